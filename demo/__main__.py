@@ -1,24 +1,29 @@
-from dotenv import load_dotenv
-load_dotenv(".env")
+import startup
+
+import os
+
+# .env がない場合は python-dotenv を読み込まない
+if os.path.exists(".env"):
+    from dotenv import load_dotenv
+    load_dotenv(".env")
 
-import configparser
 import logging
 import logging.config
 from logging import getLogger
-import os
-import yaml
 
 import constant
 
+startup.phase("env")
+
 try:
     val = os.getenv("LOGGING_CONFIG_FILE")
     if val is not None:
         if os.path.exists(val):
             constant.LOGGING_CONFIG_FILE = val
 
-    try:
-        logging.config.fileConfig(constant.LOGGING_CONFIG_FILE)
-    except (configparser.MissingSectionHeaderError, KeyError) as e:
+    def load_yaml_config():
+        import yaml
+
         try:
             with open(constant.LOGGING_CONFIG_FILE) as f:
                 yaml_conf = yaml.safe_load(f)
@@ -30,8 +35,28 @@ try:
             logging.basicConfig(level="WARNING")
             logging.error(f"log config yaml parse error: {e}")
 
+    # YAML の場合は fileConfig を試さずに読み込む
+    if os.path.splitext(constant.LOGGING_CONFIG_FILE)[1].lower() in (".yaml", ".yml"):
+        load_yaml_config()
+    else:
+        import configparser
+
+        try:
+            logging.config.fileConfig(constant.LOGGING_CONFIG_FILE)
+        except (configparser.MissingSectionHeaderError, KeyError) as e:
+            load_yaml_config()
+
+    val = os.getenv("LOGGING_QUEUE")
+    if val is not None:
+        constant.LOGGING_QUEUE = val.lower() in ("1", "true", "yes", "on")
+
+    if constant.LOGGING_QUEUE:
+        import logutil
+        logutil.start_queue_logging()
+
     # create logger
     logger = getLogger(__name__)
+    startup.phase("logging")
 
     val = os.getenv("STEPS_PER_REV")
     if val is not None:
@@ -57,6 +82,14 @@ try:
         except ValueError :
             pass
 
+    val = os.getenv("MOTOR_DRIVER")
+    if val is not None:
+        constant.MOTOR_DRIVER = val
+
+    val = os.getenv("MOTOR_AXES")
+    if val is not None:
+        constant.MOTOR_AXES = val
+
     val = os.getenv("MOTER_AMAX")
     if val is not None:
         try :
@@ -153,10 +186,118 @@ try:
         except ValueError :
             pass
 
+    val = os.getenv("MOTER_STATUS_MAX_AGE")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.MOTER_STATUS_MAX_AGE = val
+        except ValueError :
+            pass
+
+    val = os.getenv("HOMING_APPROACH_MARGIN")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.HOMING_APPROACH_MARGIN = val
+        except ValueError :
+            pass
+
+    val = os.getenv("HOMING_APPROACH_SPEED")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.HOMING_APPROACH_SPEED = val
+        except ValueError :
+            pass
+
+    val = os.getenv("HOMING_APPROACH_TIME")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.HOMING_APPROACH_TIME = val
+        except ValueError :
+            pass
+
+    val = os.getenv("STATE_FILE")
+    if val is not None:
+        constant.STATE_FILE = val
+
+    val = os.getenv("TRACKING_INTERVAL")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.TRACKING_INTERVAL = val
+        except ValueError :
+            pass
+
+    val = os.getenv("TRACKING_GAIN")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.TRACKING_GAIN = val
+        except ValueError :
+            pass
+
+    val = os.getenv("TRACKING_MAX_CORRECTION")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.TRACKING_MAX_CORRECTION = val
+        except ValueError :
+            pass
+
     val = os.getenv("APNEA_DATA_CSV_PATH")
     if val is not None:
         constant.APNEA_DATA_CSV_PATH = val
 
+    val = os.getenv("APNEA_DATA_CACHE_DIR")
+    if val is not None:
+        constant.APNEA_DATA_CACHE_DIR = val
+
+    val = os.getenv("APNEA_DATA_STREAM")
+    if val is not None:
+        constant.APNEA_DATA_STREAM = val.lower() in ("1", "true", "yes", "on")
+
+    val = os.getenv("APNEA_DATA_CHUNK_SIZE")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.APNEA_DATA_CHUNK_SIZE = val
+        except ValueError :
+            pass
+
+    val = os.getenv("PROFILE_LIBRARY_DIR")
+    if val is not None:
+        constant.PROFILE_LIBRARY_DIR = val
+
+    val = os.getenv("PROFILE_DEFAULT")
+    if val is not None:
+        constant.PROFILE_DEFAULT = val
+
+    val = os.getenv("PROFILE_CACHE_SIZE")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.PROFILE_CACHE_SIZE = val
+        except ValueError :
+            pass
+
+    val = os.getenv("PROFILE_POLL_INTERVAL")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.PROFILE_POLL_INTERVAL = val
+        except ValueError :
+            pass
+
+    val = os.getenv("PROFILE_SELECT_PRESS_TIME")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.PROFILE_SELECT_PRESS_TIME = val
+        except ValueError :
+            pass
+
     val = os.getenv("START_SW_PIN")
     if val is not None:
         try :
@@ -173,6 +314,10 @@ try:
         except ValueError :
             pass
 
+    val = os.getenv("STOP_SW_EMERGENCY")
+    if val is not None:
+        constant.STOP_SW_EMERGENCY = val.lower() in ("1", "true", "yes", "on")
+
     val = os.getenv("LIMIT_SW_PIN")
     if val is not None:
         try :
@@ -181,6 +326,26 @@ try:
         except ValueError :
             pass
 
+    val = os.getenv("LIMIT_SW_MODE")
+    if val is not None:
+        constant.LIMIT_SW_MODE = val
+
+    val = os.getenv("REFL_ACTIVE_LOW")
+    if val is not None:
+        constant.REFL_ACTIVE_LOW = val.lower() in ("1", "true", "yes", "on")
+
+    val = os.getenv("REFL_SOFT_STOP")
+    if val is not None:
+        constant.REFL_SOFT_STOP = val.lower() in ("1", "true", "yes", "on")
+
+    val = os.getenv("REFL_POLL_INTERVAL")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.REFL_POLL_INTERVAL = val
+        except ValueError :
+            pass
+
     val = os.getenv("DEBOUNCE_INTERVAL")
     if val is not None:
         try :
@@ -189,10 +354,93 @@ try:
         except ValueError :
             pass
 
+    val = os.getenv("BUTTON_DEBOUNCE_INTERVAL")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.BUTTON_DEBOUNCE_INTERVAL = val
+        except ValueError :
+            pass
+
+    val = os.getenv("SWITCH_DEBOUNCE_MODE")
+    if val is not None:
+        constant.SWITCH_DEBOUNCE_MODE = val
+
+    val = os.getenv("SWITCH_GLITCH_FILTER")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.SWITCH_GLITCH_FILTER = val
+        except ValueError :
+            pass
+
+    val = os.getenv("DEVICE_RUNTIME")
+    if val is not None:
+        constant.DEVICE_RUNTIME = val
+
+    val = os.getenv("METRICS_TEXTFILE")
+    if val is not None:
+        constant.METRICS_TEXTFILE = val
+
+    val = os.getenv("METRICS_INTERVAL")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.METRICS_INTERVAL = val
+        except ValueError :
+            pass
+
+    val = os.getenv("METRICS_HTTP_PORT")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.METRICS_HTTP_PORT = val
+        except ValueError :
+            pass
+
+    val = os.getenv("CONTROL_SOCKET")
+    if val is not None:
+        constant.CONTROL_SOCKET = val
+
+    val = os.getenv("CONTROL_STATUS_INTERVAL")
+    if val is not None:
+        try :
+            val = float(val)
+            constant.CONTROL_STATUS_INTERVAL = val
+        except ValueError :
+            pass
+
+    val = os.getenv("TELEMETRY_CAPACITY")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.TELEMETRY_CAPACITY = val
+        except ValueError :
+            pass
+
+    val = os.getenv("TELEMETRY_DECIMATION")
+    if val is not None:
+        try :
+            val = int(val)
+            constant.TELEMETRY_DECIMATION = val
+        except ValueError :
+            pass
+
+    val = os.getenv("TELEMETRY_FILE")
+    if val is not None:
+        constant.TELEMETRY_FILE = val
+
+
+    startup.phase("config")
 
     import device
+    startup.phase("imports")
     device.start()
 
 except KeyboardInterrupt:
     print("")
 
+finally:
+    if constant.LOGGING_QUEUE:
+        import logutil
+        logutil.stop_queue_logging()
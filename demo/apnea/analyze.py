@@ -0,0 +1,267 @@
+"""
+記録したテレメトリーとプロファイルの比較。
+
+テレメトリー（telemetry.TelemetryRecorder の出力）とプロファイルをサンプル番号で
+対応付け、位置誤差、速度の遅れ、オーバーランの集中、周回ごとのドリフトを求める。
+
+テレメトリーは指令（セグメント）ごとに1レコードで、サンプル番号はセグメントの
+開始サンプル、XACTUAL・VACTUAL は指令の直後に読み出した値である。そのため、
+誤差や遅れはセグメントの開始時点でのみ評価され、セグメントの途中は含まれない。
+
+    $ cd demo && python -m apnea.analyze telemetry.bin data.csv --json report.json
+
+軸ごとにプロファイルを指定する場合は軸番号の順に並べる（1つの場合は全軸に使用）。
+"""
+import argparse
+import json
+import logging
+import sys
+
+import numpy as np
+
+from apnea.data import ApneaData
+from apnea.tracking import MICROSTEPS_PER_STEP
+from telemetry import HEADER, MAGIC, RECORD, RECORD_FIELDS, VERSION
+
+# 速度の遅れを探索する範囲（サンプル数）
+MAX_LAG = 50
+# オーバーランの間隔がこのサンプル数以下であれば同じ集中とみなす
+CLUSTER_GAP = 100
+
+
+def load_trace(path: str) -> np.ndarray:
+    """
+    テレメトリーを RECORD_FIELDS の構造化配列として読み込む。拡張子が .csv の場合は CSV。
+    """
+    dtype = np.dtype(list(RECORD_FIELDS))
+    if path.lower().endswith(".csv"):
+        return np.loadtxt(path, dtype=dtype, delimiter=",", skiprows=1, ndmin=1)
+
+    with open(path, mode="rb") as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path}: truncated header")
+        magic, version, record_size, count = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError(
+                f"{path}: unsupported trace magic:{magic} version:{version}"
+                f" record size:{record_size}"
+            )
+        trace = np.fromfile(file, dtype=dtype, count=count)
+    if len(trace) != count:
+        raise ValueError(f"{path}: truncated records {len(trace)}/{count}")
+    return trace
+
+
+def _summary(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {"mean": 0.0, "rms": 0.0, "p95": 0.0, "max": 0.0}
+    magnitude = np.abs(values)
+    return {
+        "mean": float(values.mean()),
+        "rms": float(np.sqrt(np.mean(values.astype(np.float64) ** 2))),
+        "p95": float(np.percentile(magnitude, 95)),
+        "max": float(magnitude.max()),
+    }
+
+
+def position_error(trace: np.ndarray, positions: np.ndarray, scale: float) -> np.ndarray:
+    """
+    XACTUAL とプロファイルの期待位置の誤差（マイクロステップ）。
+
+    PositionTracker と同様に、最初のレコードで XACTUAL に合わせた基準から
+    ``基準 + 位置データ × 倍率`` を期待位置とする。
+    誤差はセグメントの開始サンプルでのみ求まる。
+    """
+    expected = positions[trace["index"] % len(positions)] * scale
+    actual = trace["xactual"].astype(np.float64)
+    origin = actual[0] - expected[0]
+    return actual - (origin + expected)
+
+
+def velocity_lag(trace: np.ndarray, max_lag: int = MAX_LAG) -> dict:
+    """
+    指令した VMAX に対する VACTUAL の遅れ（サンプル数）。
+
+    各レコードの VACTUAL と、L サンプル前に有効だった指令の差の二乗平均が
+    最小になる L を遅れとする。指令はレコード（セグメント）の間で保持されるとみなす。
+    VACTUAL もセグメントの開始時点の値のため、遅れの分解能はセグメントの長さに依存する。
+    """
+    index = trace["index"].astype(np.int64)
+    command = trace["vmax"].astype(np.float64)
+    vactual = trace["vactual"].astype(np.float64)
+    errors = np.empty(max_lag + 1)
+    for lag in range(max_lag + 1):
+        held = np.searchsorted(index, index - lag, side="right") - 1
+        valid = 0 <= held
+        diff = vactual[valid] - command[held[valid]]
+        errors[lag] = np.mean(diff * diff) if len(diff) else np.inf
+    lag = int(np.argmin(errors))
+    return {
+        "samples": lag,
+        "rms_error_at_lag": float(np.sqrt(errors[lag])),
+        "rms_error_at_zero": float(np.sqrt(errors[0])),
+    }
+
+
+def overrun_clusters(
+    trace: np.ndarray, interval: float, gap: int = CLUSTER_GAP
+) -> dict:
+    """
+    期限から1間隔以上遅れたレコードを、近いサンプル番号ごとにまとめる。
+
+    遅れは ``時刻 - サンプル番号 × 間隔`` の最小値を基準に求める。
+    """
+    index = trace["index"].astype(np.int64)
+    offset = trace["time"] - index * interval
+    lateness = offset - offset.min()
+    late = np.flatnonzero(interval <= lateness)
+    clusters = []
+    if len(late):
+        breaks = np.flatnonzero(np.diff(index[late]) > gap) + 1
+        for group in np.split(late, breaks):
+            clusters.append(
+                {
+                    "start_index": int(index[group[0]]),
+                    "end_index": int(index[group[-1]]),
+                    "start_time": float(trace["time"][group[0]]),
+                    "records": int(len(group)),
+                    "max_lateness": float(lateness[group].max()),
+                }
+            )
+        clusters.sort(key=lambda cluster: cluster["max_lateness"], reverse=True)
+    return {
+        "records": int(len(late)),
+        "lateness": _summary(lateness),
+        "clusters": clusters,
+    }
+
+
+def cycle_drift(trace: np.ndarray, error: np.ndarray, length: int) -> dict:
+    """
+    プロファイル1周ごとの誤差の平均と、周回に対する誤差の傾き。
+    """
+    cycle = trace["index"].astype(np.int64) // length
+    cycles = cycle - cycle.min()
+    counts = np.bincount(cycles)
+    recorded = np.flatnonzero(counts)
+    means = np.bincount(cycles, weights=error)[recorded] / counts[recorded]
+    slope = 0.0
+    if 1 < len(recorded):
+        slope = float(np.polyfit(recorded, means, 1)[0])
+    return {
+        "cycles": int(len(recorded)),
+        "slope_per_cycle": slope,
+        "mean_error": [
+            {"cycle": int(number + cycle.min()), "error": float(mean)}
+            for number, mean in zip(recorded, means)
+        ],
+    }
+
+
+def analyze_axis(trace: np.ndarray, apneadata: ApneaData) -> dict:
+    """
+    1軸分のレコード（サンプル番号順）とプロファイルを比較する。
+    """
+    positions = np.frombuffer(apneadata.positions, dtype=np.int32)
+    if len(positions) == 0:
+        raise ValueError(f"{apneadata.name}: empty profile")
+    interval = apneadata.sampling_interval
+    trace = trace[np.argsort(trace["index"], kind="stable")]
+    error = position_error(
+        trace, positions, apneadata.usteps_multiplier * MICROSTEPS_PER_STEP
+    )
+    lag = velocity_lag(trace)
+    lag["seconds"] = lag["samples"] * interval
+    return {
+        "profile": apneadata.name,
+        "records": int(len(trace)),
+        "duration": float(trace["time"][-1] - trace["time"][0]),
+        "position_error": _summary(error),
+        "velocity_lag": lag,
+        "overruns": overrun_clusters(trace, interval),
+        "drift": cycle_drift(trace, error, len(positions)),
+    }
+
+
+def analyze(trace: np.ndarray, profiles: list[ApneaData]) -> dict:
+    """
+    軸ごとにプロファイルと比較する。プロファイルが1つの場合は全軸に使用する。
+    """
+    report = {}
+    for axis in np.unique(trace["axis"]):
+        axis = int(axis)
+        apneadata = profiles[min(axis, len(profiles) - 1)]
+        report[f"axis{axis}"] = analyze_axis(trace[trace["axis"] == axis], apneadata)
+    return report
+
+
+def format_report(report: dict, clusters: int = 5) -> str:
+    lines = []
+    for name, result in report.items():
+        error = result["position_error"]
+        lag = result["velocity_lag"]
+        overruns = result["overruns"]
+        drift = result["drift"]
+        lines.append(
+            f"[{name}] profile: {result['profile']}"
+            f" records: {result['records']:,} duration: {result['duration']:,.1f}s"
+        )
+        lines.append(
+            f"  position error: mean {error['mean']:9,.1f} rms {error['rms']:9,.1f}"
+            f" p95 {error['p95']:9,.1f} max {error['max']:9,.1f}"
+        )
+        lines.append(
+            f"  velocity lag: {lag['samples']} samples ({lag['seconds']:.3f}s)"
+            f" rms {lag['rms_error_at_lag']:,.1f} (zero lag {lag['rms_error_at_zero']:,.1f})"
+        )
+        lines.append(
+            f"  overruns: {overruns['records']:,} records"
+            f" in {len(overruns['clusters'])} clusters"
+            f" max lateness {overruns['lateness']['max']:.6f}s"
+        )
+        for cluster in overruns["clusters"][:clusters]:
+            lines.append(
+                f"    index {cluster['start_index']:,}-{cluster['end_index']:,}"
+                f" records {cluster['records']:,}"
+                f" max lateness {cluster['max_lateness']:.6f}s"
+            )
+        lines.append(
+            f"  drift: {drift['slope_per_cycle']:,.2f} usteps/cycle"
+            f" over {drift['cycles']} cycles"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="テレメトリー（.bin または .csv）")
+    parser.add_argument("profiles", nargs="+", help="プロファイル（軸番号の順）")
+    parser.add_argument("--json", help="結果を JSON で出力する先（- で標準出力）")
+    parser.add_argument(
+        "--clusters", type=int, default=5, help="表示するオーバーランの集中の数"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level="WARNING")
+
+    trace = load_trace(args.trace)
+    if len(trace) == 0:
+        print(f"{args.trace}: no records", file=sys.stderr)
+        return 1
+    profiles = [ApneaData(path) for path in args.profiles]
+    report = analyze(trace, profiles)
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+        return 0
+    print(format_report(report, args.clusters))
+    if args.json is not None:
+        with open(args.json, mode="w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
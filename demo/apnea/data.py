@@ -1,13 +1,87 @@
+from array import array
 import csv
+import hashlib
+from itertools import islice
 from logging import getLogger
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from constant import *
 
 # create logger
 logger = getLogger(__name__)
 
+# バイナリキャッシュのヘッダ
+# マジック, 元CSVのサイズ, 元CSVの更新時刻(ns), サンプリング間隔(秒),
+# マイクロステップ倍率, 初期待機位置, データ数, 名前のバイト数
+_CACHE_MAGIC = b"APNEA\x00\x01\x00"
+_CACHE_HEADER = struct.Struct("=8sqqddiII")
+
+# ヘッダ行の数（名前, サンプリング間隔, マイクロステップ倍率, 初期待機位置）
+_CSV_HEADER_ROWS = 4
+
+
+def _map_columns(mm: mmap.mmap, offset: int, count: int) -> tuple[memoryview, memoryview]:
+    """
+    キャッシュのメモリマップから位置データと移動量データの列を作成する。
+
+    :param offset: 位置データの先頭（バイト）
+    :param count: データ数
+    """
+    view = memoryview(mm)
+    positions = view[offset : offset + count * 4].cast("i")
+    offset += count * 4
+    diffs = view[offset : offset + count * 4].cast("i")
+    view.release()
+    return positions, diffs
+
+
+class MovementDataView:
+    """
+    位置データと移動量データの列を (位置, 移動量) のタプル列として見せるビュー。
+
+    タプルはアクセスされた時に生成するため、全データ分のタプルは保持しない。
+    """
+
+    def __init__(self, positions, diffs):
+        self._positions = positions
+        self._diffs = diffs
+
+    @property
+    def positions(self):
+        return self._positions
+
+    @property
+    def diffs(self):
+        return self._diffs
+
+    def __len__(self):
+        return len(self._diffs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self._positions[index], self._diffs[index]))
+        return (self._positions[index], self._diffs[index])
+
+    def __iter__(self):
+        return zip(self._positions, self._diffs)
+
 
 class ApneaData:
-    def __init__(self, csv_file):
+    def __init__(
+        self,
+        csv_file,
+        cache_dir: str = APNEA_DATA_CACHE_DIR,
+        stream: bool = APNEA_DATA_STREAM,
+    ):
         self.csv_file = csv_file
+        # バイナリキャッシュの保存先（空の場合はキャッシュしない）
+        self.cache_dir = cache_dir
+        # ストリーミングモード（全データをメモリに展開しない）
+        self.stream = stream
 
         self._name = ""
         # サンプリング間隔
@@ -16,8 +90,13 @@ class ApneaData:
         self._usteps_multiplier = 0.0
         # 初期待機位置
         self._initial_position = 0
-        # 位置データと移動量データのリスト
-        self._movement_data_list = []
+        # 位置データと移動量データの列（array('i') またはメモリマップの memoryview）
+        # ストリーミングモードでキャッシュがない場合は None
+        self._positions = None
+        self._diffs = None
+        self._mmap = None
+        # メモリマップ内の位置データの先頭（バイト）
+        self._mmap_offset = 0
 
         self.load_csv()
 
@@ -38,60 +117,59 @@ class ApneaData:
         return int(self._initial_position * self._usteps_multiplier)
 
     @property
-    def movement_data_list(self):
-        return self._movement_data_list
-
-    def load_csv(self):
-        try:
-            logger.info(f"csv_file:{self.csv_file}")
-            try:
-                with open(self.csv_file, mode="r", encoding="utf-8") as file:
-                    csv_reader = csv.reader(file)
-
-                    self._name = next(csv_reader)[1]
+    def positions(self):
+        self._ensure_columns()
+        return self._positions
 
-                    try:
-                        self._sampling_interval = float(next(csv_reader)[1])/1000
-                    except ValueError:
-                        pass
+    @property
+    def diffs(self):
+        self._ensure_columns()
+        return self._diffs
 
-                    try:
-                        self._usteps_multiplier = float(next(csv_reader)[1])
-                    except ValueError:
-                        pass
+    @property
+    def nbytes(self):
+        """
+        保持している位置データと移動量データのバイト数（メモリマップを含む）
+        """
+        return sum(
+            memoryview(column).nbytes
+            for column in (self._positions, self._diffs)
+            if column is not None
+        )
 
-                    try:
-                        self._initial_position = int(next(csv_reader)[1])
-                    except ValueError:
-                        pass
-
-                    for row in csv_reader:
-                        # logger.debug(f"位置: {row[0]} 移動量: {row[1]}")
-                        # (モーター位置データ, 移動量) のタプルをリストに追加
-                        pos = 0
-                        diff = 0
-                        count = len(row)
-                        if 0 < count:
-                            try:
-                                pos = int(row[0])
-                            except ValueError:
-                                pass
+    @property
+    def movement_data_list(self):
+        self._ensure_columns()
+        return MovementDataView(self._positions, self._diffs)
 
-                            if 1 < count:
-                                try:
-                                    diff = int(row[1])
-                                except ValueError:
-                                    pass
+    @property
+    def cache_file(self):
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1(os.path.abspath(self.csv_file).encode("utf-8"))
+        return os.path.join(self.cache_dir, f"{key.hexdigest()}.bin")
 
-                        self._movement_data_list.append((pos, diff))
-            except StopIteration:
-                pass
+    def load_csv(self):
+        try:
+            logger.info(f"csv_file:{self.csv_file}")
+            self.close()
+            stat = os.stat(self.csv_file)
+            if not self._load_cache(stat):
+                if self.stream:
+                    # CSVをチャンク単位でキャッシュに変換してからメモリマップする
+                    self._parse_csv_header()
+                    if self._save_cache(stat, self._iter_csv_chunks()):
+                        self._load_cache(stat)
+                else:
+                    self._parse_csv()
+                    self._save_cache(stat, ((self._positions, self._diffs),))
 
             # CSVファイルから読み込んだ内容を確認
             logger.info(f"制御間隔: {self._sampling_interval}")
             logger.info(f"マイクロステップ: {self._usteps_multiplier}")
             logger.info(f"初期待機位置: {self._initial_position}")
-            logger.info(f"移動データ数: {len(self._movement_data_list)}")
+            if self._diffs is not None:
+                logger.info(f"移動データ数: {len(self._diffs)}")
 
             # for movement_data in self.movement_data:
             #   logger.debug(f"位置: {movement_data[0]} 移動量: {movement_data[1]}")
@@ -99,5 +177,269 @@ class ApneaData:
             logger.error(f"csv file not found {self.csv_file}")
             raise
         except:
-            logger.error(f"csv file read error {len(self._movement_data_list)}")
+            logger.error(f"csv file read error {self.csv_file}")
+            raise
+
+    def close(self):
+        """
+        メモリマップしたキャッシュを解放する。
+
+        iter_chunks、iter_movements などが返した列のスライスを使用中の場合は
+        BufferError を送出する。その場合、列は閉じる前と同じように使用できる。
+        """
+        if self._mmap is None:
+            return
+        count = len(self._diffs)
+        try:
+            self._positions.release()
+            self._diffs.release()
+            self._mmap.close()
+        except BufferError:
+            # 解放した列を作り直して開いたままにする
+            self._positions, self._diffs = _map_columns(
+                self._mmap, self._mmap_offset, count
+            )
             raise
+        self._positions = None
+        self._diffs = None
+        self._mmap = None
+
+    def iter_chunks(self, chunk_size: int = APNEA_DATA_CHUNK_SIZE):
+        """
+        位置データと移動量データを chunk_size 行ずつ返すジェネレータ。
+
+        列を保持していない場合（ストリーミングモードでキャッシュなし）は
+        CSVファイルから逐次読み込む。
+
+        :return: (位置データ, 移動量データ) のイテレータ
+        """
+        if self._diffs is None:
+            yield from self._iter_csv_chunks(chunk_size)
+            return
+        for start in range(0, len(self._diffs), chunk_size):
+            end = start + chunk_size
+            yield self._positions[start:end], self._diffs[start:end]
+
+    def iter_movements(self, chunk_size: int = APNEA_DATA_CHUNK_SIZE):
+        """
+        (位置, 移動量) のタプルを1行ずつ返すジェネレータ。
+        """
+        for positions, diffs in self.iter_chunks(chunk_size):
+            yield from zip(positions, diffs)
+
+    def _ensure_columns(self):
+        if self._diffs is None:
+            # ストリーミングモードでキャッシュがない場合は列をメモリに読み込む
+            logger.info(f"load columns {self.csv_file}")
+            self._parse_csv()
+
+    def _read_csv_header(self, csv_reader):
+        self._name = next(csv_reader)[1]
+
+        try:
+            self._sampling_interval = float(next(csv_reader)[1])/1000
+        except ValueError:
+            pass
+
+        try:
+            self._usteps_multiplier = float(next(csv_reader)[1])
+        except ValueError:
+            pass
+
+        try:
+            self._initial_position = int(next(csv_reader)[1])
+        except ValueError:
+            pass
+
+    def _parse_csv_header(self):
+        with open(self.csv_file, mode="r", encoding="utf-8") as file:
+            try:
+                self._read_csv_header(csv.reader(file))
+            except StopIteration:
+                pass
+
+    def _parse_csv(self):
+        positions = array("i")
+        diffs = array("i")
+        for chunk_positions, chunk_diffs in self._iter_csv_chunks(
+            header=True
+        ):
+            positions.extend(chunk_positions)
+            diffs.extend(chunk_diffs)
+        self._positions = positions
+        self._diffs = diffs
+
+    def _iter_csv_chunks(
+        self, chunk_size: int = APNEA_DATA_CHUNK_SIZE, header: bool = False
+    ):
+        """
+        CSVファイルのデータ行を chunk_size 行ずつ array('i') の組で返す。
+
+        :param header: True の場合はヘッダ行の内容も読み込む
+        """
+        with open(self.csv_file, mode="r", encoding="utf-8") as file:
+            csv_reader = csv.reader(file)
+            try:
+                if header:
+                    self._read_csv_header(csv_reader)
+                else:
+                    for _ in range(_CSV_HEADER_ROWS):
+                        next(csv_reader)
+            except StopIteration:
+                return
+
+            while True:
+                positions = array("i")
+                diffs = array("i")
+                for row in islice(csv_reader, chunk_size):
+                    # logger.debug(f"位置: {row[0]} 移動量: {row[1]}")
+                    pos = 0
+                    diff = 0
+                    count = len(row)
+                    if 0 < count:
+                        try:
+                            pos = int(row[0])
+                        except ValueError:
+                            pass
+
+                        if 1 < count:
+                            try:
+                                diff = int(row[1])
+                            except ValueError:
+                                pass
+
+                    try:
+                        positions.append(pos)
+                        diffs.append(diff)
+                    except OverflowError:
+                        raise ValueError(
+                            f"line {csv_reader.line_num}: {row} is out of int32 range"
+                        ) from None
+                if not diffs:
+                    return
+                yield positions, diffs
+
+    def _load_cache(self, stat: os.stat_result) -> bool:
+        """
+        バイナリキャッシュをメモリマップで読み込む。
+
+        データ列はメモリマップ上の memoryview として保持し、メモリには展開しない。
+
+        :return: 元CSVのサイズと更新時刻が一致するキャッシュを読み込めた場合は True
+        """
+        cache_file = self.cache_file
+        if cache_file is None:
+            return False
+        try:
+            with open(cache_file, mode="rb") as file:
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"cache file read error {cache_file}: {e}")
+            return False
+
+        try:
+            (
+                magic,
+                size,
+                mtime_ns,
+                sampling_interval,
+                usteps_multiplier,
+                initial_position,
+                count,
+                name_len,
+            ) = _CACHE_HEADER.unpack_from(mm)
+            if (
+                magic != _CACHE_MAGIC
+                or size != stat.st_size
+                or mtime_ns != stat.st_mtime_ns
+            ):
+                logger.info(f"cache file is stale {cache_file}")
+                mm.close()
+                return False
+
+            offset = _CACHE_HEADER.size
+            name = mm[offset : offset + name_len].decode("utf-8")
+            offset += (name_len + 3) & ~3
+
+            positions, diffs = _map_columns(mm, offset, count)
+            if len(diffs) != count:
+                positions.release()
+                diffs.release()
+                raise ValueError("truncated cache file")
+        except (ValueError, struct.error) as e:
+            logger.warning(f"cache file read error {cache_file}: {e}")
+            mm.close()
+            return False
+
+        self._name = name
+        self._sampling_interval = sampling_interval
+        self._usteps_multiplier = usteps_multiplier
+        self._initial_position = initial_position
+        self._positions = positions
+        self._diffs = diffs
+        self._mmap = mm
+        self._mmap_offset = offset
+        logger.info(f"cache file loaded {cache_file}")
+        return True
+
+    def _save_cache(self, stat: os.stat_result, chunks) -> bool:
+        """
+        データ列をバイナリキャッシュに書き出す。
+
+        位置データと移動量データをチャンク単位で書き込むため、
+        全データをメモリに展開せずに変換できる。
+        一時ファイルに書き込んでから置き換えるため、途中で電源が切れても
+        壊れたキャッシュは残らない。
+
+        :param chunks: (位置データ, 移動量データ) のイテレータ
+        :return: キャッシュを書き出した場合は True
+        """
+        cache_file = self.cache_file
+        if cache_file is None:
+            return False
+        try:
+            name = self._name.encode("utf-8")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                count = 0
+                with os.fdopen(fd, mode="w+b") as file, tempfile.TemporaryFile(
+                    dir=self.cache_dir
+                ) as diffs_file:
+                    file.write(bytes(_CACHE_HEADER.size))
+                    file.write(name)
+                    file.write(bytes(-len(name) & 3))
+                    for positions, diffs in chunks:
+                        file.write(array("i", positions))
+                        diffs_file.write(array("i", diffs))
+                        count += len(diffs)
+                    diffs_file.seek(0)
+                    shutil.copyfileobj(diffs_file, file)
+
+                    file.seek(0)
+                    file.write(
+                        _CACHE_HEADER.pack(
+                            _CACHE_MAGIC,
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                            self._sampling_interval,
+                            self._usteps_multiplier,
+                            self._initial_position,
+                            count,
+                            len(name),
+                        )
+                    )
+                    # 置き換える前にデータをディスクへ書き出す
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_file, cache_file)
+            except:
+                os.unlink(tmp_file)
+                raise
+            logger.info(f"cache file saved {cache_file}")
+            return True
+        except (OSError, struct.error) as e:
+            logger.warning(f"cache file write error {cache_file}: {e}")
+            return False
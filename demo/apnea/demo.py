@@ -1,200 +1,1090 @@
 from cgstep import TMC5240
-from logging import getLogger
+from itertools import chain
+from logging import getLogger, INFO
 import time
 from threading import Thread, Event
 
 from constant import *
 
+import metrics
 from apnea.data import ApneaData
-from motor import MotorController, calculate_motor_rpm
+from apnea.library import ProfileLibrary
+from apnea.tracking import PositionTracker
+from logutil import StatusField
+from motor import (
+    MotorController,
+    SegmentSchedule,
+    RAMP_STAT_POSITION_REACHED,
+    RAMP_STAT_VZERO,
+)
+from scheduler import DeadlineScheduler
+from telemetry import TelemetryChannel, TelemetryRecorder
 
 logger = getLogger(__name__)
 
-_g_reference_point_event = Event()
-_g_stop_event = Event()
-_g_thread = None
-
 
 class StopEvent(Exception):
     pass
 
-def start(motorController: MotorController, apneadata: ApneaData) -> Thread:
-    global _g_thread
-    if isinstance(_g_thread, Thread):
-        if _g_thread.is_alive():
-            return
-    _g_thread = Thread(
-        target=_run, args=(motorController, apneadata)
-    )
-    _g_thread.start()
 
-    return _g_thread
+class ApneaAxis:
+    """
+    ApneaPlayer で再生する1軸分のモーター、プロファイル、基準点の状態。
 
+    :param motorController: モーターコントローラー（軸ごとに別の CS 信号）
+    :param apneadata: 再生するプロファイル
+    :param name: ログに表示する軸の名前
+    :param clock: 基準点への移動の時間を計る単調増加時計（秒）
+    """
 
-def stop():
-    global _g_stop_event
-    global _g_thread
-    if isinstance(_g_thread, Thread):
-        if _g_thread.is_alive():
-            _g_stop_event.set()
-    return _g_thread
+    def __init__(
+        self,
+        motorController: MotorController,
+        apneadata: ApneaData,
+        name: str = "axis0",
+        clock=time.monotonic,
+    ):
+        self.motorController = motorController
+        self.apneadata = apneadata
+        self.name = name
+        self._clock = clock
+        self.reference_point_event = Event()
+        # 事前に変換した速度スケジュール（ストリーミングモードでは None）
+        self.schedule: SegmentSchedule = None
+        # 位置追従の補正（None の場合は補正しない）
+        self.tracker: PositionTracker = None
+        # テレメトリーの記録口（None の場合は記録しない）
+        self.telemetry: TelemetryChannel = None
+        # 基準点（XACTUAL=0）から見たリミットスイッチの検出位置（不明の場合は None）
+        self.reference_offset: int = None
 
+        # 基準点への移動の状態
+        self._approaching = False
+        self._slow_until = None
+        self._homing_edge = None
 
-def get_thread_instance() -> Thread:
-    global _g_thread
-    return _g_thread
+        # 再生状態
+        self._time_start = 0.0
+        self._index = 0
+        self._remaining = None
+        self._iter_schedule = None
+        # 最後に送った (VMAX, RAMPMODE)（停止を指令した場合は None）
+        self._command = None
+        self._wraps = metrics.PROFILE_WRAPS.labels(name)
 
+    @property
+    def interval(self):
+        return self.apneadata.sampling_interval
 
-def reached_reference_point() -> None:
-    _g_reference_point_event.set()
+    @property
+    def deadline(self):
+        """
+        次の指令を送るサンプルの期限
+        """
+        return self._time_start + self._index * self.apneadata.sampling_interval
 
+    @property
+    def index(self):
+        """
+        次の指令を送るサンプル番号
+        """
+        return self._index
 
-def moved_away_reference_point() -> None:
-    _g_reference_point_event.clear()
+    @property
+    def finished(self):
+        return self._remaining is not None and self._remaining <= 0
 
+    @property
+    def schedule_key(self):
+        """
+        ProfileLibrary に変換済みの速度スケジュールをキャッシュするキー
+        """
+        return (self.name, self._max_length())
 
-def move_to_reference_point(motorController: MotorController) -> None:
+    def compile(self, library: ProfileLibrary = None) -> None:
+        """
+        プロファイルを速度スケジュールに変換する。ストリーミングモードでは
+        再生中にチャンク単位で変換する。
 
-    # モーターを停止
-    _stop_motor(motorController)
-    # モーターの位置を基準点に移動
-    if not _g_reference_point_event.is_set():
-        motorController.rotate_backwards()
-        time_start = time.time()
-        time_limit = time_start + MOTER_LIMIT_TIME_OF_DRIVE
-        while not _g_reference_point_event.is_set():
-            _check_stop_event(0.1)
+        :param library: 変換済みのスケジュールをキャッシュするライブラリ
+        """
+        if 0 < TRACKING_INTERVAL:
+            self.tracker = PositionTracker(
+                self.motorController,
+                self.apneadata.usteps_multiplier,
+                self.apneadata.sampling_interval,
+            )
+        if self.apneadata.stream:
+            return
+        apneadata = self.apneadata
+        if library is None:
+            self.schedule = self.compile_schedule(apneadata)
+        else:
+            self.schedule = library.schedule(
+                apneadata, self.schedule_key, lambda: self.compile_schedule(apneadata)
+            )
+        logger.info(
+            f"[{self.name}] Schedule compiled."
+            f" samples:{self.schedule.samples} segments:{len(self.schedule)}"
+        )
 
-            if time_limit < time.time():
-                logger.error("Reference point not reached.")
-                break
-            logger.debug(
-                f"Motor controller is moving."
-                f" xtarget:{motorController.tmc5240.xtarget:9},"
-                f" xactual:{motorController.tmc5240.xactual:9},"
-                f" vactual:{motorController.tmc5240.vactual:9}"
+    def compile_schedule(self, apneadata: ApneaData) -> SegmentSchedule:
+        """
+        プロファイルをこの軸の速度スケジュールに変換する（軸の状態は変更しない）。
+        """
+        return self.motorController.compile_schedule(
+            apneadata.sampling_interval,
+            apneadata.usteps_multiplier,
+            apneadata.diffs,
+        ).segments(self._max_length())
+
+    def _max_length(self) -> int:
+        # 位置追従時は XACTUAL を確認する間隔（PositionTracker.interval）でセグメントを分割する
+        return max(1, TRACKING_INTERVAL) if 0 < TRACKING_INTERVAL else 0
+
+    def _iter_segments(self):
+        """
+        プロファイル1周分の (VMAX, RAMPMODE, サンプル数, 位置データ) を返すイテレータを
+        作成する。同じ指令が続くサンプルは1つのセグメントにまとめる。
+
+        事前に変換したスケジュールがない場合（ストリーミングモード）は、
+        データをチャンク単位で読み込みながら変換する。
+        """
+        apneadata = self.apneadata
+        if self.schedule is not None:
+            positions = apneadata.positions
+            return (
+                (vmax, rampmode, count, positions[start])
+                for vmax, rampmode, start, count in self.schedule
             )
-        # モーターを停止
-        _stop_motor(motorController)
+        max_length = self._max_length()
+        return chain.from_iterable(
+            (
+                (vmax, rampmode, count, positions[start])
+                for vmax, rampmode, start, count in self.motorController.compile_schedule(
+                    apneadata.sampling_interval, apneadata.usteps_multiplier, diffs
+                ).segments(max_length)
+            )
+            for positions, diffs in apneadata.iter_chunks()
+        )
 
-    # モーターの基準点を現在位置に設定
-    motorController.set_reference_point()
+    def start_homing(self) -> None:
+        """
+        基準点への移動を開始する。
 
+        基準点の位置がわかっている場合は、リミットスイッチの手前まで位置決めで
+        移動してから HOMING_APPROACH_SPEED で近づく。わかっていない場合は
+        MOTER_DEFAULT_SPEED で後退してリミットスイッチを探す。
+        """
+        self._homing_edge = None
+        if self.motorController.reference_switch_enabled:
+            # 前回の検出位置のラッチを捨てる
+            self.motorController.clear_reference_latch()
+        if self.reference_offset is not None:
+            target = self.reference_offset + HOMING_APPROACH_MARGIN
+            if target < self.motorController.status(0).xactual:
+                self._approaching = True
+                self._slow_until = None
+                self.motorController.move_target(target)
+                return
+            self._search(HOMING_APPROACH_SPEED)
+        else:
+            self._search(MOTER_DEFAULT_SPEED)
 
-def _check_stop_event(wait:float=0.0) -> None:
-    if _g_stop_event.wait(wait):
-        raise StopEvent()
+    def _search(self, rpm: float) -> None:
+        self._approaching = False
+        self._slow_until = None
+        if rpm < MOTER_DEFAULT_SPEED:
+            self._slow_until = self._clock() + HOMING_APPROACH_TIME
+        self.motorController.rotate_backwards(rpm)
 
+    def update_homing(self) -> float:
+        """
+        基準点への移動の状態を更新する。リミットスイッチを検出した場合はモーターを停止する。
 
-def _stop_motor(motorController: MotorController) -> None:
-    # モーターを停止
-    motorController.stop()
-    while motorController.is_running():
-        _check_stop_event(0.1)
-        
-        logger.debug(
-            f"Motor controller is stopping."
-            f" xtarget:{motorController.tmc5240.xtarget:9},"
-            f" xactual:{motorController.tmc5240.xactual:9},"
-            f" vactual:{motorController.tmc5240.vactual:9}"
-        )
+        リミットスイッチが REFL に接続されている場合は、ドライバーが停止して
+        検出位置をラッチしているため、ステータスを読み出してスイッチの状態を反映し、
+        ラッチした位置を検出位置とする。
 
+        :return: 基準点に到達した場合は None、それ以外は次に確認するまでの最大間隔（秒）
+        """
+        motorController = self.motorController
+        refl = motorController.reference_switch_enabled
+        status = None
+        if refl:
+            # スイッチの状態は reached_reference_point のコールバックで反映される
+            status = motorController.status(0)
+        if self.reference_point_event.is_set():
+            if status is not None and status.status_latch_l:
+                self._homing_edge = motorController.read_latch()
+            else:
+                self._homing_edge = motorController.status(0).xactual
+            motorController.stop()
+            return None
+        interval = 1.0
+        if self._approaching:
+            status = motorController.status(0)
+            if status.ramp_stat & RAMP_STAT_POSITION_REACHED != RAMP_STAT_POSITION_REACHED:
+                interval = motorController.poll_interval(RAMP_STAT_POSITION_REACHED, status)
+            else:
+                logger.debug(f"[{self.name}] Approach reached. {status.xactual}")
+                self._search(HOMING_APPROACH_SPEED)
+        if not self._approaching and self._slow_until is not None:
+            time_remaining = self._slow_until - self._clock()
+            if 0 < time_remaining:
+                interval = time_remaining
+            else:
+                # 保存した位置と実際の位置がずれている
+                logger.warning(
+                    f"[{self.name}] Reference point not found near the saved position."
+                )
+                self._search(MOTER_DEFAULT_SPEED)
+        if refl:
+            interval = min(interval, REFL_POLL_INTERVAL)
+        return interval
 
-def _run(motorController: MotorController, apneadata: ApneaData):
+    def finish_homing(self, reached: bool = True) -> None:
+        """
+        停止した位置を基準点に設定し、リミットスイッチの検出位置を記録する。
 
-    logger.info("Apnea demo start.")
-    _g_stop_event.clear()
-    try:
-        sample_interval = apneadata.sampling_interval
-        logging_interval = 1.0  # ロギング間隔（秒）
+        :param reached: リミットスイッチに到達したか（False の場合は基準点を不明とする）
+        """
+        motorController = self.motorController
+        if not reached:
+            self.reference_offset = None
+        elif self._homing_edge is not None:
+            self.reference_offset = self._homing_edge - motorController.status(0).xactual
+        self._homing_edge = None
+        motorController.set_reference_point()
 
-        time_start = time.time()  # 開始時刻を取得
-        time_sampling = time_start + sample_interval  # サンプリング時間を初期化
+    def set_reference_point(self) -> None:
+        """
+        停止中の現在位置を基準点に設定する。リミットスイッチの検出位置は
+        新しい基準点からの位置に直す。
+        """
+        motorController = self.motorController
+        xactual = motorController.status(0).xactual
+        motorController.set_reference_point()
+        if self.reference_offset is not None:
+            self.reference_offset -= xactual
 
-        time_logging = time_start + logging_interval  # ロギング時間を初期化
+    def position_state(self) -> dict:
+        """
+        保存する位置（基準点が不明、または移動中の場合は None）
+        """
+        if self.reference_offset is None:
+            return None
+        status = self.motorController.status(0)
+        if status.is_running():
+            return None
+        return {"xactual": status.xactual, "reference": self.reference_offset}
 
-        rpms = calculate_motor_rpm(
-            apneadata.sampling_interval,
-            apneadata.usteps_multiplier,
-            apneadata.movement_data_list,
-            steps_per_rev=STEPS_PER_REV,
+    def restore_position_state(self, entry: dict) -> None:
+        """
+        保存した位置を復元する。
+        """
+        self.motorController.set_position(entry["xactual"])
+        self.reference_offset = entry["reference"]
+        logger.info(
+            f"[{self.name}] Position restored."
+            f" xactual:{entry['xactual']} reference:{entry['reference']}"
         )
-        iter_rpms = iter(rpms)
 
-        # モータードライバーを印加
-        if not motorController.is_poweron():
-            motorController.poweron()
+    def start(self, time_start: float, samples: int = None) -> None:
+        """
+        再生を開始する。最初の期限は開始時刻から1間隔後。
+
+        :param samples: 再生するサンプル数（None の場合は停止要求まで繰り返す）
+        """
+        self._time_start = time_start
+        self._index = 1
+        self._remaining = samples
+        self._iter_schedule = self._iter_segments()
+        self._command = None
+        if self.tracker is not None:
+            self.tracker.reset()
+
+    def resume(self, shift: float) -> None:
+        """
+        一時停止から再開する。期限を一時停止していた時間だけ遅らせ、
+        一時停止で止めたセグメントの指令を送り直す。
+        基準点に到達している場合、逆方向の指令は送り直さない（step と同じ）。
+
+        :param shift: 一時停止していた時間（秒）
+        """
+        self._time_start += shift
+        if self._command is None:
+            return
+        vmax, rampmode = self._command
+        if (
+            rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+            and self.reference_point_event.is_set()
+        ):
+            self._command = None
+            return
+        self.motorController.set_velocity(vmax, rampmode)
+
+    def step(self) -> tuple[int, int, int]:
+        """
+        次のセグメントの指令をモータードライバーへ送り、期限をセグメントの終わりに進める。
+
+        :return: 送った (VMAX, RAMPMODE, サンプル数)
+        """
+        try:
+            vmax, rampmode, count, pos = next(self._iter_schedule)
+        except StopIteration:
+            self._wraps.inc()
+            self._iter_schedule = self._iter_segments()
+            vmax, rampmode, count, pos = next(self._iter_schedule)
+        if self._remaining is not None:
+            count = min(count, self._remaining)
+            self._remaining -= count
+
+        if self.tracker is not None:
+            vmax, rampmode = self.tracker.correct(vmax, rampmode, pos, count)
+
+        if (
+            rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+            and self.motorController.reference_switch_enabled
+        ):
+            # REFL のスイッチの状態を反映する（ドライバーは既に停止している）
+            self.motorController.status()
+        if (
+            rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+            and self.reference_point_event.is_set()
+        ):
+            self.motorController.stop()
+            self._command = None
+        else:
+            self.motorController.set_velocity(vmax, rampmode)
+            self._command = (vmax, rampmode)
+
+        if self.telemetry is not None:
+            # 負方向の指令は負の VMAX として VACTUAL と比較できるようにする
+            if rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE:
+                velocity = -vmax
+            else:
+                velocity = vmax
+            self.telemetry.record(self._index - 1, velocity, self.motorController)
+        self._index += count
+        return vmax, rampmode, count
+
+
+class ApneaPlayer:
+    """
+    複数の軸のプロファイルを1本のスレッドで再生するプレーヤー。
+
+    すべての軸を1つの DeadlineScheduler で駆動し、各軸の期限（開始時刻 +
+    サンプル番号 × サンプリング間隔）のうち最も早いものまでスリープする。
+    同じ期限の軸は同じ起床で指令を送るため、軸を増やしてもスレッドは増えない。
+
+    ホーミングから再生までの手順は待機する時刻を返すジェネレーター（*_steps）で、
+    制御スレッド（drive）と asyncio のランタイム（runtime.DeviceRuntime.drive）が
+    同じ手順を実行する。
+
+    :param axes: 再生する軸
+    :param clock: 再生の期限を計る単調増加時計（秒）
+    :param sleep: clock の時間で待機する関数（None の場合は実時間で待機する）
+    """
+
+    def __init__(
+        self, axes: list[ApneaAxis] = None, clock=time.monotonic, sleep=None
+    ):
+        self._axes = list(axes) if axes is not None else []
+        self._clock = clock
+        self._sleep = sleep
+        self._stop_event = Event()
+        # 制御スレッドを起床させるイベント（停止要求、一時停止と再開の要求、基準点到達）
+        self._wake_event = Event()
+        self._thread = None
+        self._telemetry = None
+        self._library = None
+        # 一時停止の要求
+        self._pause_event = Event()
+        self._time_paused = 0.0
+        # 制御ループが公開する状態（idle, starting, playing, paused, stopping）
+        self._state = "idle"
+        self._snapshot = None
+        self.publish_status()
+
+    @property
+    def axes(self):
+        return self._axes
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def paused(self) -> bool:
+        return self._pause_event.is_set()
+
+    @property
+    def snapshot(self) -> dict:
+        """
+        制御ループが最後に公開した状態。任意のスレッドから参照でき、SPI 通信は行わない。
+        """
+        return self._snapshot
+
+    def publish_status(
+        self,
+        state: str = None,
+        scheduler: DeadlineScheduler = None,
+        max_age: float = None,
+    ) -> None:
+        """
+        現在の状態とモーターのステータスからスナップショットを作成して公開する。
+        制御ループから呼び出す。
+
+        :param state: 新しい状態（None の場合は変更しない）
+        :param scheduler: 再生中のスケジューラ（経過時間と遅れを含める）
+        :param max_age: ステータスの最大経過時間（秒）。古い場合は読み出す
+                        （None の場合はキャッシュしているステータスを使う）
+        """
+        if state is not None:
+            self._state = state
+        now = self._clock()
+        axes = []
+        for axis in self._axes:
+            entry = {
+                "name": axis.name,
+                "profile": axis.apneadata.name,
+                "index": axis.index,
+                "reference_offset": axis.reference_offset,
+            }
+            if max_age is None:
+                status = axis.motorController.last_status
+            else:
+                status = axis.motorController.status(max_age)
+            if status is not None:
+                entry["xactual"] = status.xactual
+                entry["vactual"] = status.vactual
+                entry["vmax"] = status.vmax
+                entry["rpm"] = status.vactual_rpm
+                entry["status_age"] = now - status.timestamp
+            axes.append(entry)
+        snapshot = {
+            "state": self._state,
+            "time": time.time(),
+            "selected_profile": None if self._library is None else self._library.selected,
+            "axes": axes,
+        }
+        if scheduler is not None:
+            snapshot["elapsed"] = scheduler.now() - scheduler.time_start
+            snapshot["lateness"] = scheduler.lateness
+            snapshot["overruns"] = scheduler.overruns
+        # 参照の置き換えで公開する（公開後のスナップショットは変更しない）
+        self._snapshot = snapshot
+
+    def pause(self) -> bool:
+        """
+        再生を一時停止する。制御ループがモーターを停止し、再開するまで期限を進めない。
+
+        :return: 一時停止した場合は True（再生中でない場合は False）
+        """
+        if self._state != "playing" or self._pause_event.is_set():
+            return False
+        self._time_paused = self._clock()
+        self._pause_event.set()
+        self._wake_event.set()
+        return True
+
+    def resume(self) -> bool:
+        """
+        一時停止した再生を再開する。
+
+        :return: 再開した場合は True（一時停止していない場合は False）
+        """
+        if not self._pause_event.is_set():
+            return False
+        self._pause_event.clear()
+        self._wake_event.set()
+        return True
+
+    def paused_time(self) -> float:
+        """
+        一時停止を要求した時刻からの経過時間（秒）
+        """
+        return self._clock() - self._time_paused
+
+    def clear_pause(self) -> None:
+        self._pause_event.clear()
+
+    @property
+    def library(self) -> ProfileLibrary:
+        return self._library
+
+    def set_library(self, library: ProfileLibrary) -> None:
+        """
+        再生開始時にライブラリで選択中のプロファイルをすべての軸で再生する。
+        None で各軸のプロファイルに戻す。
+        """
+        self._library = library
+
+    def select_profile(self, name: str = None, prepare: bool = None) -> str:
+        """
+        次の再生で使用するプロファイルを選択する。再生中の場合は次の開始から使用する。
+
+        :param name: プロファイルの名前（None の場合は名前の順で次のプロファイル）
+        :param prepare: 別スレッドで読み込みと変換を済ませておく（None の場合は再生中でなければ行う）
+        :return: 選択したプロファイルの名前（ライブラリがない場合は None）
+        """
+        library = self._library
+        if library is None:
+            return None
+        if name is None:
+            name = library.select_next()
+        else:
+            name = library.select(name)
+        if prepare is None:
+            # 再生中は制御スレッドのタイミングを乱さないように変換しない
+            prepare = not (isinstance(self._thread, Thread) and self._thread.is_alive())
+        if prepare and name is not None:
+            Thread(
+                target=self.prepare_profile, args=(name,), name="ProfilePrepare", daemon=True
+            ).start()
+        return name
+
+    def prepare_profile(self, name: str = None) -> None:
+        """
+        ライブラリのプロファイルを読み込み、各軸の速度スケジュールに変換してキャッシュする。
+
+        :param name: プロファイルの名前（None の場合は選択中のプロファイル）
+        """
+        library = self._library
+        if library is None:
+            return
+        try:
+            apneadata = library.load(name)
+            if apneadata.stream:
+                return
+            for axis in self._axes:
+                library.schedule(
+                    apneadata,
+                    axis.schedule_key,
+                    lambda axis=axis: axis.compile_schedule(apneadata),
+                )
+        except Exception:
+            logger.exception(f"profile prepare error {name}")
+
+    def load_profile(self) -> None:
+        """
+        ライブラリで選択中のプロファイルをすべての軸に設定する。ライブラリがない場合は何もしない。
+        """
+        if self._library is None:
+            return
+        apneadata = self._library.load()
+        for axis in self._axes:
+            if axis.apneadata is not apneadata:
+                logger.info(f"[{axis.name}] profile: {self._library.selected}")
+                axis.apneadata = apneadata
+
+    @property
+    def telemetry(self) -> TelemetryRecorder:
+        return self._telemetry
+
+    def set_telemetry(self, recorder: TelemetryRecorder) -> None:
+        """
+        すべての軸の指令と位置をレコーダーに記録する。None で記録を止める。
+        """
+        self._telemetry = recorder
+        for number, axis in enumerate(self._axes):
+            axis.telemetry = recorder.channel(number) if recorder is not None else None
+
+    def dump_telemetry(self, path: str = None) -> str:
+        """
+        テレメトリーをファイルへ書き出す。記録していない場合は何もしない。
+
+        :return: 書き出したファイルのパス
+        """
+        if self._telemetry is None:
+            return None
+        try:
+            return self._telemetry.dump(path)
+        except OSError:
+            logger.exception("telemetry dump error")
+            return None
+
+    @property
+    def thread(self) -> Thread:
+        return self._thread
+
+    def add_axis(
+        self,
+        motorController: MotorController,
+        apneadata: ApneaData,
+        name: str = None,
+    ) -> ApneaAxis:
+        if name is None:
+            name = f"axis{len(self._axes)}"
+        axis = ApneaAxis(motorController, apneadata, name, self._clock)
+        self._axes.append(axis)
+        self.publish_status()
+        return axis
+
+    def start(self) -> Thread:
+        if isinstance(self._thread, Thread):
+            if self._thread.is_alive():
+                return
+        self._thread = Thread(target=self._run)
+        self._thread.start()
+
+        return self._thread
+
+    def stop(self) -> Thread:
+        if isinstance(self._thread, Thread):
+            if self._thread.is_alive():
+                self._stop_event.set()
+                self._wake_event.set()
+        return self._thread
+
+    def emergency_stop(self, time_edge: float = None) -> list[float]:
+        """
+        すべての軸に VMAX=0 を直ちに書き込み、続けて通常の停止を要求する。
+        任意のスレッドから呼び出せる。
+
+        基準点へ戻っている間と、非常停止をラッチ済みの間は何もしない。
+        停止スイッチのチャタリングで基準点への戻りを中断しないため。
+
+        :param time_edge: スイッチのエッジを検出した時刻（time.monotonic）
+        :return: 各軸のエッジ検出から書き込み完了までの時間（秒）。何もしなかった場合は空
+        """
+        if self._state == "stopping" or all(
+            axis.motorController.emergency_stopped for axis in self._axes
+        ):
+            return []
+        latencies = [
+            axis.motorController.emergency_stop(time_edge) for axis in self._axes
+        ]
+        self.stop()
+        return latencies
+
+    def _clear_emergency_stop(self) -> None:
+        for axis in self._axes:
+            axis.motorController.clear_emergency_stop()
+
+    def reached_reference_point(self, axis: int = 0) -> None:
+        self._axes[axis].reference_point_event.set()
+        self._wake_event.set()
+
+    def moved_away_reference_point(self, axis: int = 0) -> None:
+        self._axes[axis].reference_point_event.clear()
+
+    def drive(self, steps):
+        """
+        手順（ジェネレーター）を呼び出し元のスレッドで最後まで実行する。
+
+        手順は次に起床する時刻（clock の時刻）、または起床イベントまで待機する
+        場合は None を返す。起床イベント（停止要求、一時停止と再開の要求、基準点到達）で
+        早く戻った場合も手順を進め、状態の確認は手順が行う。停止要求は手順へ StopEvent
+        として送る。
+
+        :param steps: *_steps が返すジェネレーター
+        :return: 手順の戻り値
+        """
+        sleeper = DeadlineScheduler(0.0, self._wake_event, self._clock, self._sleep)
+        try:
+            wait = next(steps)
+            while True:
+                if wait is None:
+                    self._wake_event.wait()
+                else:
+                    sleeper.sleep_until(wait)
+                self._wake_event.clear()
+                if self._stop_event.is_set():
+                    self._stop_event.clear()
+                    wait = steps.throw(StopEvent())
+                else:
+                    wait = next(steps)
+        except StopIteration as e:
+            return e.value
+
+    def move_to_reference_point(self, axes: list[ApneaAxis] = None) -> None:
+        """
+        すべての軸を同時に基準点へ移動し、現在位置を基準点に設定する（homing_steps）。
+        """
+        self.drive(self.homing_steps(axes))
+
+    def homing_steps(self, axes: list[ApneaAxis] = None):
+        """
+        すべての軸を同時に基準点へ移動し、現在位置を基準点に設定する手順。
+        基準点の位置がわかっている軸は手前まで高速に移動してから低速で近づく。
+        """
+        if axes is None:
+            axes = self._axes
+        time_start = self._clock()
 
         # モーターを停止
-        _stop_motor(motorController)
-        
+        yield from self._stop_motors(axes)
         # モーターの位置を基準点に移動
-        move_to_reference_point(motorController)
-        
-        # モーターの位置をオフセット分移動
-        motorController.move_target(MOTER_INITIAL_OFFSET)
-        logger.info(f"Motor move to offset position {motorController.tmc5240.xactual} ...")
-        while motorController.is_running():
-            _check_stop_event(0.1)
-        logger.info(f"Motor moved offset position. {motorController.tmc5240.xactual}")
+        moving = [axis for axis in axes if not axis.reference_point_event.is_set()]
+        for axis in moving:
+            axis.start_homing()
+        time_limit = self._clock() + MOTER_LIMIT_TIME_OF_DRIVE
+        while moving:
+            wait = 1.0
+            for axis in list(moving):
+                interval = axis.update_homing()
+                if interval is None:
+                    moving.remove(axis)
+                else:
+                    wait = min(wait, interval)
+            if not moving:
+                break
+
+            time_remaining = time_limit - self._clock()
+            if time_remaining <= 0:
+                for axis in moving:
+                    logger.error(f"[{axis.name}] Reference point not reached.")
+                break
+            # 基準点到達、停止要求、または次の確認時刻で起床する
+            yield self._clock() + min(time_remaining, wait)
+            for axis in moving:
+                mc = axis.motorController
+                logger.debug(
+                    "[%s] Motor controller is moving. xtarget:%9s, xactual:%9s, vactual:%9s",
+                    axis.name,
+                    StatusField(mc, "xtarget"),
+                    StatusField(mc, "xactual"),
+                    StatusField(mc, "vactual"),
+                )
+        # モーターを停止
+        yield from self._stop_motors(axes)
+
         # モーターの基準点を現在位置に設定
-        motorController.set_reference_point()
+        for axis in axes:
+            axis.finish_homing(axis not in moving)
+        metrics.HOMING_TIME.observe(self._clock() - time_start)
+        self.publish_status()
+
+    def position_state(self) -> dict:
+        """
+        各軸の保存する位置。基準点が不明、または移動中の軸は含まない。
+        """
+        axes = {}
+        for axis in self._axes:
+            entry = axis.position_state()
+            if entry is not None:
+                axes[axis.name] = entry
+        return axes
+
+    def restore_position_state(self, axes: dict) -> None:
+        """
+        保存した位置を名前の一致する軸に復元する。
+        """
+        for axis in self._axes:
+            entry = axes.get(axis.name)
+            if entry is not None:
+                axis.restore_position_state(entry)
+
+    def release_steps(self, axis: ApneaAxis, is_pressed):
+        """
+        リミットスイッチが押されている場合、モーターを回転させてリミットスイッチを離す手順。
+
+        :param is_pressed: リミットスイッチが押されているかを返す関数
+        """
+        motorController = axis.motorController
+        logger.info(
+            "[%s] Motor position move. %s.", axis.name, StatusField(motorController, "xactual")
+        )
+        motorController.rotate()
+        t = self._clock()
+        time_proc = t + 1.0
+        time_limit = t + MOTER_LIMIT_TIME_OF_DRIVE
+        while is_pressed():
+            yield from self._delay(0.1)
+            t = self._clock()
+            if t > time_proc:
+                time_proc = t
+                logger.info(
+                    "[%s] Motor position move. %s.",
+                    axis.name,
+                    StatusField(motorController, "xactual"),
+                )
+            if t > time_limit:
+                logger.error(f"[{axis.name}] Limit switch not released.")
+                break
+
         # モーターを停止
-        _stop_motor(motorController)
-        
-        # モーターを初期位置に移動
-        motorController.move_target(apneadata.initial_position)
-        logger.info(f"Motor move to initial position {apneadata.initial_position} ...")
-        while motorController.is_running():
-            _check_stop_event(0.1)
-        logger.info(f"Motor moved initial position. {motorController.tmc5240.xactual}")
+        yield from self._delay(MOTER_EXTRAQ_STOP_TIME)
+        motorController.stop()
+        if not (yield from self.wait_motor_steps(motorController, RAMP_STAT_VZERO)):
+            logger.error(f"[{axis.name}] Motor not stopped.")
+        logger.info("[%s] Motor stop. %s.", axis.name, StatusField(motorController, "xactual"))
+
+    def _delay(self, seconds: float):
+        # 起床イベントで戻っても seconds 秒経つまで待機する
+        time_wake = self._clock() + seconds
+        while self._clock() < time_wake:
+            yield time_wake
+
+    def wait_motor_steps(
+        self,
+        motorController: MotorController,
+        condition,
+        timeout: float = MOTER_LIMIT_TIME_OF_DRIVE,
+    ):
+        """
+        モーターの状態が condition になるまで待機する手順。
+
+        ポーリング間隔は MotorController.wait_until と同じく予測残り時間から決める。
+
+        :param condition: RAMP_STAT のビットマスク
+        :param timeout: タイムアウト（秒）。None の場合は無期限
+        :return: 条件が成立した場合は True、タイムアウトの場合は False
+        """
+        time_limit = None
+        if timeout is not None:
+            time_limit = self._clock() + timeout
 
         while True:
-            _check_stop_event(0.001)
-            time_current = time.time()
-
-            if time_sampling <= time_current:
-                rpm = 0
-                try:
-                    rpm = next(iter_rpms)
-                except StopIteration:
-                    iter_rpms = iter(rpms)
-                    rpm = next(iter_rpms)
-
-                if rpm < 0:
-                    if _g_reference_point_event.is_set():
-                        motorController.stop()
-                    else:
-                        motorController.rotate_backwards(abs(rpm))
-                else:
-                    motorController.rotate(rpm)
-                logger.debug(f"{time_current:.3f}, {time_sampling:.3f}, {time_current-time_sampling:.3f}, {rpm:.3f}")
-                time_sampling += sample_interval
-            else:
-                if _g_reference_point_event.is_set():
-                    if motorController.rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE:
+            status = motorController.status(0)
+            if status.ramp_stat & condition == condition:
+                return True
+
+            time_wake = self._clock() + motorController.poll_interval(condition, status)
+            if time_limit is not None:
+                if time_limit <= self._clock():
+                    logger.error(f"Motor wait timeout. condition:{condition:#x}")
+                    return False
+                time_wake = min(time_wake, time_limit)
+            yield time_wake
+
+    def _stop_motors(self, axes: list[ApneaAxis]):
+        # すべてのモーターに停止を指令してから停止を待つ
+        for axis in axes:
+            axis.motorController.stop()
+        for axis in axes:
+            yield from self.wait_motor_steps(axis.motorController, RAMP_STAT_VZERO, None)
+
+            mc = axis.motorController
+            logger.debug(
+                "[%s] Motor controller is stopped. xtarget:%9s, xactual:%9s, vactual:%9s",
+                axis.name,
+                StatusField(mc, "xtarget"),
+                StatusField(mc, "xactual"),
+                StatusField(mc, "vactual"),
+            )
+
+    def _move_targets(self, axes: list[ApneaAxis], targets: list[int]):
+        # すべてのモーターに移動を指令してから到達を待つ
+        for axis, target in zip(axes, targets):
+            axis.motorController.move_target(target)
+            logger.info(
+                "[%s] Motor move to %s from %s ...",
+                axis.name,
+                target,
+                StatusField(axis.motorController, "xactual"),
+            )
+        for axis in axes:
+            yield from self.wait_motor_steps(axis.motorController, RAMP_STAT_POSITION_REACHED)
+            logger.info(
+                "[%s] Motor moved. %s",
+                axis.name,
+                StatusField(axis.motorController, "xactual"),
+            )
+
+    def play(self, scheduler: DeadlineScheduler, samples: int = None) -> None:
+        """
+        各軸の速度スケジュールを呼び出し元のスレッドで再生する（play_steps）。
+
+        :param scheduler: サンプリング期限のスケジューラ
+        :param samples: 各軸で再生するサンプル数（None の場合は停止要求まで繰り返す）
+        """
+        self.drive(self.play_steps(scheduler, samples))
+
+    def play_steps(self, scheduler: DeadlineScheduler, samples: int = None):
+        """
+        各軸の速度スケジュールをセグメントごとにモータードライバーへ送る手順。
+
+        同じ指令が続く間は指令を送らず、最も早い軸の期限まで待機する。
+        期限は開始時刻とサンプル番号から求めるため、起床の遅れは累積しない。
+        長いセグメントの途中でも CONTROL_STATUS_INTERVAL ごとに起床して状態を公開する。
+
+        :param scheduler: 期限の時計と遅れの記録に使用するスケジューラ
+        :param samples: 各軸で再生するサンプル数（None の場合は停止要求まで繰り返す）
+        """
+        logging_interval = 1.0  # ロギング間隔（秒）
+        axes = self._axes
+
+        scheduler.start()
+        time_start = scheduler.time_start
+        time_logging = time_start + logging_interval  # ロギング時間を初期化
+        if self._telemetry is not None:
+            # サンプル番号は再生ごとに0から始まるため、前回の再生の記録を消す
+            self._telemetry.clear()
+        for axis in axes:
+            axis.start(time_start, samples)
+        self.publish_status("playing", scheduler)
+        time_publish = time_start + CONTROL_STATUS_INTERVAL  # 状態の公開時間を初期化
+
+        while True:
+            active = [axis for axis in axes if not axis.finished]
+            if not active:
+                break
+            if self._pause_event.is_set():
+                yield from self._hold(active, scheduler)
+            deadline = min(axis.deadline for axis in active)
+
+            time_current = scheduler.now()
+            if time_current < deadline:
+                if time_publish <= time_current:
+                    # 期限までの空き時間に状態を公開する（指令は遅らせない）
+                    self.publish_status(scheduler=scheduler, max_age=CONTROL_STATUS_INTERVAL)
+                    while time_publish <= time_current:
+                        time_publish += CONTROL_STATUS_INTERVAL
+                # 停止要求、一時停止要求、基準点到達でも起床する
+                yield min(deadline, time_publish)
+                # 基準点到達で起床した場合は逆方向の指令を止める
+                for axis in active:
+                    motorController = axis.motorController
+                    if (
+                        axis.reference_point_event.is_set()
+                        and motorController.rampmode
+                        == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+                    ):
                         motorController.stop()
+                continue
+            lateness = scheduler.record(deadline)
+            metrics.SAMPLE_LATENESS.observe(lateness)
+            if scheduler.interval <= lateness:
+                metrics.OVERRUNS.inc()
+
+            time_current = scheduler.now()
+            for axis in active:
+                if axis.deadline <= deadline:
+                    vmax, rampmode, count = axis.step()
+                    logger.debug(
+                        "[%s] %.3f, %.3f, %s, %s, %s",
+                        axis.name, time_current, lateness, vmax, rampmode, count,
+                    )
+            metrics.PROCESSING_TIME.observe(scheduler.now() - time_current)
 
             if time_logging <= time_current:
-                prosess_time = time.time() - time_current
+                prosess_time = scheduler.now() - time_current
+                for axis in axes:
+                    self.log_status(axis)
                 logger.info(
-                    f" x: {motorController.tmc5240.xactual:8,}"
-                    f" v/max: {motorController.tmc5240.vactual:8,}/{motorController.tmc5240.vmax:8,}"
-                    f" rpm/max: {motorController.tmc5240.vactual_rpm :8,.3f} / {motorController.tmc5240.vmax_rpm:8,.3f}"
-                    f" mode: {motorController.rampmode}"
                     f" elapsed: {time_current - time_start:.3f}"
+                    f" lateness: {scheduler.lateness:.6f}"
+                    f" overruns: {scheduler.overruns}"
                     f" prosessing time: {prosess_time:.6f}"
                 )
-                time_logging += logging_interval
-    except StopEvent:
-        _g_stop_event.clear()
-    finally:
+                while time_logging <= time_current:
+                    time_logging += logging_interval
+
+    def _hold(self, axes: list[ApneaAxis], scheduler: DeadlineScheduler):
+        """
+        一時停止の要求から再開まで、モーターを停止して待機する手順。
+        待機中の停止要求は StopEvent として届く。
+        """
+        for axis in axes:
+            axis.motorController.stop()
+        self.publish_status("paused", scheduler)
+        logger.info("Apnea demo paused.")
+        while self._pause_event.is_set():
+            yield None
+        shift = self.paused_time()
+        for axis in axes:
+            axis.resume(shift)
+        self.publish_status("playing", scheduler)
+        logger.info(f"Apnea demo resumed. paused:{shift:.3f}s")
+
+    def log_status(self, axis: ApneaAxis) -> None:
+        motorController = axis.motorController
+        if not logger.isEnabledFor(INFO):
+            return
+        # キュー経由の出力ではキャッシュしたステータスを使うため、制御スレッドで読み出しておく
+        motorController.status()
+        logger.info(
+            "[%s] x: %s v/max: %s/%s rpm/max: %s / %s mode: %s",
+            axis.name,
+            StatusField(motorController, "xactual", "8,"),
+            StatusField(motorController, "vactual", "8,"),
+            StatusField(motorController, "vmax", "8,"),
+            StatusField(motorController, "vactual_rpm", "8,.3f"),
+            StatusField(motorController, "vmax_rpm", "8,.3f"),
+            motorController.rampmode,
+        )
+        tracker = axis.tracker
+        if tracker is not None:
+            logger.info(
+                f"[{axis.name}]"
+                f" tracking error: {tracker.error:6,}"
+                f" max: {tracker.max_error:6,}"
+                f" rms: {tracker.rms_error:8,.1f}"
+                f" correction: {tracker.correction:8,.0f}"
+            )
+
+    def _run(self):
+        self._stop_event.clear()
         try:
+            self.drive(self.demo_steps())
+        finally:
+            try:
+                self.dump_telemetry()
+            finally:
+                self.publish_status("idle")
+
+    def demo_steps(self):
+        """
+        ホーミング、オフセット移動、初期位置への移動の後、停止要求まで再生する手順。
+        停止要求の後は基準点に戻してモータードライバーを停止する。
+
+        制御スレッド（drive）と asyncio のランタイムで共通に使用する。終了後の
+        idle の状態は、呼び出し側がテレメトリーを書き出した後に公開する。
+        """
+        logger.info("Apnea demo start.")
+        axes = self._axes
+        self._clear_emergency_stop()
+        self.publish_status("starting")
+        try:
+            self.load_profile()
+            for axis in axes:
+                axis.compile(self._library)
+
+            # モータードライバーを印加
+            for axis in axes:
+                if not axis.motorController.is_poweron():
+                    axis.motorController.poweron()
+
             # モーターの位置を基準点に移動
-            move_to_reference_point(motorController)
+            yield from self.homing_steps()
+
+            # モーターの位置をオフセット分移動
+            yield from self._move_targets(axes, [MOTER_INITIAL_OFFSET] * len(axes))
+            # モーターの基準点を現在位置に設定
+            for axis in axes:
+                axis.set_reference_point()
+            # モーターを停止
+            yield from self._stop_motors(axes)
+
+            # モーターを初期位置に移動
+            yield from self._move_targets(
+                axes, [axis.apneadata.initial_position for axis in axes]
+            )
+
+            # 期限は各軸のサンプリング間隔で求めるため、スケジューラの間隔は
+            # 遅れの判定にのみ使用する
+            scheduler = DeadlineScheduler(
+                min(axis.interval for axis in axes), clock=self._clock
+            )
+            yield from self.play_steps(scheduler)
         except StopEvent:
-            _g_stop_event.clear()
-        # モータードライバーを停止
-        if motorController.is_poweron():
-            motorController.poweroff()
-        logger.info(f"Apnea demo stop. power is {motorController.is_poweron()}.")
\ No newline at end of file
+            # 停止要求
+            pass
+        finally:
+            self.clear_pause()
+            self.publish_status("stopping")
+            # 非常停止で減速を開始した後、通常の手順で基準点に戻す
+            self._clear_emergency_stop()
+            try:
+                # モーターの位置を基準点に移動
+                yield from self.homing_steps()
+            except StopEvent:
+                pass
+            # モータードライバーを停止
+            for axis in axes:
+                if axis.motorController.is_poweron():
+                    axis.motorController.poweroff()
+            logger.info("Apnea demo stop.")
@@ -0,0 +1,365 @@
+"""
+プロファイルライブラリ。
+
+PROFILE_LIBRARY_DIR の CSV ファイルを名前（ファイル名）で選択して再生する。
+読み込んだプロファイルと軸ごとに変換した速度スケジュールは、合計サイズが
+PROFILE_CACHE_SIZE 以下になるように最近使ったものから保持する（LRU）。
+
+ディレクトリは inotify（使用できない場合は PROFILE_POLL_INTERVAL ごとの stat）で
+監視し、書き換えられたファイルのキャッシュを破棄する。次の再生開始時に読み込み直す。
+"""
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+from logging import getLogger
+import os
+import select
+import struct
+from threading import Event, RLock, Thread
+
+from constant import *
+
+import metrics
+from apnea.data import ApneaData
+from motor import SegmentSchedule
+
+# create logger
+logger = getLogger(__name__)
+
+PROFILE_SUFFIX = ".csv"
+
+# inotify のイベント（sys/inotify.h）
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_INOTIFY_MASK = (
+    _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE | _IN_DELETE_SELF
+)
+# struct inotify_event の固定部（wd, mask, cookie, len）
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _schedule_size(schedule: SegmentSchedule) -> int:
+    return sum(
+        column.nbytes
+        for column in (schedule.vmax, schedule.rampmode, schedule.start, schedule.count)
+    )
+
+
+class _ProfileEntry:
+    """
+    キャッシュしたプロファイルと変換済みの速度スケジュール。
+    """
+
+    def __init__(self, apneadata: ApneaData):
+        self.apneadata = apneadata
+        # {キー: SegmentSchedule}
+        self.schedules = {}
+        self.size = apneadata.nbytes
+
+
+class ProfileLibrary:
+    """
+    ディレクトリのプロファイルを選択して読み込み、LRU キャッシュに保持する。
+    任意のスレッドから呼び出せる。
+
+    :param directory: プロファイル（CSV ファイル）のディレクトリ
+    :param cache_size: キャッシュの上限（バイト）。選択中のプロファイルは上限を超えても保持する
+    :param selected: 最初に選択するプロファイルの名前（空の場合は先頭）
+    """
+
+    def __init__(
+        self,
+        directory: str = PROFILE_LIBRARY_DIR,
+        cache_size: int = PROFILE_CACHE_SIZE * 1024 * 1024,
+        selected: str = PROFILE_DEFAULT,
+    ):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._lock = RLock()
+        # {名前: _ProfileEntry}（最後に使ったものが末尾）
+        self._entries = OrderedDict()
+        self._size = 0
+        self._selected = None
+        self._watcher = None
+
+        names = self.names()
+        if selected and selected not in names:
+            logger.warning(f"profile not found {selected}")
+            selected = ""
+        if not selected and names:
+            selected = names[0]
+        self._selected = selected or None
+
+    @property
+    def selected(self) -> str:
+        return self._selected
+
+    @property
+    def size(self) -> int:
+        """
+        キャッシュしているプロファイルとスケジュールの合計サイズ（バイト）
+        """
+        return self._size
+
+    def names(self) -> list[str]:
+        """
+        ライブラリのプロファイルの名前（ファイル名）の一覧
+        """
+        try:
+            with os.scandir(self.directory) as entries:
+                return sorted(
+                    entry.name
+                    for entry in entries
+                    if entry.name.endswith(PROFILE_SUFFIX) and entry.is_file()
+                )
+        except OSError as e:
+            logger.error(f"profile library read error {self.directory}: {e}")
+            return []
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def select(self, name: str) -> str:
+        """
+        再生するプロファイルを選択する。
+
+        :return: 選択したプロファイルの名前
+        """
+        if name not in self.names():
+            raise KeyError(name)
+        self._selected = name
+        logger.info(f"profile selected: {name}")
+        return name
+
+    def select_next(self) -> str:
+        """
+        名前の順で次のプロファイルを選択する（最後の次は先頭）。
+
+        :return: 選択したプロファイルの名前（ライブラリが空の場合は None）
+        """
+        names = self.names()
+        if not names:
+            return None
+        if self._selected in names:
+            name = names[(names.index(self._selected) + 1) % len(names)]
+        else:
+            name = names[0]
+        return self.select(name)
+
+    def load(self, name: str = None) -> ApneaData:
+        """
+        プロファイルを返す。キャッシュにない場合は読み込む。
+
+        :param name: プロファイルの名前（None の場合は選択中のプロファイル）
+        """
+        return self._entry(name).apneadata
+
+    def schedule(self, apneadata: ApneaData, key, compile) -> SegmentSchedule:
+        """
+        プロファイルの速度スケジュールを返す。キャッシュにない場合は compile() で変換する。
+
+        :param apneadata: load で返したプロファイル
+        :param key: 変換の条件を表すキー（軸ごとに異なる）
+        :param compile: 速度スケジュールを変換する関数
+        """
+        with self._lock:
+            entry = self._entries.get(os.path.basename(apneadata.csv_file))
+            if entry is None or entry.apneadata is not apneadata:
+                # キャッシュから外れたプロファイル（ファイルが書き換えられたなど）
+                return compile()
+            schedule = entry.schedules.get(key)
+            if schedule is not None:
+                metrics.PROFILE_CACHE_LOOKUPS.labels("hit").inc()
+                return schedule
+            metrics.PROFILE_CACHE_LOOKUPS.labels("miss").inc()
+            schedule = compile()
+            entry.schedules[key] = schedule
+            size = _schedule_size(schedule)
+            entry.size += size
+            self._size += size
+            self._evict()
+            return schedule
+
+    def invalidate(self, name: str) -> None:
+        """
+        プロファイルのキャッシュを破棄する。再生中の軸は保持しているデータで再生を続ける。
+        """
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._size -= entry.size
+                logger.info(f"profile cache invalidated: {name}")
+
+    def _entry(self, name: str = None) -> _ProfileEntry:
+        if name is None:
+            name = self._selected
+            if name is None:
+                raise KeyError("no profile in library")
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                metrics.PROFILE_CACHE_LOOKUPS.labels("hit").inc()
+                return entry
+            metrics.PROFILE_CACHE_LOOKUPS.labels("miss").inc()
+            entry = _ProfileEntry(ApneaData(self.path(name)))
+            self._entries[name] = entry
+            self._size += entry.size
+            self._evict()
+            return entry
+
+    def _evict(self) -> None:
+        # ロック取得中に呼び出すこと
+        for name in list(self._entries):
+            if self._size <= self.cache_size:
+                break
+            if name == self._selected:
+                continue
+            entry = self._entries.pop(name)
+            self._size -= entry.size
+            logger.debug(f"profile cache evicted: {name} size:{entry.size}")
+
+    ##############################################
+    # 監視
+
+    def start_watch(self, poll_interval: float = PROFILE_POLL_INTERVAL) -> "ProfileLibrary":
+        """
+        ディレクトリの監視を開始する。
+        """
+        if self._watcher is None:
+            self._watcher = _Watcher(self, poll_interval).start()
+        return self
+
+    def stop_watch(self) -> None:
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _changed(self, name: str) -> None:
+        if not name.endswith(PROFILE_SUFFIX):
+            return
+        logger.info(f"profile changed: {name}")
+        self.invalidate(name)
+
+
+class _Inotify:
+    """
+    libc の inotify を ctypes で呼び出す。
+    """
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), _INOTIFY_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, os.strerror(errno), directory)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read(self) -> list[tuple[int, str]]:
+        """
+        届いているイベントを読み出す。
+
+        :return: [(マスク, ファイル名), ...]
+        """
+        events = []
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class _Watcher:
+    """
+    ProfileLibrary のディレクトリを監視するスレッド。
+    inotify を使用できない場合は stat の比較で変更を検出する。
+    """
+
+    def __init__(self, library: ProfileLibrary, poll_interval: float):
+        self._library = library
+        self._poll_interval = poll_interval
+        self._stop_event = Event()
+        self._thread = None
+        # 停止時に select を起床させるパイプ
+        self._wakeup = None
+
+    def start(self) -> "_Watcher":
+        try:
+            inotify = _Inotify(self._library.directory)
+        except (OSError, AttributeError) as e:
+            # AttributeError: libc に inotify がない
+            logger.warning(f"inotify unavailable, polling profile library: {e}")
+            target, args = self._poll, ()
+        else:
+            self._wakeup = os.pipe()
+            target, args = self._watch, (inotify,)
+        self._thread = Thread(target=target, args=args, name="ProfileWatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"\0")
+        self._thread.join()
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def _watch(self, inotify: _Inotify):
+        try:
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([inotify, self._wakeup[0]], [], [])
+                if inotify not in readable:
+                    continue
+                for mask, name in inotify.read():
+                    if mask & _IN_DELETE_SELF:
+                        logger.warning(
+                            f"profile library removed {self._library.directory}"
+                        )
+                    elif name:
+                        self._library._changed(name)
+        finally:
+            inotify.close()
+
+    def _scan(self) -> dict:
+        stats = {}
+        for name in self._library.names():
+            try:
+                stat = os.stat(self._library.path(name))
+            except OSError:
+                continue
+            stats[name] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def _poll(self):
+        stats = self._scan()
+        while not self._stop_event.wait(self._poll_interval):
+            current = self._scan()
+            for name in stats.keys() | current.keys():
+                if stats.get(name) != current.get(name):
+                    self._library._changed(name)
+            stats = current
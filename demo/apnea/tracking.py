@@ -0,0 +1,144 @@
+from cgstep import TMC5240
+from logging import getLogger
+import math
+
+from constant import *
+
+from motor import MotorController
+
+# create logger
+logger = getLogger(__name__)
+
+# 1フルステップあたりのマイクロステップ数（MRES=256）
+MICROSTEPS_PER_STEP = 256
+
+
+class PositionTracker:
+    """
+    プロファイルの位置データと XACTUAL を比較して指令速度を補正する。
+
+    N サンプルごとに XACTUAL を読み出し、期待位置との誤差を次の N サンプルで
+    解消する補正速度を求めて各サンプルの VMAX に加える。セグメント単位で再生する
+    場合は、セグメントの長さを N 以下にすること。期待位置は最初の
+    サンプルで XACTUAL に合わせた基準から ``基準 + 位置データ × 倍率`` で求めるため、
+    プロファイルが先頭に戻っても基準はずれない。
+
+    速度スケジュールは ``移動量 × マイクロステップ倍率`` をフルステップとして
+    VMAX に変換するため、XACTUAL 上の倍率は ``マイクロステップ倍率 × 256``
+    （MRES=256 の1ステップあたりのマイクロステップ数）になる。
+
+    :param motorController: モーターコントローラー
+    :param usteps_multiplier: マイクロステップ倍率
+    :param sample_interval: サンプリング間隔（秒）
+    :param interval: XACTUAL を読み出すサンプル間隔
+    :param gain: 誤差に対する補正の比率（1.0 で次の N サンプルで誤差を解消する）
+    :param max_correction_rpm: 補正速度の上限（RPM）
+    """
+
+    def __init__(
+        self,
+        motorController: MotorController,
+        usteps_multiplier: float,
+        sample_interval: float,
+        interval: int = TRACKING_INTERVAL,
+        gain: float = TRACKING_GAIN,
+        max_correction_rpm: float = TRACKING_MAX_CORRECTION,
+    ):
+        self._motorController = motorController
+        # 位置データ1あたりの XACTUAL
+        self._scale = usteps_multiplier * MICROSTEPS_PER_STEP
+        self._interval = max(1, interval)
+        self._gain = gain
+
+        tmc = motorController.tmc5240
+        # usteps/s から VMAX への変換係数
+        self._v_scale = 2**24 / tmc.fclk / (self._interval * sample_interval)
+        self._max_correction = tmc.rpm2v(max_correction_rpm)
+
+        self._origin = None
+        self._count = 0
+        self._correction = 0.0
+
+        # 追従誤差 (usteps)
+        self._error = 0
+        self._max_error = 0
+        self._sum_squared_error = 0
+        self._measurements = 0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def max_error(self):
+        return self._max_error
+
+    @property
+    def rms_error(self):
+        if self._measurements == 0:
+            return 0.0
+        return math.sqrt(self._sum_squared_error / self._measurements)
+
+    @property
+    def correction(self):
+        return self._correction
+
+    def reset(self):
+        self._origin = None
+        self._count = 0
+        self._correction = 0.0
+        self._error = 0
+        self._max_error = 0
+        self._sum_squared_error = 0
+        self._measurements = 0
+
+    def correct(
+        self, vmax: int, rampmode: int, position: int, count: int = 1
+    ) -> tuple[int, int]:
+        """
+        サンプル（またはセグメント）の指令速度を補正する。
+
+        :param vmax: スケジュールの VMAX
+        :param rampmode: スケジュールの RAMPMODE
+        :param position: 開始時点のプロファイルの位置データ
+        :param count: 同じ指令が続くサンプル数
+        :return: 補正後の (VMAX, RAMPMODE)
+        """
+        if self._count == 0:
+            self._measure(position)
+        self._count += count
+        if self._interval <= self._count:
+            self._count = 0
+
+        if self._correction == 0:
+            return vmax, rampmode
+
+        if rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE:
+            v = self._correction - vmax
+        else:
+            v = self._correction + vmax
+        if v < 0:
+            return round(-v), TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+        return round(v), TMC5240.RAMPMODE_VELOCITY_POSITIVE
+
+    def _measure(self, position: int):
+        xactual = self._motorController.status(0).xactual
+        expected = position * self._scale
+        if self._origin is None:
+            self._origin = xactual - expected
+            return
+
+        error = round(self._origin + expected - xactual)
+        self._error = error
+        self._max_error = max(self._max_error, abs(error))
+        self._sum_squared_error += error * error
+        self._measurements += 1
+
+        correction = error * self._gain * self._v_scale
+        self._correction = max(
+            -self._max_correction, min(correction, self._max_correction)
+        )
@@ -0,0 +1,205 @@
+"""
+仮想時計によるプロファイルの検証。
+
+SimulatedTMC5240 と DeadlineScheduler に同じ VirtualClock を渡して ApneaPlayer の
+再生ループを実行する。期限までのスリープは時計を進めるだけなので、プロファイル全体を
+実時間を待たずに再生し、実時間と同じ指令の列をテレメトリーに記録して
+apnea.analyze で期待位置と比較する。
+
+    $ cd demo && python -m apnea.validate data/*.csv --max-error 400 --json report.json
+
+基準点への移動（ホーミング）は行わず、基準点を設定してから初期位置を XACTUAL に設定する。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from constant import *
+
+from apnea import analyze
+from apnea.data import ApneaData
+from apnea.demo import ApneaPlayer
+from motor import MotorController
+from scheduler import DeadlineScheduler, VirtualClock
+from simulator import SimulatedTMC5240
+from telemetry import RECORD_FIELDS, TelemetryRecorder
+
+
+def simulate(
+    apneadata: ApneaData, axes: int = 1, decimation: int = 1, samples: int = None
+) -> tuple[np.ndarray, dict]:
+    """
+    プロファイルを仮想時計で再生し、テレメトリーを返す。
+
+    :param apneadata: 再生するプロファイル
+    :param axes: 同じプロファイルを再生する軸の数
+    :param decimation: テレメトリーを記録する周期の間隔
+    :param samples: 各軸で再生するサンプル数（None の場合はプロファイルの長さ）
+    :return: (RECORD_FIELDS の構造化配列, 再生の統計)
+    """
+    if samples is None:
+        samples = len(apneadata.positions)
+    clock = VirtualClock()
+    player = ApneaPlayer(clock=clock.now, sleep=clock.sleep)
+    drivers = []
+    for number in range(axes):
+        driver = SimulatedTMC5240(
+            0, number, steps_per_rev=STEPS_PER_REV, clock=clock.now
+        )
+        motorController = MotorController(
+            STEPS_PER_REV, driver=driver, clock=clock.now
+        )
+        motorController.poweron()
+        motorController.set_position(apneadata.initial_position)
+        axis = player.add_axis(motorController, apneadata)
+        axis.compile()
+        drivers.append(driver)
+
+    recorder = TelemetryRecorder(
+        capacity=axes * (samples // max(1, decimation) + 1),
+        decimation=decimation,
+        path="",
+        clock=clock.now,
+    )
+    player.set_telemetry(recorder)
+
+    scheduler = DeadlineScheduler(
+        apneadata.sampling_interval, clock=clock.now, sleep=clock.sleep
+    )
+    wall_start = time.perf_counter()
+    player.play(scheduler, samples)
+    wall_seconds = time.perf_counter() - wall_start
+
+    trace = np.empty(len(recorder), dtype=np.dtype(list(RECORD_FIELDS)))
+    for (name, _), column in zip(RECORD_FIELDS, recorder.snapshot()):
+        trace[name] = column
+    virtual_seconds = clock.now() - scheduler.time_start
+    stats = {
+        "samples": samples,
+        "virtual_seconds": virtual_seconds,
+        "wall_seconds": wall_seconds,
+        "speedup": virtual_seconds / wall_seconds if 0 < wall_seconds else None,
+        "register_transfers": sum(driver.transfers for driver in drivers),
+        "overruns": scheduler.overruns,
+    }
+    return trace, stats
+
+
+def validate(
+    path: str,
+    axes: int = 1,
+    decimation: int = 1,
+    max_error: float = None,
+    telemetry: str = None,
+) -> dict:
+    """
+    1つのプロファイルを検証する。
+
+    :param max_error: 許容する位置誤差の最大値（マイクロステップ、None で判定しない）
+    :param telemetry: 記録したテレメトリーの書き出し先（RECORD_FIELDS の .npy）
+    :return: 検証結果（ok が False の場合は errors に理由）
+    """
+    apneadata = ApneaData(path)
+    trace, stats = simulate(apneadata, axes, decimation)
+    if telemetry is not None:
+        np.save(telemetry, trace)
+
+    result = {"path": path, "ok": True, "errors": [], **stats, "axes": {}}
+    for axis in range(axes):
+        report = analyze.analyze_axis(trace[trace["axis"] == axis], apneadata)
+        xactual = trace["xactual"][trace["axis"] == axis]
+        report["position_range"] = [int(xactual.min()), int(xactual.max())]
+        result["axes"][f"axis{axis}"] = report
+
+        error = report["position_error"]["max"]
+        if max_error is not None and max_error < error:
+            result["errors"].append(
+                f"axis{axis}: position error {error:,.1f} exceeds {max_error:,.1f}"
+            )
+        if xactual.min() < -MOTER_INITIAL_OFFSET:
+            # 基準点のリミットスイッチより手前に戻る
+            result["errors"].append(
+                f"axis{axis}: position {int(xactual.min()):,} passes reference point"
+            )
+    result["ok"] = not result["errors"]
+    return result
+
+
+def format_result(result: dict) -> str:
+    status = "ok" if result["ok"] else "FAILED"
+    lines = [
+        f"{result['path']}: {status}"
+        f" virtual {result['virtual_seconds']:,.1f}s"
+        f" wall {result['wall_seconds']:,.2f}s"
+        f" x{result['speedup'] or 0:,.0f}"
+        f" transfers {result['register_transfers']:,}"
+    ]
+    for name, report in result["axes"].items():
+        error = report["position_error"]
+        low, high = report["position_range"]
+        lines.append(
+            f"  [{name}] position error: rms {error['rms']:9,.1f} max {error['max']:9,.1f}"
+            f" range {low:,}..{high:,}"
+            f" drift {report['drift']['slope_per_cycle']:,.2f} usteps/cycle"
+        )
+    for error in result["errors"]:
+        lines.append(f"  error: {error}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("profiles", nargs="+", help="検証するプロファイル")
+    parser.add_argument("--axes", type=int, default=1, help="再生する軸の数")
+    parser.add_argument(
+        "--decimation", type=int, default=1, help="テレメトリーを記録する周期の間隔"
+    )
+    parser.add_argument(
+        "--max-error",
+        type=float,
+        help="許容する位置誤差の最大値（マイクロステップ）",
+    )
+    parser.add_argument(
+        "--telemetry",
+        help="テレメトリーの書き出し先（{name} をプロファイル名に置き換える .npy）",
+    )
+    parser.add_argument("--json", help="結果を JSON で出力する先（- で標準出力）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level="WARNING")
+
+    results = []
+    for path in args.profiles:
+        telemetry = None
+        if args.telemetry is not None:
+            name = os.path.splitext(os.path.basename(path))[0]
+            telemetry = args.telemetry.format(name=name)
+        try:
+            result = validate(
+                path, args.axes, args.decimation, args.max_error, telemetry
+            )
+        except (OSError, ValueError, IndexError) as e:
+            result = {"path": path, "ok": False, "errors": [repr(e)]}
+        results.append(result)
+        if args.json != "-":
+            if "axes" in result:
+                print(format_result(result))
+            else:
+                print(f"{path}: FAILED {result['errors'][0]}")
+
+    if args.json == "-":
+        print(json.dumps(results, indent=2))
+    elif args.json is not None:
+        with open(args.json, mode="w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+再生制御パスのベンチマーク。
+
+シミュレーター（SimulatedTMC5240）を接続した MotorController で ApneaPlayer の
+再生ループを実行し、結果を JSON で出力する。
+
+    $ python demo/benchmark.py --duration 10 --sizes 1000,100000,3000000 -o bench.json
+"""
+import argparse
+from array import array
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import tempfile
+from threading import Thread
+import time
+
+from cgstep import TMC5240
+import numpy as np
+
+import constant
+from apnea.data import ApneaData
+from apnea.demo import ApneaAxis, ApneaPlayer
+from motor import MotorController
+from scheduler import DeadlineScheduler
+from simulator import SimulatedTMC5240
+
+
+class RecordingScheduler(DeadlineScheduler):
+    """
+    サンプルごとの遅れを記録する DeadlineScheduler。
+    """
+
+    def __init__(self, interval: float, samples: int):
+        super().__init__(interval)
+        self.latenesses = array("d", bytes(8 * samples))
+        self.count = 0
+
+    def record(self, deadline: float) -> float:
+        lateness = super().record(deadline)
+        if self.count < len(self.latenesses):
+            self.latenesses[self.count] = lateness
+            self.count += 1
+        return lateness
+
+
+def write_profile(path: str, rows: int, sampling_interval_ms: int = 10) -> None:
+    """
+    呼吸波形を模した合成プロファイル（CSV）を書き出す。
+
+    4秒周期の呼吸と、20秒ごとに10秒間の無呼吸（移動量0）を繰り返す。
+    """
+    t = np.arange(rows) * (sampling_interval_ms / 1000)
+    positions = np.round(200 * (1 - np.cos(2 * np.pi * t / 4))).astype(np.int64)
+    positions[(t % 30) >= 20] = 0
+    diffs = np.diff(positions, append=positions[:1])
+
+    with open(path, mode="w", encoding="utf-8") as file:
+        file.write("name,benchmark\n")
+        file.write(f"sampling_interval,{sampling_interval_ms}\n")
+        file.write("usteps_multiplier,4\n")
+        file.write("initial_position,0\n")
+        for start in range(0, rows, 65536):
+            lines = [
+                f"{pos},{diff}\n"
+                for pos, diff in zip(
+                    positions[start : start + 65536].tolist(),
+                    diffs[start : start + 65536].tolist(),
+                )
+            ]
+            file.writelines(lines)
+
+
+def _percentile(values, q):
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, q))
+
+
+def bench_load(path: str, cache_dir: str) -> dict:
+    """
+    ApneaData の読み込み時間（CSV解析とキャッシュからの読み込み）を計測する。
+    """
+    result = {}
+
+    t = time.perf_counter()
+    apneadata = ApneaData(path, cache_dir="")
+    result["csv_load_seconds"] = time.perf_counter() - t
+    result["rows"] = len(apneadata.diffs)
+
+    # キャッシュを作成してから計測する
+    ApneaData(path, cache_dir=cache_dir).close()
+    t = time.perf_counter()
+    cached = ApneaData(path, cache_dir=cache_dir)
+    result["cache_load_seconds"] = time.perf_counter() - t
+    cached.close()
+
+    return result, apneadata
+
+
+def calculate_motor_rpm(
+    sample_interval_secondes: float,
+    microstep_ratio: float,
+    movements: list[float, float],
+    steps_per_rev: float = 200,
+):
+    """
+    各時間点でのモーターの回転速度をRPMで計算する。
+
+    速度スケジュールを NumPy で変換する前の1行ずつの計算（参照実装）。
+    compile_motor_schedule の結果の確認と変換時間の比較に使用する。
+
+    :param sample_interval_secondes: サンプル間隔（秒）
+    :param microstep_ratio: マイクロステップ倍率
+    :param movements: 移動量のリスト（各サンプルでの(位置, ±移動量)）
+    :param steps_per_rev: モーターの一回転あたりのステップ数（フルステップ）
+    :return: 各サンプルでのモーターの回転速度（RPM）のリスト
+    """
+    rpms = []  # RPMを格納するリスト
+    for movement in movements:
+        val = 0
+        if 1 < len(movement):
+            val = movement[1]
+        # ステップ/サンプル間隔（秒）
+        speed_steps_per_sample_interval = val * microstep_ratio
+        # ステップ/秒
+        speed_steps_per_second = (
+            speed_steps_per_sample_interval / sample_interval_secondes
+        )
+
+        rpm = (speed_steps_per_second * 60) / steps_per_rev
+        rpms.append(round(rpm, 2))
+    return rpms
+
+
+def reference_schedule(driver: TMC5240, apneadata: ApneaData) -> list[tuple[int, int]]:
+    """
+    calculate_motor_rpm の RPM を TMC5240.rpm2v で変換した速度スケジュール。
+
+    :return: 各サンプルの (VMAX, RAMPMODE) のリスト
+    """
+    rpms = calculate_motor_rpm(
+        apneadata.sampling_interval,
+        apneadata.usteps_multiplier,
+        apneadata.movement_data_list,
+        steps_per_rev=driver.steps_per_rev,
+    )
+    return [
+        (
+            driver.rpm2v(abs(rpm)),
+            TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+            if rpm < 0
+            else TMC5240.RAMPMODE_VELOCITY_POSITIVE,
+        )
+        for rpm in rpms
+    ]
+
+
+def bench_compile(motorController: MotorController, apneadata: ApneaData) -> dict:
+    """
+    速度スケジュールの変換時間を計測し、参照実装（calculate_motor_rpm）と比較する。
+    """
+    diffs = apneadata.diffs
+    t = time.perf_counter()
+    schedule = motorController.compile_schedule(
+        apneadata.sampling_interval, apneadata.usteps_multiplier, diffs
+    )
+    seconds = time.perf_counter() - t
+
+    t = time.perf_counter()
+    reference = reference_schedule(motorController.tmc5240, apneadata)
+    reference_seconds = time.perf_counter() - t
+    return {
+        "compile_seconds": seconds,
+        "compile_rows_per_second": len(schedule) / seconds if 0 < seconds else None,
+        "reference_compile_seconds": reference_seconds,
+        "compile_matches_reference": list(schedule) == reference,
+    }
+
+
+def bench_playback(apneadata: ApneaData, duration: float) -> dict:
+    """
+    シミュレーターに対して再生ループを duration 秒実行し、遅れ・起床回数・
+    CPU時間・レジスタアクセス数を計測する。
+    """
+    driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV)
+    motorController = MotorController(
+        steps_per_rev=constant.STEPS_PER_REV, driver=driver
+    )
+    motorController.poweron()
+    axis = ApneaAxis(motorController, apneadata)
+    axis.compile()
+    player = ApneaPlayer([axis])
+
+    samples = max(1, int(duration / apneadata.sampling_interval))
+    scheduler = RecordingScheduler(apneadata.sampling_interval, samples)
+    result = {}
+
+    def run():
+        driver.reset_counters()
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        player.play(scheduler, samples)
+        result["wall_seconds"] = time.perf_counter() - wall_start
+        result["cpu_seconds"] = time.thread_time() - cpu_start
+
+    thread = Thread(target=run)
+    thread.start()
+    thread.join()
+
+    latenesses = np.frombuffer(scheduler.latenesses, dtype=np.float64)[
+        : scheduler.count
+    ]
+    wall_seconds = result["wall_seconds"]
+    return {
+        "samples": samples,
+        "segments": len(axis.schedule) if axis.schedule is not None else None,
+        "wakeups": scheduler.count,
+        "sampling_interval": apneadata.sampling_interval,
+        "wall_seconds": wall_seconds,
+        "lateness_seconds": {
+            "p50": _percentile(latenesses, 50),
+            "p90": _percentile(latenesses, 90),
+            "p99": _percentile(latenesses, 99),
+            "p999": _percentile(latenesses, 99.9),
+            "max": float(latenesses.max()) if len(latenesses) else None,
+            "mean": float(latenesses.mean()) if len(latenesses) else None,
+        },
+        "overruns": scheduler.overruns,
+        "cpu_seconds_per_sample": result["cpu_seconds"] / samples,
+        "register_transfers": driver.transfers,
+        "register_reads": sum(driver.reads.values()),
+        "register_writes": sum(driver.writes.values()),
+        "register_transfers_per_second": driver.transfers / wall_seconds,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="再生ループの計測時間（秒）",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000,100000,3000000",
+        help="読み込み・変換時間を計測するプロファイルの行数（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=10,
+        help="合成プロファイルのサンプリング間隔（ミリ秒）",
+    )
+    parser.add_argument(
+        "--profile",
+        help="再生ループに使用するプロファイル（省略時は合成プロファイル）",
+    )
+    parser.add_argument("-o", "--output", help="結果の出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level="WARNING")
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "profiles": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = os.path.join(tmp_dir, "cache")
+        controller = MotorController(
+            steps_per_rev=constant.STEPS_PER_REV,
+            driver=SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV),
+        )
+
+        for size in sizes:
+            path = os.path.join(tmp_dir, f"profile_{size}.csv")
+            write_profile(path, size, args.interval)
+            result, apneadata = bench_load(path, cache_dir)
+            result.update(bench_compile(controller, apneadata))
+            report["profiles"].append(result)
+
+        if args.profile is not None:
+            apneadata = ApneaData(args.profile, cache_dir="")
+        else:
+            rows = max(1, math.ceil(args.duration * 1000 / args.interval))
+            path = os.path.join(tmp_dir, "playback.csv")
+            write_profile(path, rows, args.interval)
+            apneadata = ApneaData(path, cache_dir="")
+        report["playback"] = bench_playback(apneadata, args.duration)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, mode="w", encoding="utf-8") as file:
+            file.write(text)
+            file.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
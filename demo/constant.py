@@ -4,6 +4,8 @@
 STEPS_PER_REV = 45                  # ステップ数
 MOTOR_RATED_VOLTAGE = 4.4           # モーターの定格電圧
 MOTOR_WINDING_RESISTANCE = 15       # モーターの巻線抵抗
+MOTOR_DRIVER = "tmc5240"            # モータードライバー（tmc5240 / simulator）
+MOTOR_AXES = ""                     # 軸の設定（例: "0.0:22:data.csv;0.1:24:data2.csv"、空で1軸）
 MOTER_AMAX = 2000                   # 最大加速度 (usteps/s²)
 MOTER_DMAX = 2000                   # 最大減速度 (usteps/s²)
 
@@ -22,17 +24,59 @@ MOTER_LIMIT_TIME_OF_DRIVE = 10.0    # モーターの駆動時間の上限（秒
 MOTER_DEFAULT_SPEED = 300.0         # モーターの通常速度（RPM）
 MOTER_EXTRAQ_STOP_TIME = 1.0        # モーター停止時の余分な時間（秒）
 MOTER_INITIAL_OFFSET = 100          # モーターの初期位置オフセット
+MOTER_STATUS_MAX_AGE = 0.02         # ステータスキャッシュの有効期間（秒）
+HOMING_APPROACH_MARGIN = 1440       # 高速移動で止める基準点の手前の距離（usteps）
+HOMING_APPROACH_SPEED = 30.0        # 基準点への最終接近の速度（RPM）
+HOMING_APPROACH_TIME = 2.0          # 最終接近で基準点に届かない場合に通常速度へ切り替えるまでの時間（秒）
+STATE_FILE = ""                     # 停止時のモーター位置の保存先（空で保存しない）
+TRACKING_INTERVAL = 0               # 位置追従で XACTUAL を確認するサンプル間隔（0で無効）
+TRACKING_GAIN = 0.5                 # 位置追従の補正ゲイン
+TRACKING_MAX_CORRECTION = 30.0      # 位置追従の補正速度の上限（RPM）
 APNEA_DATA_CSV_PATH = "data.csv"    # 睡眠時無呼吸データのCSVファイルパス
+APNEA_DATA_CACHE_DIR = ".cache"     # 睡眠時無呼吸データのキャッシュ保存先（空でキャッシュしない）
+APNEA_DATA_STREAM = False           # 睡眠時無呼吸データをチャンク単位で読み込む
+APNEA_DATA_CHUNK_SIZE = 65536       # チャンク単位で読み込む行数
+PROFILE_LIBRARY_DIR = ""            # プロファイルライブラリのディレクトリ（空で使用しない。使用時は全軸で選択したプロファイルを再生）
+PROFILE_DEFAULT = ""                # 起動時に選択するプロファイルのファイル名（空で名前順の先頭）
+PROFILE_CACHE_SIZE = 256            # 読み込んだプロファイルと速度スケジュールのキャッシュの上限（MiB）
+PROFILE_POLL_INTERVAL = 2.0         # inotify を使用できない場合にライブラリの変更を確認する間隔（秒）
+PROFILE_SELECT_PRESS_TIME = 1.5     # スタートスイッチをこの時間（秒）以上押すと次のプロファイルを選択
 
 #
 # ピン設定
 #
 START_SW_PIN = 23                   # スタートスイッチのピン番号
 STOP_SW_PIN = 27                    # ストップスイッチのピン番号
+STOP_SW_EMERGENCY = True            # ストップスイッチの最初のエッジでモーターを直ちに減速する
 LIMIT_SW_PIN = 22                   # リミットスイッチのピン番号
+LIMIT_SW_MODE = "gpio"              # リミットスイッチの接続（gpio: GPIOのピン / refl: TMC5240のREFL入力で停止）
+REFL_ACTIVE_LOW = True              # REFL が Low のときにリミットスイッチが有効
+REFL_SOFT_STOP = False              # REFL で DMAX で減速して停止する（False で直ちに停止）
+REFL_POLL_INTERVAL = 0.01           # 基準点への移動中に REFL の状態を確認する間隔（秒）
 DEBOUNCE_INTERVAL = 0.01            # デバウンス間隔（秒）
+BUTTON_DEBOUNCE_INTERVAL = 0.2      # スタート・ストップスイッチのデバウンス間隔（秒、tick 方式）
+SWITCH_DEBOUNCE_MODE = "tick"       # デバウンス方式（tick: tickと共有スレッド / timer: エッジごとのタイマー）
+SWITCH_GLITCH_FILTER = 1000         # pigpioのグリッチフィルタ（マイクロ秒、0で無効）
+DEVICE_RUNTIME = "thread"           # デバイス制御の実行方式（thread: スレッド / asyncio: イベントループ）
+
+#
+# メトリクス設定
+#
+METRICS_TEXTFILE = ""               # Prometheus テキストファイルの出力先（空で出力しない）
+METRICS_INTERVAL = 10.0             # テキストファイルの書き出し間隔（秒）
+METRICS_HTTP_PORT = 0               # localhost で /metrics を公開するポート（0で無効）
+CONTROL_SOCKET = ""                 # 制御 API の Unix ドメインソケットのパス（空で無効）
+CONTROL_STATUS_INTERVAL = 0.2       # 再生中に制御 API の状態を更新する間隔（秒）
+
+#
+# テレメトリー設定
+#
+TELEMETRY_CAPACITY = 0              # リングバッファのレコード数（0で記録しない）
+TELEMETRY_DECIMATION = 1            # 記録する指令（セグメント）の間隔（1ですべて）
+TELEMETRY_FILE = "telemetry-%Y%m%d-%H%M%S.bin"  # 書き出し先（strftime 書式、.csv で CSV）
 
 #
 # ロギング設定
 #
 LOGGING_CONFIG_FILE = "logging.yaml"
+LOGGING_QUEUE = False               # ログをキュー経由でリスナースレッドから出力する
@@ -0,0 +1,156 @@
+"""
+ローカルの制御 API。
+
+CONTROL_SOCKET の Unix ドメインソケットで、1行1つの JSON のコマンドを受け付けて
+1行の JSON で応答する。
+
+    {"command": "status"}
+    {"command": "select", "name": "night.csv"}
+
+status の応答は制御ループが公開したスナップショット（ApneaPlayer.snapshot）で、
+SPI 通信は行わないため、頻繁に問い合わせてもモーターの制御に影響しない。
+
+    $ cd demo && python control.py status
+"""
+import json
+from logging import getLogger
+import os
+import socket
+import sys
+from threading import Thread
+
+from constant import *
+
+# create logger
+logger = getLogger(__name__)
+
+# 1行の最大長（バイト）
+MAX_LINE = 4096
+
+
+def _handler_class(commands: dict, snapshot):
+    """
+    commands と snapshot を呼び出すリクエストハンドラーのクラスを作成する。
+    """
+    from socketserver import StreamRequestHandler
+
+    class ControlHandler(StreamRequestHandler):
+        def handle(self):
+            while True:
+                line = self.rfile.readline(MAX_LINE)
+                if not line:
+                    return
+                if not line.strip():
+                    continue
+                reply = self._execute(line)
+                self.wfile.write(json.dumps(reply, default=str).encode("utf-8") + b"\n")
+
+        def _execute(self, line: bytes) -> dict:
+            try:
+                request = json.loads(line)
+                command = request["command"]
+            except (ValueError, TypeError, KeyError):
+                return {"ok": False, "error": "invalid request"}
+            if command == "status":
+                return {"ok": True, "status": snapshot()}
+            func = commands.get(command)
+            if func is None:
+                return {"ok": False, "error": f"unknown command: {command}"}
+            args = {key: value for key, value in request.items() if key != "command"}
+            logger.info(f"control command:{command} args:{args}")
+            try:
+                result = func(**args)
+            except (KeyError, TypeError, ValueError) as e:
+                return {"ok": False, "error": f"{command}: {e!r}"}
+            if result is False:
+                return {"ok": False, "error": f"{command}: not accepted"}
+            reply = {"ok": True}
+            if result is not None and result is not True:
+                reply["result"] = result
+            return reply
+
+    return ControlHandler
+
+
+class ControlServer:
+    """
+    制御 API の Unix ドメインソケットサーバー。接続ごとのスレッドで応答する。
+
+    :param commands: {コマンド名: 関数}。関数はリクエストのコマンド以外の項目を
+                     キーワード引数で受け取り、False を返した場合は失敗として応答する
+    :param snapshot: 公開されている状態を返す関数（SPI 通信を行わないこと）
+    :param path: ソケットのパス（空の場合は起動しない）
+    """
+
+    def __init__(self, commands: dict, snapshot, path: str = CONTROL_SOCKET):
+        self._commands = commands
+        self._snapshot = snapshot
+        self._path = path
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if not self._path:
+            return self
+        from socketserver import ThreadingUnixStreamServer
+
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        handler = _handler_class(self._commands, self._snapshot)
+        self._server = ThreadingUnixStreamServer(self._path, handler)
+        self._server.daemon_threads = True
+        os.chmod(self._path, 0o600)
+        self._thread = Thread(
+            target=self._server.serve_forever, name="ControlServer", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"control socket: {self._path}")
+        return self
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+def request(command: str, path: str = CONTROL_SOCKET, **args) -> dict:
+    """
+    制御 API にコマンドを送り、応答を返す。
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps({"command": command, **args}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as file:
+            return json.loads(file.readline())
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="制御 API にコマンドを送る")
+    parser.add_argument(
+        "command", help="start, stop, pause, resume, select, profiles, status"
+    )
+    parser.add_argument("name", nargs="?", help="select で選択するプロファイルの名前")
+    parser.add_argument("--socket", default=CONTROL_SOCKET, help="ソケットのパス")
+    args = parser.parse_args(argv)
+    if not args.socket:
+        parser.error("CONTROL_SOCKET is not set, specify --socket")
+
+    params = {} if args.name is None else {"name": args.name}
+    reply = request(args.command, args.socket, **params)
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,24 @@
 from cgstep import TMC5240
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 import pigpio
+import signal
 import time
 from threading import Thread, Event
 
 from constant import *
 
+import startup
 from apnea.data import ApneaData
-from apnea import demo as ApneaDemo
-from motor import MotorController
-from switch import Switch
+from apnea.demo import ApneaPlayer
+from apnea.library import ProfileLibrary
+from control import ControlServer
+from logutil import StatusField
+from motor import MotorController, RAMP_STAT_VZERO, create_driver
+from metrics import MetricsExporter
+from state import consume_state, save_state
+from switch import Switch, SwitchDispatcher
+from telemetry import create_recorder
 
 logger = getLogger(__name__)
 
@@ -36,126 +45,394 @@ def _stop_sw_pin_cbf(gpio, level, tick):
     _demo_stop()
 
 
-def _limit_sw_pin_cbf(gpio, level, tick):
-    logger.info(f"limit sw gpio:{gpio}, level:{level}, tick:{tick}")
-    if level == pigpio.HIGH:
-        ApneaDemo.moved_away_reference_point()
+def press_callback(on_short, on_long, press_time: float = PROFILE_SELECT_PRESS_TIME):
+    """
+    押していた時間で動作を切り替える Switch.callback を作成する（EITHER_EDGE で使用する）。
+
+    スイッチを離したとき（HIGH）に、押していた時間が press_time 秒以上であれば
+    on_long()、短ければ on_short() を呼び出す。
+    """
+    press_ticks = int(press_time * 1000000)
+    tick_pressed = None
+
+    def cbf(gpio, level, tick):
+        nonlocal tick_pressed
+        logger.info(f"press sw gpio:{gpio}, level:{level}, tick:{tick}")
+        if level == pigpio.LOW:
+            tick_pressed = tick
+            return
+        # tick は32ビットで周回する
+        if tick_pressed is not None and press_ticks <= (tick - tick_pressed) & 0xFFFFFFFF:
+            on_long()
+        else:
+            on_short()
+        tick_pressed = None
+
+    return cbf
+
+
+def _emergency_stop_cbf(player: ApneaPlayer):
+    def cbf(gpio, level, tick):
+        # pigpio のコールバックスレッドで、デバウンス前の最初のエッジから呼び出される
+        time_edge = time.monotonic()
+        latencies = player.emergency_stop(time_edge)
+        log_emergency_stop(gpio, tick, latencies)
+
+    return cbf
+
+
+def log_emergency_stop(gpio, tick, latencies: list[float]) -> None:
+    latencies = [latency for latency in latencies if latency is not None]
+    if not latencies:
+        # 非常停止はラッチ済み（チャタリングなど）
+        return
+    logger.warning(
+        f"emergency stop gpio:{gpio}, tick:{tick},"
+        f" stop-to-decel latency:{max(latencies) * 1000:.3f}ms"
+    )
+
+
+def _limit_sw_pin_cbf(player: ApneaPlayer, axis: int):
+    def cbf(gpio, level, tick):
+        logger.info(f"limit sw gpio:{gpio}, level:{level}, tick:{tick}, axis:{axis}")
+        if level == pigpio.HIGH:
+            player.moved_away_reference_point(axis)
+        else:
+            player.reached_reference_point(axis)
+
+    return cbf
+
+
+def _limit_sw_refl_cbf(player: ApneaPlayer, axis: int):
+    # MotorController.status で REFL の状態の変化を検出したときに呼び出される
+    cbf = _limit_sw_pin_cbf(player, axis)
+
+    def refl_cbf(active: bool):
+        cbf("REFL", pigpio.LOW if active else pigpio.HIGH, 0)
+
+    return refl_cbf
+
+
+def parse_axes(text: str = MOTOR_AXES) -> list[tuple]:
+    """
+    軸の設定を解析する。
+
+    軸ごとに "SPIバス.CS[.ボードID]:リミットスイッチのピン[:CSVファイルパス]" を
+    ; 区切りで指定する。空の場合は SPI 0.0、LIMIT_SW_PIN、APNEA_DATA_CSV_PATH の1軸。
+
+    :return: [(バス, CS, ボードID, リミットスイッチのピン, CSVファイルパス), ...]
+    """
+    axes = []
+    for spec in text.split(";"):
+        spec = spec.strip()
+        if not spec:
+            continue
+        fields = spec.split(":", 2)
+        spi = [int(v) for v in fields[0].split(".")]
+        bus, device = spi[0], spi[1] if 1 < len(spi) else 0
+        board_id = spi[2] if 2 < len(spi) else None
+        pin = int(fields[1]) if 1 < len(fields) and fields[1] else LIMIT_SW_PIN
+        csv_path = fields[2] if 2 < len(fields) and fields[2] else APNEA_DATA_CSV_PATH
+        axes.append((bus, device, board_id, pin, csv_path))
+    if not axes:
+        axes.append((0, 0, None, LIMIT_SW_PIN, APNEA_DATA_CSV_PATH))
+    return axes
+
+
+def _load_profile(csv_path: str, library: ProfileLibrary = None) -> ApneaData:
+    if library is None:
+        apneadata = ApneaData(csv_path)
     else:
-        ApneaDemo.reached_reference_point()
+        apneadata = library.load()
+    # 速度スケジュールの変換で使う NumPy も読み込んでおく
+    import numpy
+
+    return apneadata
+
+
+def create_player() -> tuple[ApneaPlayer, list[int]]:
+    """
+    MOTOR_AXES の設定から軸を作成する。
+
+    :return: (プレーヤー, 各軸のリミットスイッチのピン)
+    """
+    player = ApneaPlayer()
+    limit_pins = []
+    axes = parse_axes()
+    library = None
+    if PROFILE_LIBRARY_DIR:
+        # ライブラリで選択したプロファイルをすべての軸で再生する
+        library = ProfileLibrary()
+        player.set_library(library)
+    # プロファイルの読み込みをモータードライバーの初期化と並行して行う
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ProfileLoader") as executor:
+        profiles = [
+            executor.submit(_load_profile, csv_path, library)
+            for _, _, _, _, csv_path in axes
+        ]
+        motorControllers = []
+        for bus, device, board_id, pin, csv_path in axes:
+            driver = create_driver(
+                steps_per_rev=STEPS_PER_REV, bus=bus, device=device, board_id=board_id
+            )
+            motorControllers.append(
+                MotorController(steps_per_rev=STEPS_PER_REV, driver=driver)
+            )
+        startup.phase("drivers")
+
+        for (bus, device, board_id, pin, csv_path), motorController, profile in zip(
+            axes, motorControllers, profiles
+        ):
+            axis = player.add_axis(motorController, profile.result())
+            logger.info(
+                f"[{axis.name}] spi:{bus}.{device} board:{board_id} limit sw:{pin} data:{csv_path}"
+            )
+            limit_pins.append(pin)
+    startup.phase("profiles")
+
+    if library is not None:
+        library.start_watch()
+        logger.info(
+            f"profile library:{library.directory} selected:{library.selected}"
+            f" cache:{library.cache_size}"
+        )
+        # ホーミングの間に速度スケジュールを変換しておく
+        Thread(target=player.prepare_profile, name="ProfilePrepare", daemon=True).start()
+
+    recorder = create_recorder()
+    if recorder is not None:
+        player.set_telemetry(recorder)
+        # SIGUSR1 で記録中のテレメトリーを書き出す
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: Thread(
+                target=player.dump_telemetry, name="TelemetryDump"
+            ).start(),
+        )
+        logger.info(
+            f"telemetry capacity:{recorder.capacity}"
+            f" decimation:{recorder.decimation} file:{recorder.path}"
+        )
+    return player, limit_pins
+
+
+def save_position_state(player: ApneaPlayer) -> None:
+    """
+    停止している軸の位置を STATE_FILE に保存する。
+    """
+    if not STATE_FILE:
+        return
+    try:
+        axes = player.position_state()
+        save_state(axes)
+        logger.info(f"position state saved: {axes}")
+    except OSError:
+        logger.exception("position state save error")
+
+
+def create_control_server(player: ApneaPlayer, commands: dict) -> ControlServer:
+    """
+    制御 API のサーバーを作成する。
+
+    :param commands: start, stop, pause, resume, select のコマンドの関数
+    """
+    commands = dict(commands)
+
+    def profiles():
+        library = player.library
+        if library is None:
+            return False
+        return {"profiles": library.names(), "selected": library.selected}
+
+    commands["profiles"] = profiles
+    return ControlServer(commands, lambda: player.snapshot)
+
+
+def _select_profile(player: ApneaPlayer):
+    def select(name: str = None):
+        # ライブラリがない場合は失敗として応答する
+        return player.select_profile(name) or False
+
+    return select
+
+
+def create_switch_options() -> tuple[SwitchDispatcher, dict, dict]:
+    """
+    SWITCH_DEBOUNCE_MODE に従ってスイッチのオプションを作成する。
+
+    :return: (ディスパッチャー（使用しない場合は None）,
+              リミットスイッチの Switch のキーワード引数,
+              スタート・ストップスイッチの Switch のキーワード引数)
+    """
+    if SWITCH_DEBOUNCE_MODE == "tick":
+        # 全スイッチのコールバックを1本のスレッドで処理する
+        dispatcher = SwitchDispatcher().start()
+        switch_options = {
+            "debounce_interval": DEBOUNCE_INTERVAL,
+            "dispatcher": dispatcher,
+            "glitch_filter": SWITCH_GLITCH_FILTER,
+        }
+        # 手で押すスイッチは離すときのチャタリングが長いため、長い間隔で抑える
+        button_options = dict(switch_options, debounce_interval=BUTTON_DEBOUNCE_INTERVAL)
+        return dispatcher, switch_options, button_options
+    switch_options = {"debounce_interval": 0.2}
+    return None, switch_options, switch_options
 
 
 def start():
-    global _g_motorController
-    global _g_apneadata
+    exporter = MetricsExporter().start()
+    try:
+        if DEVICE_RUNTIME == "asyncio":
+            import runtime
+
+            runtime.start()
+        else:
+            _start_threaded()
+    finally:
+        exporter.stop()
 
-    _g_apneadata = ApneaData(APNEA_DATA_CSV_PATH)
 
-    _g_motorController = MotorController(steps_per_rev=STEPS_PER_REV)
-    _g_motorController.poweron()
+def _start_threaded():
+    player, limit_pins = create_player()
     try:
-        logger.info(f"Motor enabled. xtarget:{_g_motorController.tmc5240.xtarget}")
-        while _g_motorController.is_running():
-            time.sleep(1.0)
+        for axis in player.axes:
+            motorController = axis.motorController
+            motorController.poweron()
             logger.info(
-                f"Motor controller is running."
-                f" xtarget:{_g_motorController.tmc5240.xtarget:9},"
-                f" xactual:{_g_motorController.tmc5240.xactual:9},"
-                f" vactual:{_g_motorController.tmc5240.vactual:9}"
+                "[%s] Motor enabled. xtarget:%s",
+                axis.name,
+                StatusField(motorController, "xtarget"),
             )
+        for axis in player.axes:
+            motorController = axis.motorController
+            if not motorController.wait_until(RAMP_STAT_VZERO, MOTER_LIMIT_TIME_OF_DRIVE):
+                status = motorController.status()
+                logger.error(
+                    f"[{axis.name}] Motor controller is running."
+                    f" xtarget:{status.xtarget:9},"
+                    f" xactual:{status.xactual:9},"
+                    f" vactual:{status.vactual:9}"
+                )
+        # 前回の終了時の位置を復元する
+        player.restore_position_state(consume_state())
+        startup.phase("poweron")
         pi = pigpio.pi()
+        dispatcher, switch_options, button_options = create_switch_options()
+        limit_sws = []
         try:
             ########################################################
-            # リミットスイッチの設定
-            limit_sw = Switch(
-                LIMIT_SW_PIN, pi, debounce_interval=0.2, edge=pigpio.EITHER_EDGE
-            )
-            logger.info(f"limit sw({limit_sw.pin}) level:{limit_sw.level}")
+            # リミットスイッチの設定（軸ごと）
+            limit_pressed = []
+            for index, (axis, pin) in enumerate(zip(player.axes, limit_pins)):
+                motorController = axis.motorController
+                if LIMIT_SW_MODE == "refl":
+                    # ドライバーが REFL で停止し、状態はステータスの読み出しで反映する
+                    motorController.enable_reference_switch(
+                        _limit_sw_refl_cbf(player, index)
+                    )
+                    status = motorController.status(0)
+                    logger.info(f"[{axis.name}] limit sw(REFL) active:{status.status_stop_l}")
+                    limit_pressed.append(
+                        lambda motorController=motorController: (
+                            motorController.status(0).status_stop_l
+                        )
+                    )
+                    continue
+                limit_sw = Switch(pin, pi, edge=pigpio.EITHER_EDGE, **switch_options)
+                limit_sws.append(limit_sw)
+                logger.info(f"[{axis.name}] limit sw({limit_sw.pin}) level:{limit_sw.level}")
+                limit_sw.callback = _limit_sw_pin_cbf(player, index)
+                limit_sw.callback(limit_sw.pin, limit_sw.level, 0)
+                limit_pressed.append(lambda limit_sw=limit_sw: limit_sw.level == pigpio.LOW)
+
+            # リミットスイッチの状態を確認（位置を復元した軸は基準点で停止している）
+            for axis, is_pressed in zip(player.axes, limit_pressed):
+                if is_pressed() and axis.reference_offset is None:
+                    player.drive(player.release_steps(axis, is_pressed))
+            startup.phase("switches")
+
+            # モーターの位置を基準点に移動
+            player.move_to_reference_point()
+            startup.phase("homing")
+
+            ########################################################
+            # スタートスイッチの設定
+            if player.library is None:
+                start_edge = pigpio.RISING_EDGE
+            else:
+                start_edge = pigpio.EITHER_EDGE
+            start_sw = Switch(START_SW_PIN, pi, edge=start_edge, **button_options)
+            logger.info(f"start sw({start_sw.pin}) level:{start_sw.level}")
             try:
-                limit_sw.callback = _limit_sw_pin_cbf
-                _limit_sw_pin_cbf(limit_sw.pin, limit_sw.level, 0)
-
-                # リミットスイッチの状態を確認
-                if limit_sw.level == pigpio.LOW:
-                    logger.info(f"Motor position move. {_g_motorController.tmc5240.xactual}.")
-                    # リミットスイッチが押されている場合、モーターを回転させてリミットスイッチを離す
-                    _g_motorController.rotate()
-                    t = time.time()
-                    time_proc = t + 1.0
-                    time_limit = t + MOTER_LIMIT_TIME_OF_DRIVE
-                    while limit_sw.level == pigpio.LOW:
-                        time.sleep(0.1)
-                        t = time.time()
-                        if t > time_proc :
-                            time_proc = t
-                            logger.info(f"Motor position move. {_g_motorController.tmc5240.xactual}.")
-                        if t > time_limit:
-                            logger.error("Limit switch not released.")
-                            break
-                        
-                    # モーターを停止
-                    time.sleep(MOTER_EXTRAQ_STOP_TIME)
-                    _g_motorController.stop()
-                    time_proc = t + 1.0
-                    time_limit = t + MOTER_LIMIT_TIME_OF_DRIVE
-                    while _g_motorController.is_running():
-                        time.sleep(0.1)
-                        t = time.time()
-                        if t > time_proc :
-                            time_proc = t
-                            logger.info(f"Motor stop. {_g_motorController.tmc5240.xactual}.")
-                        if t > time_limit:
-                            logger.error("Motor not stopped.")
-                            break
-
-                # モーターの位置を基準点に移動
-                ApneaDemo.move_to_reference_point(_g_motorController)
+                if player.library is None:
+                    start_sw.callback = _start_sw_pin_cbf
+                else:
+                    # 長押しで次のプロファイルを選択する
+                    start_sw.callback = press_callback(_demo_start, player.select_profile)
 
                 ########################################################
-                # スタートスイッチの設定
-                start_sw = Switch(
-                    START_SW_PIN, pi, debounce_interval=0.2, edge=pigpio.RISING_EDGE
+                # ストップスイッチの設定
+                stop_sw = Switch(
+                    STOP_SW_PIN, pi, edge=pigpio.RISING_EDGE, **button_options
                 )
-                logger.info(f"start sw({start_sw.pin}) level:{start_sw.level}")
+                logger.info(f"stop sw({stop_sw.pin}) level:{stop_sw.level}")
                 try:
-                    start_sw.callback = _start_sw_pin_cbf
+                    if STOP_SW_EMERGENCY:
+                        # 停止は最初のエッジで要求する（デバウンス後の通知で基準点への戻りを中断しない）
+                        stop_sw.edge_callback = _emergency_stop_cbf(player)
+                    else:
+                        stop_sw.callback = _stop_sw_pin_cbf
 
                     ########################################################
-                    # ストップスイッチの設定
-                    stop_sw = Switch(
-                        STOP_SW_PIN, pi, debounce_interval=0.2, edge=pigpio.RISING_EDGE
-                    )
-                    logger.info(f"stop sw({stop_sw.pin}) level:{stop_sw.level}")
-                    try:
-                        stop_sw.callback = _stop_sw_pin_cbf
+                    # 制御 API
+                    control = create_control_server(
+                        player,
+                        {
+                            "start": _demo_start,
+                            "stop": _demo_stop,
+                            "pause": player.pause,
+                            "resume": player.resume,
+                            "select": _select_profile(player),
+                        },
+                    ).start()
+                    startup.report()
 
-                        ########################################################
-                        # メインループ
+                    ########################################################
+                    # メインループ
+                    try:
                         while True:
                             _g_demo_event.wait()
                             _g_demo_event.clear()
 
                             if _g_demo_sop_event.is_set():
                                 _g_demo_sop_event.clear()
-                                ApneaDemo.stop()
-                            
+                                player.stop()
+
                             if _g_demo_start_event.is_set():
                                 _g_demo_start_event.clear()
-                                ApneaDemo.start(_g_motorController, _g_apneadata)
+                                player.start()
                     finally:
-                        stop_sw.cancel()
+                        control.stop()
                 finally:
-                    start_sw.cancel()
+                    stop_sw.cancel()
             finally:
-                limit_sw.cancel()
+                start_sw.cancel()
         finally:
+            for limit_sw in limit_sws:
+                limit_sw.cancel()
+            if dispatcher is not None:
+                dispatcher.stop()
             pi.stop()
     finally:
-        thread = ApneaDemo.stop()
+        thread = player.stop()
         if isinstance(thread, Thread):
             if thread.is_alive():
                 thread.join()
-        if _g_motorController.is_poweron():
-            _g_motorController.poweroff()
-            logger.info(f"motor power off.")
-        logger.info(f"device stopped. motor power is {_g_motorController.is_poweron()}")
-
+        save_position_state(player)
+        if player.library is not None:
+            player.library.stop_watch()
+        for axis in player.axes:
+            if axis.motorController.is_poweron():
+                axis.motorController.poweroff()
+                logger.info(f"[{axis.name}] motor power off.")
+        logger.info("device stopped.")
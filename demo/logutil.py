@@ -0,0 +1,99 @@
+"""
+制御スレッドを止めないためのロギング補助。
+
+- StatusField: ログ出力時にのみ MotorController のステータスを評価する遅延引数
+- start_queue_logging: ルートロガーのハンドラーをキュー経由にし、
+  リスナースレッドで整形・出力する（LOGGING_QUEUE = True で有効）
+"""
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from constant import *
+
+# キュー経由の出力中のリスナー
+_g_listener = None
+
+
+class StatusField:
+    """
+    ログレコードが出力されるときにだけ MotorController のステータスを読む遅延引数。
+
+    ``logger.debug("xactual:%9s", StatusField(motorController, "xactual"))`` のように
+    %s 形式で渡す。ログレベルが無効な場合は評価されない。
+
+    キュー経由の出力中は、整形がリスナースレッドで行われるため SPI 通信をせず、
+    生成時点のステータスのキャッシュ（MotorController.last_status）を使う。
+
+    :param motorController: モーターコントローラー
+    :param name: MotorStatus の属性名
+    :param format_spec: 値の書式（format() の書式指定）
+    """
+
+    __slots__ = ("_motorController", "_name", "_format_spec", "_status")
+
+    def __init__(self, motorController, name: str, format_spec: str = ""):
+        self._motorController = motorController
+        self._name = name
+        self._format_spec = format_spec
+        self._status = motorController.last_status if _g_listener is not None else None
+
+    def __str__(self):
+        status = self._status
+        if status is None:
+            if _g_listener is not None:
+                return "-"
+            status = self._motorController.status()
+        return format(getattr(status, self._name), self._format_spec)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    レコードを整形せずにキューへ渡す QueueHandler。
+
+    標準の QueueHandler は呼び出し元のスレッドでメッセージを整形するため、
+    整形と遅延引数の評価をリスナースレッドで行うようにする。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_queue_logging() -> QueueListener:
+    """
+    ルートロガーのハンドラーをリスナースレッドへ移し、ルートロガーには
+    キューへ渡すハンドラーのみを残す。
+    """
+    global _g_listener
+    if _g_listener is not None:
+        return _g_listener
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    queue = SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(queue))
+
+    _g_listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    _g_listener.start()
+    return _g_listener
+
+
+def stop_queue_logging() -> None:
+    """
+    キューに残ったレコードを出力してリスナースレッドを停止し、ハンドラーを戻す。
+    """
+    global _g_listener
+    listener = _g_listener
+    if listener is None:
+        return
+    listener.stop()
+    _g_listener = None
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _DeferredQueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
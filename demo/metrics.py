@@ -0,0 +1,346 @@
+"""
+制御ループのメトリクス（カウンターとヒストグラム）。
+
+計測側は数値の加算のみを行い、SPI 通信や文字列の整形はしない。
+Prometheus のテキスト形式への変換は、テキストファイルの書き出しスレッドまたは
+localhost の HTTP サーバーのスレッドで行う。
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from logging import getLogger
+import os
+from threading import Event, Lock, Thread
+
+from constant import *
+
+# create logger
+logger = getLogger(__name__)
+
+# 秒単位のヒストグラムの既定のバケット上限
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0002,
+    0.0005,
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+)
+
+
+class _Metric(ABC):
+    """
+    ラベルごとの値を持つメトリクスの基底クラス。
+
+    labels(...) で取得した子メトリクスを保持しておけば、計測時に辞書の検索も不要になる。
+    子メトリクスはそれぞれロックを持ち、複数のスレッド（制御スレッド、pigpio の
+    コールバックスレッド、イベントループ）から更新できる。
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """
+        ラベルの値の組に対応する子メトリクスを作成する。
+        """
+
+    @abstractmethod
+    def _render_child(self, values, child) -> list[str]:
+        """
+        子メトリクスを Prometheus のテキスト形式の行に変換する。
+        """
+
+    def _label_text(self, values, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: int = 1):
+        self._default.inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {child.value}"]
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # 最後の要素は +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        # バケットと合計を同じ時点の値で出力する
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            label = self._label_text(values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{label} {cumulative}")
+        cumulative += counts[-1]
+        label = self._label_text(values, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{label} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Prometheus のテキスト形式に変換する。
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        node_exporter の textfile collector 用にファイルへ書き出す（一時ファイルから置き換え）。
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+SAMPLE_LATENESS = REGISTRY.register(
+    Histogram("apnea_sample_lateness_seconds", "Lateness of each control wakeup.")
+)
+PROCESSING_TIME = REGISTRY.register(
+    Histogram(
+        "apnea_processing_seconds",
+        "Time spent commanding the drivers in each control wakeup.",
+    )
+)
+OVERRUNS = REGISTRY.register(
+    Counter("apnea_overruns_total", "Control wakeups late by one interval or more.")
+)
+PROFILE_WRAPS = REGISTRY.register(
+    Counter("apnea_profile_wraps_total", "Profile restarts from the beginning.", ("axis",))
+)
+PROFILE_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "apnea_profile_cache_lookups_total",
+        "Profile library cache lookups.",
+        ("result",),
+    )
+)
+HOMING_TIME = REGISTRY.register(
+    Histogram(
+        "apnea_homing_seconds",
+        "Duration of moves to the reference point.",
+        buckets=(0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0),
+    )
+)
+REGISTER_READS = REGISTRY.register(
+    Counter("motor_register_reads_total", "TMC5240 register reads.")
+)
+REGISTER_WRITES = REGISTRY.register(
+    Counter("motor_register_writes_total", "TMC5240 register writes.")
+)
+EMERGENCY_STOP_LATENCY = REGISTRY.register(
+    Histogram(
+        "motor_emergency_stop_latency_seconds",
+        "Time from the stop switch edge callback to the VMAX=0 write.",
+    )
+)
+
+
+def _handler_class(registry: Registry):
+    """
+    registry を公開する HTTP リクエストハンドラーのクラスを作成する。
+    http.server は HTTP で公開する場合にのみ読み込む。
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return MetricsHandler
+
+
+class MetricsExporter:
+    """
+    メトリクスをテキストファイルと HTTP で公開する。
+
+    :param textfile: テキストファイルのパス（空の場合は書き出さない）
+    :param interval: テキストファイルの書き出し間隔（秒）
+    :param port: HTTP サーバーのポート（0 の場合は起動しない）
+    :param host: HTTP サーバーのアドレス
+    :param registry: 公開するレジストリ
+    """
+
+    def __init__(
+        self,
+        textfile: str = METRICS_TEXTFILE,
+        interval: float = METRICS_INTERVAL,
+        port: int = METRICS_HTTP_PORT,
+        host: str = "127.0.0.1",
+        registry: Registry = REGISTRY,
+    ):
+        self._textfile = textfile
+        self._interval = interval
+        self._port = port
+        self._host = host
+        self._registry = registry
+        self._stop_event = Event()
+        self._threads = []
+        self._server = None
+
+    def start(self):
+        if self._textfile:
+            thread = Thread(target=self._write_loop, name="MetricsTextfile", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            logger.info(f"metrics textfile: {self._textfile}")
+        if 0 < self._port:
+            from http.server import ThreadingHTTPServer
+
+            handler = _handler_class(self._registry)
+            self._server = ThreadingHTTPServer((self._host, self._port), handler)
+            thread = Thread(
+                target=self._server.serve_forever, name="MetricsHttp", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+            logger.info(f"metrics http: http://{self._host}:{self._port}/metrics")
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        if self._textfile:
+            self._write()
+
+    def _write(self):
+        try:
+            self._registry.write_textfile(self._textfile)
+        except OSError:
+            logger.exception("metrics textfile write error")
+
+    def _write_loop(self):
+        while not self._stop_event.wait(self._interval):
+            self._write()
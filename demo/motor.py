@@ -1,12 +1,61 @@
 from cgstep import TMC5240
 
 from logging import getLogger
+from threading import Event, RLock
+import time
 
 from constant import *
 
+import metrics
+
 # create logger
 logger = getLogger(__name__)
 
+# TMC5240 レジスタアドレス
+REG_RAMPMODE = 0x20
+REG_XACTUAL = 0x21
+REG_VACTUAL = 0x22
+REG_VMAX = 0x27
+REG_XTARGET = 0x2D
+REG_SW_MODE = 0x34
+REG_RAMP_STAT = 0x35
+REG_XLATCH = 0x36
+REG_DRV_STATUS = 0x6F
+
+# RAMP_STAT のビット（MotorController.wait_until の条件に使用する）
+RAMP_STAT_STATUS_STOP_L = 1 << 0
+RAMP_STAT_STATUS_LATCH_L = 1 << 2
+RAMP_STAT_EVENT_STOP_L = 1 << 4
+RAMP_STAT_VELOCITY_REACHED = 1 << 8
+RAMP_STAT_POSITION_REACHED = 1 << 9
+RAMP_STAT_VZERO = 1 << 10
+
+# SW_MODE のビット（REFL に接続したリミットスイッチ）
+SW_MODE_STOP_L_ENABLE = 1 << 0
+SW_MODE_POL_STOP_L = 1 << 2
+SW_MODE_LATCH_L_ACTIVE = 1 << 5
+SW_MODE_EN_SOFTSTOP = 1 << 11
+
+# wait_until のポーリング間隔の範囲（秒）
+WAIT_POLL_INTERVAL_MIN = 0.002
+WAIT_POLL_INTERVAL_MAX = 0.1
+
+# ステータススナップショットで一括して読み出すレジスタ
+STATUS_REGISTERS = (
+    REG_XACTUAL,
+    REG_VACTUAL,
+    REG_VMAX,
+    REG_XTARGET,
+    REG_RAMP_STAT,
+    REG_DRV_STATUS,
+)
+
+
+def _to_signed(value: int, bits: int) -> int:
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
 
 class MotorEnabledError(Exception):
     """
@@ -48,22 +97,136 @@ class MotorRunningError(Exception):
             self.message = "Motor is running."
 
 
+class MotorStatus:
+    """
+    TMC5240 のステータスレジスタを一括で読み出したスナップショット。
+
+    :param registers: {アドレス: 値} のレジスタ値
+    :param spi_status: SPI 応答のステータスバイト
+    :param timestamp: 読み出し時刻（MotorController の clock）
+    :param v2rpm: 速度(v)を RPM に変換する関数
+    """
+
+    __slots__ = (
+        "xactual",
+        "vactual",
+        "vmax",
+        "xtarget",
+        "ramp_stat",
+        "drv_status",
+        "spi_status",
+        "timestamp",
+        "vactual_rpm",
+        "vmax_rpm",
+    )
+
+    def __init__(self, registers: dict, spi_status: int, timestamp: float, v2rpm):
+        self.xactual = _to_signed(registers[REG_XACTUAL], 32)
+        self.vactual = _to_signed(registers[REG_VACTUAL], 24)
+        self.vmax = registers[REG_VMAX]
+        self.xtarget = _to_signed(registers[REG_XTARGET], 32)
+        self.ramp_stat = registers[REG_RAMP_STAT]
+        self.drv_status = registers[REG_DRV_STATUS]
+        self.spi_status = spi_status
+        self.timestamp = timestamp
+        self.vactual_rpm = v2rpm(self.vactual)
+        self.vmax_rpm = v2rpm(self.vmax)
+
+    # RAMP_STAT
+    @property
+    def status_stop_l(self):
+        return bool(self.ramp_stat & (1 << 0))
+
+    @property
+    def status_latch_l(self):
+        return bool(self.ramp_stat & (1 << 2))
+
+    @property
+    def event_stop_l(self):
+        return bool(self.ramp_stat & (1 << 4))
+
+    @property
+    def velocity_reached(self):
+        return bool(self.ramp_stat & (1 << 8))
+
+    @property
+    def position_reached(self):
+        return bool(self.ramp_stat & (1 << 9))
+
+    @property
+    def vzero(self):
+        return bool(self.ramp_stat & (1 << 10))
+
+    # DRV_STATUS
+    @property
+    def ot(self):
+        return bool(self.drv_status & (1 << 25))
+
+    @property
+    def otpw(self):
+        return bool(self.drv_status & (1 << 26))
+
+    @property
+    def stst(self):
+        return bool(self.drv_status & (1 << 31))
+
+    def is_running(self):
+        return self.vactual != 0
+
+
+def create_driver(
+    driver: str = MOTOR_DRIVER,
+    steps_per_rev=200,
+    bus: int = 0,
+    device: int = 0,
+    board_id: int = None,
+) -> TMC5240:
+    """
+    モータードライバーを作成する。
+
+    :param driver: "tmc5240"（SPI接続の実機）または "simulator"（シミュレーター）
+    :param steps_per_rev: モーター1回転のフルステップ数
+    :param bus: SPIバス
+    :param device: CS信号
+    :param board_id: RPZ-Stepper基板用ボード選択信号（None で使用しない）
+    """
+    if driver == "simulator":
+        from simulator import SimulatedTMC5240
+
+        logger.info(f"motor driver: simulator bus:{bus} device:{device}")
+        return SimulatedTMC5240(
+            bus, device, board_id, steps_per_rev=steps_per_rev
+        )
+    return TMC5240(bus, device, board_id, steps_per_rev=steps_per_rev)
+
+
 class MotorController:
-    def __init__(self, steps_per_rev=200):
+    def __init__(
+        self,
+        steps_per_rev=200,
+        status_max_age: float = MOTER_STATUS_MAX_AGE,
+        driver: TMC5240 = None,
+        clock=time.monotonic,
+    ):
 
         ifs = round(MOTOR_RATED_VOLTAGE / MOTOR_WINDING_RESISTANCE, 3)
 
-        self._tmc5240 = TMC5240(steps_per_rev=steps_per_rev)
+        if driver is None:
+            driver = create_driver(steps_per_rev=steps_per_rev)
+        self._tmc5240 = driver
+        # レジスタアクセスを直列化するロック（非常停止は別スレッドから書き込む）
+        self._lock = RLock()
+        # 非常停止のラッチ
+        self._estop = False
+        self._estop_latency = None
         self._poweron_flag = bool(self._tmc5240.toff != 0)
         self._tmc5240.disable()
 
         self._tmc5240.ifs = ifs  # 電流値ifs (A)
-        self._tmc5240.amax = (
-            MOTER_AMAX if 0 < MOTER_AMAX else 0
-        )  # 最大加速度 (usteps/s²)
-        self._tmc5240.dmax = (
-            MOTER_DMAX if 0 < MOTER_DMAX else 0
-        )  # 最大減速度 (usteps/s²)
+        self._amax = MOTER_AMAX if 0 < MOTER_AMAX else 0
+        self._dmax = MOTER_DMAX if 0 < MOTER_DMAX else 0
+        self._tmc5240.amax = self._amax  # 最大加速度 (usteps/s²)
+        self._tmc5240.dmax = self._dmax  # 最大減速度 (usteps/s²)
 
         v = a = d = 0
         if 0 < MOTER_V1:
@@ -91,20 +254,27 @@ class MotorController:
             self._tmc5240.a2 = a
             self._tmc5240.d2 = d
 
-        self._tmc5240.vmax = 0  # 最大速度を0rpmに設定
-        self._tmc5240.xtarget = 0
+        # 最後に書き込んだレジスタ値のシャドウ {アドレス: 値}
+        self._registers = {}
+
+        self._write_register(REG_VMAX, 0)  # 最大速度を0rpmに設定
+        self._write_register(REG_XTARGET, 0)
         self._tmc5240.xactual = 0
 
         self._rampmode = TMC5240.RAMPMODE_VELOCITY_POSITIVE  # 速度制御モード (正回転)
-        self._tmc5240.rampmode = self._rampmode
+        self._write_register(REG_RAMPMODE, self._rampmode)
 
         if self._poweron_flag:
             self.poweron()
 
-        self._thread = None
-        self._sample_interval = 0
-        self._rpms = []
-        self._stop_flag = False
+        # ステータススナップショットのキャッシュ（時刻は clock で計る）
+        self._status = None
+        self._status_max_age = status_max_age
+        self._clock = clock
+
+        # REFL のリミットスイッチの状態が変化したときに呼び出す関数とその状態
+        self._reference_callback = None
+        self._reference_active = None
 
         logger.info(f"ifs:{ifs}")
 
@@ -116,111 +286,538 @@ class MotorController:
     def rampmode(self):
         return self._rampmode
 
+    @property
+    def emergency_stopped(self):
+        return self._estop
+
+    @property
+    def emergency_stop_latency(self):
+        """
+        直近の非常停止でエッジ検出から VMAX=0 の書き込み完了までの時間（秒）
+        """
+        return self._estop_latency
+
+    @property
+    def last_status(self):
+        """
+        直近に読み出したステータスのスナップショット（SPI 通信は行わない）。未読み出しの場合は None
+        """
+        return self._status
+
     def is_poweron(self):
         return self._poweron_flag
 
     def poweron(self):
-        self._tmc5240.enable()
-        self._poweron_flag = True
+        with self._lock:
+            self._tmc5240.enable()
+            self._poweron_flag = True
         return self
 
     def poweroff(self):
-        self._tmc5240.disable()
-        self._poweron_flag = False
+        with self._lock:
+            self._tmc5240.disable()
+            self._poweron_flag = False
+        return self
+
+    def emergency_stop(self, time_edge: float = None) -> float:
+        """
+        VMAX=0 を直ちに書き込んで減速を開始し、非常停止をラッチする。
+
+        任意のスレッドから呼び出せる。制御スレッドのレジスタアクセスとはロックで
+        直列化し、ラッチ中は set_velocity と move_target の指令を無視する。
+        ラッチは clear_emergency_stop で解除する。
+
+        :param time_edge: スイッチのエッジを検出した時刻（time.monotonic）
+        :return: time_edge から書き込み完了までの時間（秒）。ラッチ済みの場合は None
+        """
+        with self._lock:
+            if self._estop:
+                return None
+            self._estop = True
+            # シャドウと同じ値でも必ず書き込む
+            self._tmc5240.write_register(REG_VMAX, 0)
+            self._registers[REG_VMAX] = 0
+            self._status = None
+            if time_edge is None:
+                return None
+            self._estop_latency = time.monotonic() - time_edge
+        metrics.REGISTER_WRITES.inc()
+        metrics.EMERGENCY_STOP_LATENCY.observe(self._estop_latency)
+        return self._estop_latency
+
+    def clear_emergency_stop(self):
+        with self._lock:
+            self._estop = False
+        return self
+
+    @property
+    def reference_switch_enabled(self):
+        return self._reference_callback is not None
+
+    def enable_reference_switch(
+        self,
+        callback,
+        active_low: bool = REFL_ACTIVE_LOW,
+        soft_stop: bool = REFL_SOFT_STOP,
+    ):
+        """
+        REFL に接続したリミットスイッチでランプジェネレータが負方向の移動を停止し、
+        検出時の XACTUAL を XLATCH にラッチするように SW_MODE を設定する。
+
+        スイッチの状態（RAMP_STAT の status_stop_l）はステータスを読み出すたびに確認し、
+        変化した場合に callback(active) を呼び出す。
+
+        :param callback: スイッチの状態が変化したときに呼び出す関数
+        :param active_low: REFL が Low のときにスイッチが有効
+        :param soft_stop: DMAX で減速して停止する（False の場合は直ちに停止）
+        """
+        sw_mode = SW_MODE_STOP_L_ENABLE | SW_MODE_LATCH_L_ACTIVE
+        if active_low:
+            sw_mode |= SW_MODE_POL_STOP_L
+        if soft_stop:
+            sw_mode |= SW_MODE_EN_SOFTSTOP
+        with self._lock:
+            self._write_register(REG_SW_MODE, sw_mode)
+            self._reference_callback = callback
+            self._reference_active = None
+            self._status = None
+        self.clear_reference_latch()
+        return self
+
+    def clear_reference_latch(self):
+        """
+        RAMP_STAT の status_latch_l と event_stop_l をクリアする（1 の書き込みでクリア）。
+        """
+        with self._lock:
+            self._tmc5240.write_register(
+                REG_RAMP_STAT, RAMP_STAT_STATUS_LATCH_L | RAMP_STAT_EVENT_STOP_L
+            )
+            self._status = None
+        metrics.REGISTER_WRITES.inc()
+        return self
+
+    def read_latch(self) -> int:
+        """
+        リミットスイッチを検出したときの XACTUAL（XLATCH）を読み出す。
+        """
+        values, _ = self._read_registers((REG_XLATCH,))
+        return _to_signed(values[REG_XLATCH], 32)
+
+    def _write_register(self, addr: int, value: int) -> bool:
+        """
+        シャドウと値が異なる場合のみレジスタに書き込む。
+        書き込んだ場合はステータスのキャッシュを破棄する（指令後の状態を読み出すため）。
+
+        :return: 書き込みを行った場合は True
+        """
+        with self._lock:
+            if self._registers.get(addr) == value:
+                return False
+            self._tmc5240.write_register(addr, value)
+            self._registers[addr] = value
+            self._status = None
+        metrics.REGISTER_WRITES.inc()
+        return True
+
+    def _read_registers(self, addrs) -> tuple[dict, int]:
+        """
+        複数のレジスタをパイプラインで読み出す。
+
+        TMC5240 は直前の読み出し要求に対する値を次の転送で返すため、
+        N 個のレジスタを N+1 回の転送で読み出せる。
+
+        :return: ({アドレス: 値}, 最後に受信したステータスバイト)
+        """
+        spi = self._tmc5240.spi
+        values = {}
+        prev = None
+        data = None
+        with self._lock:
+            self._tmc5240.select_board()
+            for addr in (*addrs, addrs[-1]):
+                data = spi.xfer3([addr, 0, 0, 0, 0])
+                if prev is not None:
+                    values[prev] = (
+                        (data[1] << 24) | (data[2] << 16) | (data[3] << 8) | data[4]
+                    )
+                prev = addr
+        metrics.REGISTER_READS.inc(len(addrs))
+        return values, data[0]
+
+    def status(self, max_age: float = None) -> MotorStatus:
+        """
+        ステータスのスナップショットを返す。
+
+        キャッシュが max_age 秒以内であれば SPI 通信を行わずにキャッシュを返す。
+
+        :param max_age: キャッシュの最大経過時間（秒）。省略時はコンストラクタの設定値
+        """
+        if max_age is None:
+            max_age = self._status_max_age
+        status = self._status
+        now = self._clock()
+        if status is not None and now - status.timestamp <= max_age:
+            return status
+
+        registers, spi_status = self._read_registers(STATUS_REGISTERS)
+        status = MotorStatus(registers, spi_status, now, self._tmc5240.v2rpm)
+        self._status = status
+
+        callback = self._reference_callback
+        if callback is not None:
+            active = status.status_stop_l
+            if active != self._reference_active:
+                self._reference_active = active
+                callback(active)
+        return status
+
+    def compile_schedule(
+        self, sample_interval_secondes: float, microstep_ratio: float, diffs
+    ) -> "MotorSchedule":
+        """
+        移動量の列をこのドライバー用の速度スケジュールに変換する。
+        """
+        return compile_motor_schedule(
+            sample_interval_secondes,
+            microstep_ratio,
+            diffs,
+            steps_per_rev=self._tmc5240.steps_per_rev,
+            fclk=self._tmc5240.fclk,
+        )
+
+    def invalidate_registers(self):
+        """
+        レジスタのシャドウを破棄する。ドライバーがリセットされた場合に呼び出す。
+        """
+        self._registers.clear()
+        self._status = None
         return self
 
     def set_rampmode(self, rampmode):
-        if self._rampmode != rampmode:
-            self._tmc5240.rampmode = rampmode
+        # RAMPMODE レジスタは下位2ビット以外が未使用のため読み出さずに書き込む
+        with self._lock:
+            self._write_register(REG_RAMPMODE, rampmode)
             self._rampmode = rampmode
         return self
 
+    def set_velocity(self, vmax: int, rampmode):
+        """
+        速度制御モードで VMAX と回転方向を設定する。
+
+        方向と速度が共に変わる場合のみ HOLD を経由し、旧方向へ新しい速度で
+        加速しないようにする。変化のないレジスタには書き込まない。
+
+        :param vmax: TMC5240 の速度 (VMAX)
+        :param rampmode: RAMPMODE_VELOCITY_POSITIVE または RAMPMODE_VELOCITY_NEGATIVE
+        """
+        if not self.is_poweron():
+            raise MotorNotEnabledError()
+        with self._lock:
+            if self._estop:
+                return self
+            if self._rampmode != rampmode and self._registers.get(REG_VMAX) != vmax:
+                self.set_rampmode(TMC5240.RAMPMODE_HOLD)
+            self._write_register(REG_VMAX, vmax)
+            self.set_rampmode(rampmode)
+        return self
+
     def set_reference_point(self):
-        if self.is_running():
-            raise MotorRunningError()
-        self._tmc5240.xactual = 0
+        return self.set_position(0)
+
+    def set_position(self, xactual: int):
+        """
+        停止中の現在位置を XACTUAL に設定する（保存した位置の復元など）。
+        """
+        with self._lock:
+            if self.is_running():
+                raise MotorRunningError()
+            self._tmc5240.xactual = xactual
+            self._status = None
         return self
 
     def move_target(self, target: int, rpm: float = MOTER_DEFAULT_SPEED):
         if not self.is_poweron():
             raise MotorNotEnabledError()
-        if self.is_running():
-            raise MotorRunningError()
-
-        self.set_rampmode(TMC5240.RAMPMODE_POSITIONING)  # 速度制御モード (位置制御)
-        self._tmc5240.xtarget = target
-        self._tmc5240.vmax_rpm = rpm
+        with self._lock:
+            if self.is_running():
+                raise MotorRunningError()
+            if self._estop:
+                return self
+
+            self.set_rampmode(TMC5240.RAMPMODE_POSITIONING)  # 速度制御モード (位置制御)
+            self._write_register(REG_XTARGET, target)
+            self._write_register(REG_VMAX, self._tmc5240.rpm2v(rpm))
         return self
 
     def rotate(self, rpm: float = MOTER_DEFAULT_SPEED):
-        if not self.is_poweron():
-            raise MotorNotEnabledError()
-        self.set_rampmode(TMC5240.RAMPMODE_HOLD)
-        self._tmc5240.vmax_rpm = rpm
-        self.set_rampmode(TMC5240.RAMPMODE_VELOCITY_POSITIVE)
+        self.set_velocity(
+            self._tmc5240.rpm2v(rpm), TMC5240.RAMPMODE_VELOCITY_POSITIVE
+        )
 
     def rotate_backwards(self, rpm: float = MOTER_DEFAULT_SPEED):
-        if not self.is_poweron():
-            raise MotorNotEnabledError()
-        self.set_rampmode(TMC5240.RAMPMODE_HOLD)
-        self._tmc5240.vmax_rpm = rpm
-        self.set_rampmode(TMC5240.RAMPMODE_VELOCITY_NEGATIVE)
+        self.set_velocity(
+            self._tmc5240.rpm2v(rpm), TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+        )
 
     def stop(self):
-        self._tmc5240.vmax = 0
+        self._write_register(REG_VMAX, 0)
+
+    def is_running(self, max_age: float = None):
+        return self.status(max_age).is_running()
+
+    def predict_remaining_time(self, condition, status: MotorStatus) -> float:
+        """
+        AMAX/DMAX から条件が成立するまでの残り時間を予測する。
+
+        :param condition: RAMP_STAT のビットマスク（RAMP_STAT_VZERO など）
+        :param status: 現在のステータス
+        :return: 予測残り時間（秒）。予測できない場合は None
+        """
+        tmc = self._tmc5240
+        # 速度 (usteps/s) と加速度 (usteps/s²) の単位
+        v_unit = tmc.fclk / 2**24
+        a_unit = tmc.fclk**2 / 2**41
+
+        v = abs(status.vactual) * v_unit
+        amax = self._amax * a_unit
+        if self._rampmode == TMC5240.RAMPMODE_POSITIONING:
+            dmax = self._dmax * a_unit
+        else:
+            # 速度制御モードでは AMAX で減速する
+            dmax = amax
+
+        if condition == RAMP_STAT_VZERO:
+            if dmax <= 0:
+                return None
+            return v / dmax
+
+        if condition == RAMP_STAT_POSITION_REACHED:
+            if self._rampmode != TMC5240.RAMPMODE_POSITIONING:
+                return None
+            if amax <= 0 or dmax <= 0:
+                return None
+            distance = abs(status.xtarget - status.xactual)
+            vmax = status.vmax * v_unit
+            braking = v * v / (2 * dmax)
+            if distance <= braking or vmax <= v:
+                # 減速中または最大速度で移動中
+                if v <= 0:
+                    return 0.0
+                return max(distance - braking, 0.0) / v + v / dmax
+            # 最大速度まで加速してから減速する（台形）
+            t_acc = (vmax - v) / amax
+            d_acc = (v + vmax) / 2 * t_acc
+            d_dec = vmax * vmax / (2 * dmax)
+            if d_acc + d_dec <= distance:
+                return t_acc + (distance - d_acc - d_dec) / vmax + vmax / dmax
+            # 最大速度に達しない（三角形）
+            vpeak = ((2 * amax * dmax * distance + dmax * v * v) / (amax + dmax)) ** 0.5
+            return (vpeak - v) / amax + vpeak / dmax
+
+        return None
+
+    def poll_interval(self, condition, status: MotorStatus) -> float:
+        """
+        条件の確認を次に行うまでの間隔を、予測残り時間から
+        WAIT_POLL_INTERVAL_MIN から WAIT_POLL_INTERVAL_MAX の範囲で決める。
+
+        :param condition: RAMP_STAT のビットマスク、または MotorStatus を受け取る関数
+        :param status: 現在のステータス
+        """
+        if callable(condition):
+            return WAIT_POLL_INTERVAL_MAX
+        remaining = self.predict_remaining_time(condition, status)
+        if remaining is None:
+            return WAIT_POLL_INTERVAL_MAX
+        return min(max(remaining, WAIT_POLL_INTERVAL_MIN), WAIT_POLL_INTERVAL_MAX)
+
+    def wait_until(
+        self,
+        condition,
+        timeout: float = None,
+        stop_event: Event = None,
+    ) -> bool:
+        """
+        RAMP_STAT の条件が成立するまで待機する。
+
+        ポーリング間隔は AMAX/DMAX から予測した残り時間に合わせて
+        WAIT_POLL_INTERVAL_MIN から WAIT_POLL_INTERVAL_MAX の範囲で決める。
+
+        :param condition: RAMP_STAT のビットマスク、または MotorStatus を受け取る関数
+        :param timeout: タイムアウト（秒）。None の場合は無期限
+        :param stop_event: セットされたら待機を中断するイベント
+        :return: 条件が成立した場合は True、タイムアウトまたは中断の場合は False
+        """
+        if callable(condition):
+            is_satisfied = condition
+        else:
+            def is_satisfied(status):
+                return status.ramp_stat & condition == condition
 
-    def is_running(self):
-        return self._tmc5240.vactual != 0
+        time_limit = None
+        if timeout is not None:
+            time_limit = time.monotonic() + timeout
+
+        while True:
+            status = self.status(0)
+            if is_satisfied(status):
+                return True
 
+            interval = self.poll_interval(condition, status)
+            if time_limit is not None:
+                time_remaining = time_limit - time.monotonic()
+                if time_remaining <= 0:
+                    return False
+                interval = min(interval, time_remaining)
 
-def calculate_motor_rpm(
+            if stop_event is None:
+                time.sleep(interval)
+            elif stop_event.wait(interval):
+                return False
+
+
+class MotorSchedule:
+    """
+    サンプルごとの VMAX と RAMPMODE を事前計算した速度スケジュール。
+
+    :param vmax: 各サンプルの VMAX（int32 の ndarray）
+    :param rampmode: 各サンプルの RAMPMODE（int8 の ndarray）
+    """
+
+    def __init__(self, vmax: "np.ndarray", rampmode: "np.ndarray"):
+        self.vmax = vmax
+        self.rampmode = rampmode
+
+    def __len__(self):
+        return len(self.vmax)
+
+    def __iter__(self):
+        # memoryview 経由で Python の int として取り出す
+        return zip(memoryview(self.vmax), memoryview(self.rampmode))
+
+    def segments(self, max_length: int = 0) -> "SegmentSchedule":
+        """
+        同じ VMAX と RAMPMODE が連続するサンプルを1つのセグメントにまとめる。
+
+        :param max_length: セグメントの最大サンプル数（0 の場合は制限しない）
+        :return: セグメント単位の速度スケジュール
+        """
+        import numpy as np
+
+        n = len(self.vmax)
+        if n == 0:
+            empty = np.zeros(0, dtype=np.int32)
+            return SegmentSchedule(empty, empty.astype(np.int8), empty, empty)
+
+        changed = np.empty(n, dtype=bool)
+        changed[0] = True
+        np.not_equal(self.vmax[1:], self.vmax[:-1], out=changed[1:])
+        changed[1:] |= self.rampmode[1:] != self.rampmode[:-1]
+        start = np.flatnonzero(changed)
+        count = np.diff(start, append=n)
+
+        if 0 < max_length and max_length < count.max():
+            # 長いセグメントを max_length ごとに分割する
+            parts = -(-count // max_length)
+            index = np.repeat(np.arange(len(start)), parts)
+            offset = np.arange(parts.sum()) - np.repeat(np.cumsum(parts) - parts, parts)
+            offset *= max_length
+            start = start[index] + offset
+            count = np.minimum(count[index] - offset, max_length)
+
+        return SegmentSchedule(
+            self.vmax[start],
+            self.rampmode[start],
+            start.astype(np.int32),
+            count.astype(np.int32),
+        )
+
+
+class SegmentSchedule:
+    """
+    同じ指令が続くサンプルをまとめた (VMAX, RAMPMODE, 開始サンプル, サンプル数) の
+    速度スケジュール。
+
+    :param vmax: 各セグメントの VMAX（int32 の ndarray）
+    :param rampmode: 各セグメントの RAMPMODE（int8 の ndarray）
+    :param start: 各セグメントの開始サンプル番号（int32 の ndarray）
+    :param count: 各セグメントのサンプル数（int32 の ndarray）
+    """
+
+    def __init__(
+        self,
+        vmax: "np.ndarray",
+        rampmode: "np.ndarray",
+        start: "np.ndarray",
+        count: "np.ndarray",
+    ):
+        self.vmax = vmax
+        self.rampmode = rampmode
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return len(self.vmax)
+
+    @property
+    def samples(self):
+        """
+        セグメント全体のサンプル数
+        """
+        return int(self.count.sum())
+
+    def __iter__(self):
+        return zip(
+            memoryview(self.vmax),
+            memoryview(self.rampmode),
+            memoryview(self.start),
+            memoryview(self.count),
+        )
+
+
+def compile_motor_schedule(
     sample_interval_secondes: float,
     microstep_ratio: float,
-    movements: list[float, float],
+    diffs,
     steps_per_rev: float = 200,
-):
+    fclk: int = 12500000,
+) -> MotorSchedule:
     """
-    各時間点でのモーターの回転速度をRPMで計算する。
+    各サンプルの移動量から VMAX と回転方向を一括で計算する。
+
+    RPM を小数点以下2桁に丸めた後（従来のサンプルごとの RPM 計算と同じ）、
+    TMC5240.rpm2v と同じ式で VMAX に変換する。
 
     :param sample_interval_secondes: サンプル間隔（秒）
     :param microstep_ratio: マイクロステップ倍率
-    :param movements: 移動量のリスト（各サンプルでの±移動量）
+    :param diffs: 各サンプルでの±移動量の列（array('i') や memoryview など）
     :param steps_per_rev: モーターの一回転あたりのステップ数（フルステップ）
-    :return: 各サンプルでのモーターの回転速度（RPM）のリスト
-    """
-    rpms = []  # RPMを格納するリスト
-    index = 0
-    rpm_sum = 0
-
-    logger.info(f"sample_interval_secondes:{sample_interval_secondes:.3f}.")
-    logger.info(f"microstep_ratio:{microstep_ratio:.3f}.")
-    logger.info(f"steps_per_rev:{steps_per_rev:.3f}.")
-
-    for movement in movements:
-        val = 0
-        if 1 < len(movement):
-            val = movement[1]
-        # ステップ/サンプル間隔（秒）
-        speed_steps_per_sample_interval = val * microstep_ratio
-        # ステップ/秒
-        speed_steps_per_second = (
-            speed_steps_per_sample_interval / sample_interval_secondes
-        )
+    :param fclk: TMC5240 のクロック周波数（Hz）
+    :return: 速度スケジュール
+    """
+    logger.debug(f"sample_interval_secondes:{sample_interval_secondes:.3f}.")
+    logger.debug(f"microstep_ratio:{microstep_ratio:.3f}.")
+    logger.debug(f"steps_per_rev:{steps_per_rev:.3f}.")
 
-        rpm = (speed_steps_per_second * 60) / steps_per_rev
-        rpm = round(rpm, 2)
-        rpms.append(rpm)
-        rpm_sum += rpm
+    # NumPy は起動を速くするため変換時に読み込む
+    import numpy as np
 
-        if index < 100:
-            logger.debug(
-                f"[{index:2}]val:{val:3} rpm:{rpm:10,.3f}. speed_steps_per_second:{speed_steps_per_second:10,.3f}"
-            )
-        index += 1
+    diffs = np.asarray(diffs)
+
+    # ステップ/秒
+    speed_steps_per_second = diffs * microstep_ratio / sample_interval_secondes
+    rpms = np.round((speed_steps_per_second * 60) / steps_per_rev, 2)
+
+    vmax = np.rint(np.abs(rpms) / 60 * steps_per_rev * 256 / fclk * 2**24)
+    rampmode = np.where(
+        rpms < 0,
+        TMC5240.RAMPMODE_VELOCITY_NEGATIVE,
+        TMC5240.RAMPMODE_VELOCITY_POSITIVE,
+    )
 
-    logger.info(f"len:{len(rpms)} sum:{rpm_sum}")
+    logger.debug(f"len:{len(rpms)} sum:{rpms.sum()}")
 
-    return rpms
+    return MotorSchedule(vmax.astype(np.int32), rampmode.astype(np.int8))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,413 @@
+"""
+asyncio のイベントループでデバイスを制御するランタイム（DEVICE_RUNTIME = "asyncio"）。
+
+スイッチのエッジは pigpio やディスパッチャーのスレッドから DeviceRuntime.post で
+イベントループへ渡す。ホーミング・オフセット移動・再生は ApneaPlayer の手順
+（*_steps）をイベントループ上で実行し、停止スイッチでタスクをキャンセルする。
+"""
+import asyncio
+from logging import getLogger
+import pigpio
+import time
+
+from constant import *
+
+import device
+import startup
+from apnea.demo import ApneaAxis, ApneaPlayer, StopEvent
+from logutil import StatusField
+from motor import RAMP_STAT_VZERO
+from state import consume_state
+from switch import Switch
+
+logger = getLogger(__name__)
+
+
+class DeviceRuntime:
+    """
+    ApneaPlayer の手順をイベントループ上で実行する。
+
+    このクラスはイベントの受け渡しとキャンセルのみを扱い、手順は制御スレッドと
+    共通の ApneaPlayer.*_steps を使用する。
+
+    イベントは post(名前, 引数...) で任意のスレッドから送り、add_handler で登録した
+    ハンドラがイベントループ上で呼び出される。ハンドラがコルーチンを返す場合は
+    タスクとして実行する。
+
+    :param player: 制御する軸を持つプレーヤー（スレッドは使用しない）
+    :param loop: イベントループ
+    """
+
+    def __init__(self, player: ApneaPlayer, loop: asyncio.AbstractEventLoop):
+        self._player = player
+        self._loop = loop
+        # 基準点到達、一時停止と再開の要求で手順を起床させる
+        self._wake = asyncio.Event()
+        self._shutdown = asyncio.Event()
+        self._demo_task = None
+        self._handlers = {}
+
+        self.add_handler("start", self._on_start)
+        self.add_handler("stop", self._on_stop)
+        self.add_handler("limit", self._on_limit)
+        self.add_handler("pause", self._on_pause)
+        self.add_handler("resume", self._on_resume)
+        self.add_handler("select", self._on_select)
+        self.add_handler("shutdown", self._on_shutdown)
+
+    @property
+    def player(self):
+        return self._player
+
+    @property
+    def demo_task(self) -> asyncio.Task:
+        return self._demo_task
+
+    def add_handler(self, name: str, handler) -> None:
+        """
+        イベント name のハンドラを登録する。
+        """
+        self._handlers[name] = handler
+
+    def post(self, name: str, *args) -> None:
+        """
+        イベントをイベントループへ送る。任意のスレッドから呼び出せる。
+        """
+        self._loop.call_soon_threadsafe(self._dispatch, name, args)
+
+    def switch_callback(self, name: str, *args):
+        """
+        スイッチのエッジを (name, *args, level) のイベントとして送る Switch.callback を作成する。
+        """
+
+        def cbf(gpio, level, tick):
+            logger.info(f"{name} sw gpio:{gpio}, level:{level}, tick:{tick}")
+            self.post(name, *args, level)
+
+        return cbf
+
+    def reference_switch_callback(self, axis: int):
+        """
+        REFL のリミットスイッチの状態の変化を limit イベントとして送る
+        MotorController.enable_reference_switch のコールバックを作成する。
+        """
+
+        def cbf(active: bool):
+            logger.info(f"limit sw REFL active:{active}, axis:{axis}")
+            self.post("limit", axis, pigpio.LOW if active else pigpio.HIGH)
+
+        return cbf
+
+    def select_command(self, name: str = None):
+        """
+        制御 API の select コマンド。名前を確認してから select イベントを送る。
+        """
+        library = self._player.library
+        if library is None:
+            return False
+        if name is not None and name not in library.names():
+            raise KeyError(name)
+        self.post("select", name)
+
+    def emergency_stop_callback(self):
+        """
+        スイッチの最初のエッジで全軸に VMAX=0 を書き込み、stop イベントを送る
+        Switch.edge_callback を作成する。pigpio のコールバックスレッドで呼び出される。
+        """
+
+        def cbf(gpio, level, tick):
+            time_edge = time.monotonic()
+            latencies = self._player.emergency_stop(time_edge)
+            if not latencies:
+                # 基準点へ戻っている間、またはラッチ済み（チャタリングなど）
+                return
+            self.post("stop")
+            device.log_emergency_stop(gpio, tick, latencies)
+
+        return cbf
+
+    def _dispatch(self, name, args):
+        handler = self._handlers.get(name)
+        if handler is None:
+            logger.warning(f"Unknown event: {name}")
+            return
+        try:
+            result = handler(*args)
+        except Exception:
+            logger.exception(f"Event handler error: {name}")
+            return
+        if asyncio.iscoroutine(result):
+            self._loop.create_task(result)
+
+    async def run(self) -> None:
+        """
+        shutdown イベントまで待機する。終了時（キャンセル時を含む）にデモを停止する。
+        """
+        try:
+            await self._shutdown.wait()
+        finally:
+            await self.stop_demo()
+
+    ##############################################
+    # イベントハンドラ
+
+    def _on_start(self, *args):
+        if self._demo_task is not None and not self._demo_task.done():
+            return
+        self._demo_task = self._loop.create_task(self.demo())
+        self._demo_task.add_done_callback(self._demo_done)
+
+    def _demo_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error("Apnea demo failed.", exc_info=task.exception())
+
+    def _on_stop(self, *args):
+        if self._demo_task is not None:
+            self._demo_task.cancel()
+
+    def _on_pause(self, *args):
+        # 再生中の手順を起床させ、モーターを停止する
+        if self._player.pause():
+            self._wake.set()
+
+    def _on_resume(self, *args):
+        if self._player.resume():
+            self._wake.set()
+
+    def _on_select(self, name: str = None):
+        # 再生中は次の開始時に読み込みと変換を行う
+        playing = self._demo_task is not None and not self._demo_task.done()
+        self._player.select_profile(name, prepare=not playing)
+
+    def _on_shutdown(self, *args):
+        self._shutdown.set()
+
+    def _on_limit(self, axis: int, level):
+        if level == pigpio.HIGH:
+            self._player.moved_away_reference_point(axis)
+            return
+        # 再生中の逆方向の指令は起床した手順が止める
+        self._player.reached_reference_point(axis)
+        self._wake.set()
+
+    async def stop_demo(self) -> None:
+        """
+        デモのタスクをキャンセルし、基準点への移動と電源断が終わるまで待機する。
+        """
+        task = self._demo_task
+        if task is None or task.done():
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    ##############################################
+    # コルーチン
+
+    async def drive(self, steps):
+        """
+        ApneaPlayer の手順（ジェネレーター）をイベントループ上で最後まで実行する。
+
+        手順が返す時刻（time.monotonic）まで、または None の場合はイベントまで待機する。
+        タスクのキャンセルは停止要求として手順へ StopEvent を送る。手順が StopEvent を
+        処理しない場合はキャンセルされたまま終了する。
+
+        :param steps: ApneaPlayer.*_steps が返すジェネレーター
+        :return: 手順の戻り値
+        """
+        try:
+            wait = next(steps)
+            while True:
+                try:
+                    await self._wait(wait)
+                except asyncio.CancelledError:
+                    asyncio.current_task().uncancel()
+                    try:
+                        wait = steps.throw(StopEvent())
+                    except StopEvent:
+                        raise asyncio.CancelledError() from None
+                    continue
+                wait = next(steps)
+        except StopIteration as e:
+            return e.value
+
+    async def _wait(self, wait: float) -> None:
+        # 時刻 wait まで、または基準点到達などのイベントまで待機する
+        if wait is None:
+            self._wake.clear()
+            await self._wake.wait()
+            return
+        delay = wait - time.monotonic()
+        if delay <= 0:
+            return
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def demo(self) -> None:
+        """
+        ホーミング、オフセット移動、初期位置への移動の後、停止要求まで再生する
+        （ApneaPlayer.demo_steps）。
+        """
+        try:
+            await self.drive(self._player.demo_steps())
+        finally:
+            try:
+                # ファイルの書き出しでイベントループを止めない
+                await asyncio.to_thread(self._player.dump_telemetry)
+            finally:
+                self._player.publish_status("idle")
+
+    async def home(self, axes: list[ApneaAxis] = None) -> None:
+        """
+        すべての軸を同時に基準点へ移動し、現在位置を基準点に設定する。
+        基準点の位置がわかっている軸は手前まで高速に移動してから低速で近づく。
+        """
+        await self.drive(self._player.homing_steps(axes))
+
+    async def release_limit_switch(self, axis: ApneaAxis, is_pressed) -> None:
+        """
+        リミットスイッチが押されている場合、モーターを回転させてリミットスイッチを離す。
+
+        :param is_pressed: リミットスイッチが押されているかを返す関数
+        """
+        await self.drive(self._player.release_steps(axis, is_pressed))
+
+    async def wait_motor(self, axis: ApneaAxis, condition) -> bool:
+        """
+        モーターの状態が condition になるまで待機する。
+
+        :return: 条件が成立した場合は True、タイムアウトの場合は False
+        """
+        return await self.drive(
+            self._player.wait_motor_steps(axis.motorController, condition)
+        )
+
+
+async def main() -> None:
+    player, limit_pins = device.create_player()
+    runtime = DeviceRuntime(player, asyncio.get_running_loop())
+    try:
+        for axis in player.axes:
+            axis.motorController.poweron()
+            logger.info(
+                "[%s] Motor enabled. xtarget:%s",
+                axis.name,
+                StatusField(axis.motorController, "xtarget"),
+            )
+        for axis in player.axes:
+            if not await runtime.wait_motor(axis, RAMP_STAT_VZERO):
+                logger.error(f"[{axis.name}] Motor controller is running.")
+        # 前回の終了時の位置を復元する
+        player.restore_position_state(consume_state())
+        startup.phase("poweron")
+
+        pi = pigpio.pi()
+        dispatcher, switch_options, button_options = device.create_switch_options()
+        switches = []
+        try:
+            ########################################################
+            # リミットスイッチの設定（軸ごと）
+            limit_pressed = []
+            for index, (axis, pin) in enumerate(zip(player.axes, limit_pins)):
+                motorController = axis.motorController
+                if LIMIT_SW_MODE == "refl":
+                    # ドライバーが REFL で停止し、状態はステータスの読み出しで反映する
+                    motorController.enable_reference_switch(
+                        runtime.reference_switch_callback(index)
+                    )
+                    active = motorController.status(0).status_stop_l
+                    logger.info(f"[{axis.name}] limit sw(REFL) active:{active}")
+                    runtime._on_limit(index, pigpio.LOW if active else pigpio.HIGH)
+                    limit_pressed.append(
+                        lambda motorController=motorController: (
+                            motorController.status(0).status_stop_l
+                        )
+                    )
+                    continue
+                limit_sw = Switch(pin, pi, edge=pigpio.EITHER_EDGE, **switch_options)
+                switches.append(limit_sw)
+                logger.info(f"[{axis.name}] limit sw({limit_sw.pin}) level:{limit_sw.level}")
+                limit_sw.callback = runtime.switch_callback("limit", index)
+                runtime._on_limit(index, limit_sw.level)
+                limit_pressed.append(lambda limit_sw=limit_sw: limit_sw.level == pigpio.LOW)
+
+            # リミットスイッチの状態を確認（位置を復元した軸は基準点で停止している）
+            for axis, is_pressed in zip(player.axes, limit_pressed):
+                if is_pressed() and axis.reference_offset is None:
+                    await runtime.release_limit_switch(axis, is_pressed)
+            startup.phase("switches")
+
+            # モーターの位置を基準点に移動
+            await runtime.home()
+            startup.phase("homing")
+
+            ########################################################
+            # スタート・ストップスイッチの設定
+            if player.library is None:
+                start_sw = Switch(START_SW_PIN, pi, edge=pigpio.RISING_EDGE, **button_options)
+                start_sw.callback = runtime.switch_callback("start")
+            else:
+                # 長押しで次のプロファイルを選択する
+                start_sw = Switch(START_SW_PIN, pi, edge=pigpio.EITHER_EDGE, **button_options)
+                start_sw.callback = device.press_callback(
+                    lambda: runtime.post("start"), lambda: runtime.post("select")
+                )
+            switches.append(start_sw)
+            logger.info(f"start sw({start_sw.pin}) level:{start_sw.level}")
+
+            stop_sw = Switch(STOP_SW_PIN, pi, edge=pigpio.RISING_EDGE, **button_options)
+            switches.append(stop_sw)
+            if STOP_SW_EMERGENCY:
+                # 停止は最初のエッジで要求する（デバウンス後の通知で基準点への戻りを中断しない）
+                stop_sw.edge_callback = runtime.emergency_stop_callback()
+            else:
+                stop_sw.callback = runtime.switch_callback("stop")
+            logger.info(f"stop sw({stop_sw.pin}) level:{stop_sw.level}")
+
+            ########################################################
+            # 制御 API（コマンドはイベントとして送る）
+            control = device.create_control_server(
+                player,
+                {
+                    "start": lambda: runtime.post("start"),
+                    "stop": lambda: runtime.post("stop"),
+                    "pause": lambda: runtime.post("pause"),
+                    "resume": lambda: runtime.post("resume"),
+                    "select": runtime.select_command,
+                },
+            ).start()
+            startup.report()
+
+            ########################################################
+            # メインループ
+            try:
+                await runtime.run()
+            finally:
+                control.stop()
+        finally:
+            for switch in reversed(switches):
+                switch.cancel()
+            if dispatcher is not None:
+                dispatcher.stop()
+            pi.stop()
+    finally:
+        await runtime.stop_demo()
+        device.save_position_state(player)
+        if player.library is not None:
+            player.library.stop_watch()
+        for axis in player.axes:
+            if axis.motorController.is_poweron():
+                axis.motorController.poweroff()
+                logger.info(f"[{axis.name}] motor power off.")
+        logger.info("device stopped.")
+
+
+def start():
+    asyncio.run(main())
@@ -0,0 +1,161 @@
+import time
+from threading import Event
+
+from logging import getLogger
+
+# create logger
+logger = getLogger(__name__)
+
+
+class VirtualClock:
+    """
+    sleep で時刻を進める仮想時計。
+
+    DeadlineScheduler とシミュレーターに同じ時計を渡すと、実時間を待たずに
+    実時間と同じ期限の判断と指令の列を再現できる。
+
+    :param start: 開始時刻（秒）
+    """
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+
+    def now(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        if 0 < seconds:
+            self._now += seconds
+
+
+class DeadlineScheduler:
+    """
+    単調増加時計上の絶対期限までスリープする周期スケジューラ。
+
+    期限は ``開始時刻 + サンプル番号 × 間隔`` で求めるため、誤差が累積しない。
+    待機中は ``wake_event`` がセットされた場合のみ早期に起床する。
+
+    :param interval: サンプリング間隔（秒）
+    :param wake_event: 早期起床用のイベント（停止要求など）
+    :param clock: 単調増加時計（秒）
+    :param sleep: clock の時間で待機する関数（None の場合は実時間で待機する）。
+                  指定した場合、wake_event は待機の後に確認する
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        wake_event: Event = None,
+        clock=time.monotonic,
+        sleep=None,
+    ):
+        self._interval = interval
+        self._wake_event = wake_event
+        self._clock = clock
+        self._sleep = sleep
+
+        self._time_start = 0.0
+        self._index = 0
+        # 直近サンプルの遅れ（秒）
+        self._lateness = 0.0
+        # 期限から1間隔以上遅れたサンプル数
+        self._overruns = 0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def time_start(self):
+        return self._time_start
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def lateness(self):
+        return self._lateness
+
+    @property
+    def overruns(self):
+        return self._overruns
+
+    @property
+    def deadline(self):
+        return self._time_start + self._index * self._interval
+
+    def now(self) -> float:
+        return self._clock()
+
+    def start(self, time_start: float = None):
+        """
+        スケジュールを開始する。最初の期限は開始時刻から1間隔後。
+        """
+        if time_start is None:
+            time_start = self._clock()
+        self._time_start = time_start
+        self._index = 1
+        self._lateness = 0.0
+        self._overruns = 0
+        return self
+
+    def sleep_until(self, deadline: float) -> bool:
+        """
+        絶対期限までスリープする。
+
+        :return: 期限に達した場合は True、wake_event で起床した場合は False
+        """
+        while True:
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                return True
+            if self._sleep is not None:
+                self._sleep(remaining)
+                if self._wake_event is not None and self._wake_event.is_set():
+                    return False
+            elif self._wake_event is None:
+                time.sleep(remaining)
+            elif self._wake_event.wait(remaining):
+                return False
+
+    def wait(self, count: int = 1) -> bool:
+        """
+        count サンプル先の期限まで待機する。
+
+        期限に達した場合は遅れを記録してサンプル番号を count 進める。
+        wake_event で起床した場合はサンプル番号を進めずに戻る。
+
+        :param count: 待機するサンプル数（同じ指令が続くセグメントの長さ）
+        :return: 期限に達した場合は True、wake_event で起床した場合は False
+        """
+        deadline = self._time_start + (self._index + count - 1) * self._interval
+        if not self.wait_until(deadline):
+            return False
+        self._index += count
+        return True
+
+    def wait_until(self, deadline: float) -> bool:
+        """
+        絶対期限まで待機し、期限に達した場合は遅れを記録する。
+
+        サンプル番号は進めないため、複数の軸の期限を呼び出し側で管理する場合に使用する。
+
+        :return: 期限に達した場合は True、wake_event で起床した場合は False
+        """
+        if not self.sleep_until(deadline):
+            return False
+        self.record(deadline)
+        return True
+
+    def record(self, deadline: float) -> float:
+        """
+        期限に対する現在の遅れを記録する。スリープを呼び出し側で行う場合
+        （asyncio など）に使用する。
+
+        :return: 遅れ（秒）
+        """
+        self._lateness = self._clock() - deadline
+        if self._interval <= self._lateness:
+            self._overruns += 1
+        return self._lateness
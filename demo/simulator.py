@@ -0,0 +1,402 @@
+from cgstep import TMC5240
+from collections import Counter
+from logging import getLogger
+import math
+import time
+
+# create logger
+logger = getLogger(__name__)
+
+# レジスタアドレス
+_REG_RAMPMODE = 0x20
+_REG_XACTUAL = 0x21
+_REG_VACTUAL = 0x22
+_REG_AMAX = 0x26
+_REG_VMAX = 0x27
+_REG_DMAX = 0x28
+_REG_XTARGET = 0x2D
+_REG_SW_MODE = 0x34
+_REG_RAMP_STAT = 0x35
+_REG_XLATCH = 0x36
+_REG_DRV_STATUS = 0x6F
+
+# リセット時のレジスタ値（未記載のレジスタは0）
+_RESET_REGISTERS = {
+    0x0A: 0x00000020,  # DRV_CONF
+    0x10: 0x00070A03,  # IHOLD_IRUN
+    0x6C: 0x10410150,  # CHOPCONF (TOFF=0)
+}
+
+# SW_MODE のビット
+_SW_MODE_STOP_L_ENABLE = 1 << 0
+_SW_MODE_LATCH_L_ACTIVE = 1 << 5
+_SW_MODE_EN_SOFTSTOP = 1 << 11
+
+# RAMP_STAT のイベントフラグ（1を書き込むとクリア）
+_RAMP_STAT_STATUS_LATCH_L = 1 << 2
+_RAMP_STAT_EVENT_STOP_L = 1 << 4
+
+# 位置制御の積分刻み（秒）
+_POSITIONING_STEP = 0.0005
+
+
+class SimulatedSpi:
+    """
+    spidev.SpiDev の代わりに SimulatedTMC5240 へ転送する SPI デバイス。
+    """
+
+    def __init__(self, device: "SimulatedTMC5240"):
+        self._device = device
+        self.max_speed_hz = 0
+        self.mode = 0
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer3(self, data):
+        return self._device.transfer(data)
+
+
+class SimulatedTMC5240(TMC5240):
+    """
+    SPI ハードウェアなしで動作する TMC5240 のシミュレーター。
+
+    SPI の40ビットデータグラム単位で TMC5240 を模擬する。読み出し値は次の転送で
+    返され、先頭バイトは SPI ステータスになる。ランプジェネレータは AMAX/DMAX/VMAX
+    に従って VACTUAL と XACTUAL を積分する（A1/V1/D1 などの6点ランプは扱わない）。
+    REFL のリミットスイッチは set_reference_switch で配置し、SW_MODE の停止と
+    XLATCH へのラッチを模擬する。
+
+    :param steps_per_rev: モーター1回転のフルステップ数
+    :param clock: 単調増加時計（秒）
+    """
+
+    def __init__(
+        self,
+        bus=0,
+        device=0,
+        board_id=None,
+        spi_speed_hz=1000000,
+        steps_per_rev=200,
+        clock=time.monotonic,
+    ):
+        # spidev を開かないため TMC5240.__init__ は呼び出さない
+        self.spi = SimulatedSpi(self)
+        self.spi.max_speed_hz = spi_speed_hz
+        self.spi.mode = 3
+        self.signed_position = True
+        self.board_id = board_id
+        self.steps_per_rev = steps_per_rev
+        self.fclk = 12500000
+
+        self._clock = clock
+        self._time = clock()
+        self._registers = dict(_RESET_REGISTERS)
+        # 直前の読み出し要求に対する応答値
+        self._read_data = 0
+
+        # 位置(usteps)と速度(usteps/s)
+        self._x = 0.0
+        self._v = 0.0
+
+        # REFL に接続したリミットスイッチの位置（None で接続なし）
+        self._reference = None
+        self._reference_active = False
+        # RAMP_STAT のイベントフラグ
+        self._events = 0
+
+        # レジスタアクセス数
+        self.transfers = 0
+        self.reads = Counter()
+        self.writes = Counter()
+
+    def select_board(self):
+        pass
+
+    def set_reference_switch(self, position: float = None):
+        """
+        REFL に接続したリミットスイッチの位置を設定する。XACTUAL がこの位置以下の
+        ときにスイッチが有効になる。
+
+        :param position: スイッチの位置（usteps、None で接続なし）
+        """
+        self._reference = position
+        self._reference_active = self._reference_switch()
+
+    def reset_counters(self):
+        self.transfers = 0
+        self.reads.clear()
+        self.writes.clear()
+
+    ##############################################
+    # SPI
+
+    def transfer(self, data):
+        """
+        40ビットのデータグラムを1回転送する。
+
+        :param data: [アドレス(書き込み時は0x80付き), データ(4バイト)]
+        :return: [SPIステータス, 直前の読み出し値(4バイト)]
+        """
+        self.update()
+        self.transfers += 1
+
+        response = [self._spi_status()]
+        for i in range(4):
+            response.append((self._read_data >> ((3 - i) * 8)) & 0xFF)
+
+        addr = data[0] & 0x7F
+        if data[0] & 0x80:
+            value = 0
+            for i in range(4):
+                value = (value << 8) | (data[i + 1] & 0xFF)
+            self.writes[addr] += 1
+            self._write(addr, value)
+        else:
+            self.reads[addr] += 1
+            self._read_data = self._read(addr)
+        return response
+
+    def _write(self, addr, value):
+        if addr == _REG_XACTUAL:
+            x = float(_to_signed(value, 32))
+            # 座標の変更に合わせてスイッチの位置も移す
+            if self._reference is not None:
+                self._reference += x - self._x
+            self._x = x
+        elif addr == _REG_RAMP_STAT:
+            # イベントフラグは1を書き込むとクリア（状態ビットは読み出し時に算出）
+            self._events &= ~value
+            return
+        self._registers[addr] = value
+
+    def _read(self, addr):
+        if addr == _REG_XACTUAL:
+            return round(self._x) & 0xFFFFFFFF
+        if addr == _REG_VACTUAL:
+            return self._vactual() & 0xFFFFFF
+        if addr == _REG_RAMP_STAT:
+            return self._ramp_stat()
+        if addr == _REG_XLATCH:
+            return self._registers.get(_REG_XLATCH, 0) & 0xFFFFFFFF
+        if addr == _REG_DRV_STATUS:
+            return self._drv_status()
+        return self._registers.get(addr, 0)
+
+    ##############################################
+    # ステータス
+
+    def _vactual(self):
+        return round(self._v / self._velocity_unit())
+
+    def _target_velocity(self):
+        mode = self._registers.get(_REG_RAMPMODE, 0) & 0x3
+        vmax = self._registers.get(_REG_VMAX, 0) * self._velocity_unit()
+        if mode == TMC5240.RAMPMODE_VELOCITY_POSITIVE:
+            return vmax
+        if mode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE:
+            # リミットスイッチが有効な間は負方向に動かない
+            return 0.0 if self._reference_stopped() else -vmax
+        if mode == TMC5240.RAMPMODE_HOLD:
+            return self._v
+        return None
+
+    def _position_reached(self):
+        mode = self._registers.get(_REG_RAMPMODE, 0) & 0x3
+        xtarget = _to_signed(self._registers.get(_REG_XTARGET, 0), 32)
+        return (
+            mode == TMC5240.RAMPMODE_POSITIONING
+            and self._v == 0
+            and round(self._x) == xtarget
+        )
+
+    def _ramp_stat(self):
+        target = self._target_velocity()
+        if target is None:
+            target = self._v if self._position_reached() else None
+        ramp_stat = self._events
+        if self._reference_active:
+            ramp_stat |= 1 << 0  # status_stop_l
+        if target is not None and self._vactual() == round(
+            target / self._velocity_unit()
+        ):
+            ramp_stat |= 1 << 8  # velocity_reached
+        if self._position_reached():
+            ramp_stat |= 1 << 9  # position_reached
+        if self._vactual() == 0:
+            ramp_stat |= 1 << 10  # vzero
+        return ramp_stat
+
+    def _drv_status(self):
+        drv_status = 0
+        if self._vactual() == 0:
+            drv_status |= 1 << 31  # stst
+        return drv_status
+
+    def _spi_status(self):
+        ramp_stat = self._ramp_stat()
+        status = 0
+        if self._vactual() == 0:
+            status |= 1 << 3  # standstill
+        if ramp_stat & (1 << 8):
+            status |= 1 << 4  # velocity_reached
+        if ramp_stat & (1 << 9):
+            status |= 1 << 5  # position_reached
+        return status
+
+    ##############################################
+    # ランプジェネレータ
+
+    def _velocity_unit(self):
+        """
+        速度レジスタ1あたりの速度 (usteps/s)
+        """
+        return self.fclk / 2**24
+
+    def _acceleration_unit(self):
+        """
+        加速度レジスタ1あたりの加速度 (usteps/s²)
+        """
+        return self.fclk**2 / 2**41
+
+    def update(self, now: float = None):
+        """
+        現在時刻までランプジェネレータを進める。
+        """
+        if now is None:
+            now = self._clock()
+        dt = now - self._time
+        if dt <= 0:
+            return
+        self._time = now
+
+        mode = self._registers.get(_REG_RAMPMODE, 0) & 0x3
+        if mode == TMC5240.RAMPMODE_POSITIONING:
+            while 0 < dt:
+                h = min(dt, _POSITIONING_STEP)
+                self._step_positioning(h)
+                self._update_reference_switch()
+                dt -= h
+        elif self._reference is not None:
+            # スイッチの検出位置で止まるように細かく積分する
+            while 0 < dt:
+                h = min(dt, _POSITIONING_STEP)
+                self._step_velocity(self._target_velocity(), h)
+                self._update_reference_switch()
+                dt -= h
+        else:
+            self._step_velocity(self._target_velocity(), dt)
+
+    def _reference_switch(self):
+        return self._reference is not None and self._x <= self._reference
+
+    def _reference_stopped(self):
+        """
+        リミットスイッチによる停止が有効で、スイッチが有効になっているか
+        """
+        sw_mode = self._registers.get(_REG_SW_MODE, 0)
+        return bool(sw_mode & _SW_MODE_STOP_L_ENABLE) and self._reference_active
+
+    def _update_reference_switch(self):
+        """
+        リミットスイッチの状態を更新し、検出時の位置のラッチと停止を行う。
+        """
+        active = self._reference_switch()
+        sw_mode = self._registers.get(_REG_SW_MODE, 0)
+        if active and not self._reference_active:
+            if sw_mode & _SW_MODE_LATCH_L_ACTIVE:
+                self._registers[_REG_XLATCH] = round(self._reference) & 0xFFFFFFFF
+                self._events |= _RAMP_STAT_STATUS_LATCH_L
+        self._reference_active = active
+        if not (active and sw_mode & _SW_MODE_STOP_L_ENABLE and self._v < 0):
+            return
+        self._events |= _RAMP_STAT_EVENT_STOP_L
+        if not sw_mode & _SW_MODE_EN_SOFTSTOP:
+            # ハードストップ：スイッチの位置で直ちに停止
+            self._x = float(self._reference)
+            self._v = 0.0
+
+    def _step_velocity(self, target, dt):
+        """
+        速度制御モードで dt 秒進める。目標速度まで AMAX で加減速する。
+        """
+        a = self._registers.get(_REG_AMAX, 0) * self._acceleration_unit()
+        dv = target - self._v
+        if dv == 0 or a <= 0:
+            self._x += self._v * dt
+            return
+
+        t_ramp = abs(dv) / a
+        a = math.copysign(a, dv)
+        if dt < t_ramp:
+            self._x += self._v * dt + a * dt * dt / 2
+            self._v += a * dt
+        else:
+            self._x += self._v * t_ramp + a * t_ramp * t_ramp / 2
+            self._v = target
+            self._x += self._v * (dt - t_ramp)
+
+    def _step_positioning(self, h):
+        """
+        位置制御モードで h 秒進める。XTARGET に向けて AMAX で加速し、
+        制動距離に入ったら DMAX で減速する。
+        """
+        amax = self._registers.get(_REG_AMAX, 0) * self._acceleration_unit()
+        dmax = self._registers.get(_REG_DMAX, 0) * self._acceleration_unit()
+        vmax = self._registers.get(_REG_VMAX, 0) * self._velocity_unit()
+        xtarget = _to_signed(self._registers.get(_REG_XTARGET, 0), 32)
+
+        distance = xtarget - self._x
+        if self._v == 0 and abs(distance) < 0.5:
+            return
+        if self._reference_stopped() and (self._v < 0 or (self._v == 0 and distance < 0)):
+            # リミットスイッチが有効な間は負方向に動かない（ソフトストップは DMAX で減速）
+            if self._v < 0 and 0 < dmax:
+                v = min(0.0, self._v + dmax * h)
+                self._x += (self._v + v) / 2 * h
+                self._v = v
+            else:
+                self._v = 0.0
+            return
+
+        direction = math.copysign(1.0, distance)
+        if 0 < dmax:
+            braking = self._v * self._v / (2 * dmax)
+        else:
+            braking = 0.0
+
+        if self._v * direction < 0 or vmax == 0:
+            # 逆方向に動いている、または VMAX=0 の場合は減速
+            target = 0.0
+            a = dmax
+        elif abs(distance) <= braking:
+            target = 0.0
+            a = dmax
+        else:
+            target = direction * vmax
+            a = amax if abs(self._v) < vmax else dmax
+
+        if a <= 0:
+            self._x += self._v * h
+            return
+
+        dv = target - self._v
+        step = math.copysign(min(abs(dv), a * h), dv)
+        v = self._v + step
+        x = self._x + (self._v + v) / 2 * h
+
+        # 目標位置を通過する場合は目標位置で停止
+        if (xtarget - x) * direction <= 0 and abs(v) <= a * h * 2:
+            x = float(xtarget)
+            v = 0.0
+        self._x = x
+        self._v = v
+
+
+def _to_signed(value: int, bits: int) -> int:
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
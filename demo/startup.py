@@ -0,0 +1,46 @@
+"""
+起動から待機状態までの各段階の所要時間の計測。
+
+__main__ の最初に読み込み、段階の終わりで phase() を呼び出す。
+待機状態になったら report() で内訳をログに出力する。
+"""
+from logging import getLogger
+import time
+
+# create logger
+logger = getLogger(__name__)
+
+_g_time_start = time.perf_counter()
+_g_time_phase = _g_time_start
+# (段階の名前, 所要時間（秒）)
+_g_phases = []
+
+
+def phase(name: str) -> float:
+    """
+    前の段階の終わりからの経過時間を name の段階として記録する。
+
+    :return: 段階の所要時間（秒）
+    """
+    global _g_time_phase
+    now = time.perf_counter()
+    elapsed = now - _g_time_phase
+    _g_time_phase = now
+    _g_phases.append((name, elapsed))
+    return elapsed
+
+
+def elapsed() -> float:
+    """
+    起動からの経過時間（秒）
+    """
+    return time.perf_counter() - _g_time_start
+
+
+def report() -> None:
+    """
+    記録した段階の内訳と起動からの合計時間をログに出力する。
+    """
+    for name, seconds in _g_phases:
+        logger.info(f"startup {name:<10}: {seconds:8.3f}s")
+    logger.info(f"startup {'ready':<10}: {elapsed():8.3f}s")
@@ -0,0 +1,87 @@
+"""
+停止時のモーター位置の保存と復元。
+
+終了時に各軸の XACTUAL と基準点（リミットスイッチの検出位置）を JSON で保存し、
+次の起動時に読み込んで削除する。運転中に電源が切れた場合は保存した位置が
+残らないため、次の起動では通常の基準点探索を行う。
+"""
+import json
+from logging import getLogger
+import os
+
+from constant import *
+
+# create logger
+logger = getLogger(__name__)
+
+VERSION = 1
+
+
+def load_state(path: str = STATE_FILE) -> dict:
+    """
+    保存した位置を読み込む。
+
+    :return: {軸の名前: {"xactual": XACTUAL, "reference": 基準点}}（ない場合は空）
+    """
+    if not path:
+        return {}
+    try:
+        with open(path, mode="r", encoding="utf-8") as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"state file read error {path}: {e}")
+        return {}
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        logger.warning(f"state file version mismatch {path}")
+        return {}
+    axes = {}
+    for name, entry in data.get("axes", {}).items():
+        try:
+            axes[name] = {
+                "xactual": int(entry["xactual"]),
+                "reference": int(entry["reference"]),
+            }
+        except (KeyError, TypeError, ValueError, OverflowError):
+            logger.warning(f"state file invalid axis {name}: {entry}")
+    return axes
+
+
+def consume_state(path: str = STATE_FILE) -> dict:
+    """
+    保存した位置を読み込んでファイルを削除する。以降に電源が切れた場合は
+    位置が不明として扱われる。
+    """
+    axes = load_state(path)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"state file remove error {path}: {e}")
+    return axes
+
+
+def save_state(axes: dict, path: str = STATE_FILE) -> None:
+    """
+    位置を保存する。一時ファイルに書き込んで同期してから置き換えるため、
+    書き込み中に電源が切れても壊れたファイルは残らない。
+
+    :param axes: {軸の名前: {"xactual": XACTUAL, "reference": 基準点}}
+    """
+    if not path:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as file:
+        json.dump({"version": VERSION, "axes": axes}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    # 置き換えたディレクトリエントリも同期する
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
@@ -1,5 +1,8 @@
+import heapq
+from itertools import count
 import pigpio
-from threading import Timer, Lock
+from threading import Condition, Thread, Timer, Lock
+import time
 
 
 from logging import getLogger
@@ -7,16 +10,94 @@ from logging import getLogger
 logger = getLogger(__name__)
 
 
+class SwitchDispatcher:
+    """
+    複数のスイッチのコールバックを1本のスレッドで実行するディスパッチャー。
+
+    エッジごとにタイマースレッドを作成する代わりに、期限付きの呼び出しを
+    ヒープに積んで順に実行する。
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._queue = []
+        self._seq = count()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = Thread(target=self._run, name="SwitchDispatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._queue.clear()
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def call_at(self, due: float, func, *args):
+        """
+        time.monotonic の時刻 due に func(*args) を呼び出す。
+        """
+        with self._cond:
+            heapq.heappush(self._queue, (due, next(self._seq), func, args))
+            self._cond.notify()
+
+    def call_soon(self, func, *args):
+        self.call_at(time.monotonic(), func, *args)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if self._queue:
+                        timeout = self._queue[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, func, args = heapq.heappop(self._queue)
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("switch callback error")
+
+
 class Switch:
     """
     Represents a switch connected to a Raspberry Pi GPIO pin.
 
+    Without a dispatcher, every edge restarts a threading.Timer and the level is
+    reported once it has been stable for debounce_interval (trailing-edge debounce).
+
+    With a dispatcher, the first edge is reported immediately and further edges
+    within debounce_interval (measured with the pigpio tick) are treated as bounce.
+    When the window closes, the level is read back from the last edge and reported
+    again if it settled differently. Callbacks run on the dispatcher thread.
+
+    If edge_callback is set, it is called for every raw edge matching the edge
+    configuration before debouncing, directly on the pigpio callback thread. It is
+    meant for latency critical actions such as an emergency stop and must return quickly.
+
     Args:
         pin (int): The GPIO pin number.
         pi (pigpio.pi): An instance of the pigpio.pi class representing the Raspberry Pi.
         debounce_interval (float, optional): The debounce interval in seconds. Defaults to 0.2.
         pud (int, optional): The pull-up/pull-down configuration. Defaults to pigpio.PUD_UP.
         edge (int, optional): The edge detection configuration. Defaults to pigpio.EITHER_EDGE.
+        dispatcher (SwitchDispatcher, optional): Shared dispatcher for tick based debouncing.
+        glitch_filter (int, optional): pigpio glitch filter steady time in microseconds. 0 disables it.
     """
 
     def __init__(
@@ -26,24 +107,56 @@ class Switch:
         debounce_interval: float = 0.2,
         pud=pigpio.PUD_UP,
         edge=pigpio.EITHER_EDGE,
+        dispatcher: SwitchDispatcher = None,
+        glitch_filter: int = 0,
     ):
         self._pin = pin
         self._timer = None
         self._lock = Lock()
 
         self._debounce_interval = debounce_interval
+        self._debounce_ticks = int(debounce_interval * 1000000)
         self._edge = edge
+        self._dispatcher = dispatcher
+        self._glitch_filter = glitch_filter
+        # デバウンス前のエッジを通知するコールバック
+        self.edge_callback = None
+
+        # ディスパッチャー使用時のデバウンス状態
+        self._raw_level = None
+        self._raw_tick = 0
+        self._window_tick = None
+        self._generation = 0
 
         self._pi = pi
         with self._lock:
             self._pi.set_mode(self._pin, pigpio.INPUT)
             self._pi.set_pull_up_down(self._pin, pud)
-            self._h_pi_cbk = self._pi.callback(
-                self._pin, pigpio.EITHER_EDGE, self._pigpio_callback
-            )
+            if 0 < self._glitch_filter:
+                self._pi.set_glitch_filter(self._pin, self._glitch_filter)
+            if self._dispatcher is None:
+                cbf = self._pigpio_callback
+            else:
+                cbf = self._pigpio_tick_callback
+            self._h_pi_cbk = self._pi.callback(self._pin, pigpio.EITHER_EDGE, cbf)
             self._level = self._pi.read(self._pin)
+            self._raw_level = self._level
+
+    def _raw_edge(self, level, tick):
+        if self.edge_callback is None or level == pigpio.TIMEOUT:
+            return
+        if self._is_target_edge(level):
+            self.edge_callback(self._pin, level, tick)
+
+    def _is_target_edge(self, level):
+        return (
+            self._edge == pigpio.EITHER_EDGE
+            or (self._edge == pigpio.RISING_EDGE and level)
+            or (self._edge == pigpio.FALLING_EDGE and not level)
+        )
 
     def _pigpio_callback(self, gpio, level, tick):
+        self._raw_edge(level, tick)
         logger.debug(f"gpio:{self._pin}, level:{level}, tick:{tick}")
         with self._lock:
             if isinstance(self._timer, Timer):
@@ -53,6 +166,52 @@ class Switch:
             )
             self._timer.start()
 
+    def _pigpio_tick_callback(self, gpio, level, tick):
+        self._raw_edge(level, tick)
+        logger.debug(f"gpio:{self._pin}, level:{level}, tick:{tick}")
+        with self._lock:
+            self._raw_level = level
+            self._raw_tick = tick
+            if self._window_tick is not None:
+                # tick は32ビットで周回する
+                if (tick - self._window_tick) & 0xFFFFFFFF < self._debounce_ticks:
+                    # デバウンス期間内のエッジはチャタリングとして扱う
+                    return
+            if level == self._level:
+                return
+            generation = self._open_window(tick)
+        self._dispatcher.call_soon(self._dispatch, generation, level, tick)
+
+    def _open_window(self, tick):
+        # ロック取得中に呼び出すこと
+        self._window_tick = tick
+        self._generation += 1
+        self._dispatcher.call_at(
+            time.monotonic() + self._debounce_interval,
+            self._close_window,
+            self._generation,
+        )
+        return self._generation
+
+    def _close_window(self, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._window_tick = None
+            level = self._raw_level
+            tick = self._raw_tick
+            if level == self._level:
+                return
+            # デバウンス期間中に確定したレベルが報告済みのレベルと異なる
+            generation = self._open_window(tick)
+        self._dispatch(generation, level, tick)
+
+    def _dispatch(self, generation, level, tick):
+        with self._lock:
+            if generation != self._generation:
+                return
+        self._callback(level, tick)
+
     def _callback(self, level, tick):
 
         with self._lock:
@@ -60,11 +219,7 @@ class Switch:
             if isinstance(self._timer, Timer):
                 self._timer.cancel()
                 self._timer = None
-        if (
-            self._edge == pigpio.EITHER_EDGE
-            or (self._edge == pigpio.RISING_EDGE and level)
-            or (self._edge == pigpio.FALLING_EDGE and not level)
-        ):
+        if self._is_target_edge(level):
             self.callback(self._pin, level, tick)
 
     def __del__(self):
@@ -86,6 +241,8 @@ class Switch:
             if self._timer is not None and isinstance(self._timer, Timer):
                 self._timer.cancel()
                 self._timer = None
+            # ディスパッチャーに積まれた呼び出しを無効にする
+            self._generation += 1
 
         if self._h_pi_cbk is not None and isinstance(self._h_pi_cbk, pigpio._callback):
             self._h_pi_cbk.cancel()
@@ -93,6 +250,8 @@ class Switch:
 
         if self._pi is not None:
             if isinstance(self._pi, pigpio.pi):
+                if 0 < self._glitch_filter:
+                    self._pi.set_glitch_filter(self._pin, 0)
                 self._pi.set_pull_up_down(self._pin, pigpio.PUD_OFF)
             self._pi = None
 
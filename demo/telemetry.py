@@ -0,0 +1,221 @@
+"""
+再生中の指令値と実位置を記録するテレメトリー。
+
+事前に確保した array のリングバッファに、時刻、サンプル番号、軸番号、指令した VMAX
+（負方向は負）、XACTUAL、VACTUAL を記録する。記録時は配列の要素を書き換えるだけで、
+リストの伸長や文字列の整形は行わない。停止時または要求時（SIGUSR1）にバイナリまたは CSV で書き出す。
+記録は再生の開始時に消去するため、書き出したファイルには1回の再生分だけが含まれる。
+
+再生は同じ指令が続くサンプルを1つのセグメントとして送るため、レコードはサンプルごと
+ではなく、指令を送ったセグメントごとに1件になる。index はセグメントの開始サンプル番号で、
+次のレコードの index までは同じ VMAX が続く。XACTUAL と VACTUAL は指令の直後に
+読み出した値で、セグメントの途中の位置は記録しない。
+
+バイナリ形式は HEADER（マジック、バージョン、レコード長、レコード数）に続いて
+RECORD のレコードが古い順に並ぶ。NumPy では RECORD_FIELDS を dtype として読み込める。
+"""
+from array import array
+import csv
+from logging import getLogger
+import os
+import struct
+from threading import Lock
+import time
+
+from constant import *
+
+# create logger
+logger = getLogger(__name__)
+
+MAGIC = b"APTR"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+RECORD_FIELDS = (
+    ("time", "<f8"),
+    ("index", "<u4"),
+    ("axis", "<u4"),
+    ("vmax", "<i4"),
+    ("xactual", "<i4"),
+    ("vactual", "<i4"),
+)
+RECORD = struct.Struct("<dIIiii")
+
+
+class TelemetryChannel:
+    """
+    1軸分の記録口。間引きのカウンターを軸ごとに持つ。
+
+    ApneaAxis.step がセグメントの指令を送るたびに record を呼び出す。
+
+    :param recorder: 記録先のレコーダー
+    :param axis: 軸番号
+    """
+
+    __slots__ = ("_recorder", "_axis", "_tick")
+
+    def __init__(self, recorder: "TelemetryRecorder", axis: int):
+        self._recorder = recorder
+        self._axis = axis
+        self._tick = 0
+
+    def record(self, index: int, vmax: int, motorController) -> None:
+        """
+        セグメントの指令を送った直後に呼び出す。間引き対象の指令ではステータスを読まずに戻る。
+
+        記録するレコードごとにステータスを1回読み出す。指令の書き込みでステータスの
+        キャッシュは破棄されるため、通常は SPI 通信を伴う（サンプルごとではなく
+        セグメントごとの通信）。
+
+        :param index: セグメントの開始サンプル番号
+        :param vmax: 指令した VMAX（負方向の場合は負の値）
+        :param motorController: ステータスを読むモーターコントローラー
+        """
+        recorder = self._recorder
+        self._tick += 1
+        if self._tick < recorder.decimation:
+            return
+        self._tick = 0
+        status = motorController.status(recorder.max_age)
+        recorder.append(index, self._axis, vmax, status.xactual, status.vactual)
+
+
+class TelemetryRecorder:
+    """
+    テレメトリーのリングバッファ。容量を超えると古いレコードから上書きする。
+
+    :param capacity: 記録するレコード数（1件が1セグメント）
+    :param decimation: 記録するセグメントの間隔（1ですべての指令）
+    :param path: 書き出し先（strftime の書式を使用可。拡張子が .csv の場合は CSV）
+    :param max_age: 記録時に使うステータスキャッシュの最大経過時間（秒）
+    :param clock: 単調増加時計（秒）
+    """
+
+    def __init__(
+        self,
+        capacity: int = TELEMETRY_CAPACITY,
+        decimation: int = TELEMETRY_DECIMATION,
+        path: str = TELEMETRY_FILE,
+        max_age: float = 0.0,
+        clock=time.monotonic,
+    ):
+        if capacity <= 0:
+            raise ValueError(f"capacity must be positive: {capacity}")
+        self._capacity = capacity
+        self.decimation = max(1, decimation)
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+
+        self._time = array("d", [0.0]) * capacity
+        self._index = array("L", [0]) * capacity
+        self._axis = array("L", [0]) * capacity
+        self._vmax = array("l", [0]) * capacity
+        self._xactual = array("l", [0]) * capacity
+        self._vactual = array("l", [0]) * capacity
+        # 次に書き込む位置と記録した総数
+        self._head = 0
+        self._total = 0
+        self._lock = Lock()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def total(self):
+        """
+        記録した総レコード数（上書きされたものを含む）
+        """
+        return self._total
+
+    def __len__(self):
+        return min(self._total, self._capacity)
+
+    def channel(self, axis: int) -> TelemetryChannel:
+        return TelemetryChannel(self, axis)
+
+    def append(
+        self, index: int, axis: int, vmax: int, xactual: int, vactual: int
+    ) -> None:
+        with self._lock:
+            pos = self._head
+            self._time[pos] = self._clock()
+            self._index[pos] = index
+            self._axis[pos] = axis
+            self._vmax[pos] = vmax
+            self._xactual[pos] = xactual
+            self._vactual[pos] = vactual
+            pos += 1
+            self._head = 0 if pos == self._capacity else pos
+            self._total += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._head = 0
+            self._total = 0
+
+    def snapshot(self) -> list[array]:
+        """
+        記録中のレコードを古い順に並べた列のコピーを返す。
+        """
+        with self._lock:
+            head = self._head
+            count = min(self._total, self._capacity)
+            columns = (
+                self._time,
+                self._index,
+                self._axis,
+                self._vmax,
+                self._xactual,
+                self._vactual,
+            )
+            if count < self._capacity:
+                return [column[:count] for column in columns]
+            return [column[head:] + column[:head] for column in columns]
+
+    def dump(self, path: str = None) -> str:
+        """
+        記録中のレコードをファイルへ書き出す。
+
+        :param path: 書き出し先（省略時はコンストラクタの設定値）
+        :return: 書き出したファイルのパス（書き出し先がない場合は None）
+        """
+        if path is None:
+            path = self.path
+        if not path:
+            return None
+        path = time.strftime(path)
+        columns = self.snapshot()
+        if os.path.splitext(path)[1].lower() == ".csv":
+            self._write_csv(path, columns)
+        else:
+            self._write_binary(path, columns)
+        logger.info(f"telemetry dump: {path} records:{len(columns[0])}")
+        return path
+
+    def _write_binary(self, path: str, columns: list[array]) -> None:
+        count = len(columns[0])
+        buffer = bytearray(HEADER.size + RECORD.size * count)
+        HEADER.pack_into(buffer, 0, MAGIC, VERSION, RECORD.size, count)
+        offset = HEADER.size
+        for row in zip(*columns):
+            RECORD.pack_into(buffer, offset, *row)
+            offset += RECORD.size
+        with open(path, mode="wb") as file:
+            file.write(buffer)
+
+    def _write_csv(self, path: str, columns: list[array]) -> None:
+        with open(path, mode="w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow([name for name, _ in RECORD_FIELDS])
+            for row in zip(*columns):
+                writer.writerow((f"{row[0]:.6f}",) + row[1:])
+
+
+def create_recorder() -> TelemetryRecorder:
+    """
+    設定に従ってレコーダーを作成する。TELEMETRY_CAPACITY が 0 の場合は None。
+    """
+    if TELEMETRY_CAPACITY <= 0:
+        return None
+    return TelemetryRecorder()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# demo のモジュールはディレクトリ直下から読み込む（python -m demo と同じ）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
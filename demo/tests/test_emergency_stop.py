@@ -0,0 +1,81 @@
+from cgstep import TMC5240
+import pytest
+
+import constant
+from apnea.data import ApneaData
+from apnea.demo import ApneaPlayer, StopEvent
+from motor import MotorController
+from simulator import SimulatedTMC5240
+
+import benchmark
+
+REG_VMAX = 0x27
+
+
+def create_motor_controller():
+    driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV)
+    motorController = MotorController(steps_per_rev=constant.STEPS_PER_REV, driver=driver)
+    motorController.poweron()
+    return motorController
+
+
+@pytest.fixture
+def motorController():
+    return create_motor_controller()
+
+
+@pytest.fixture
+def player(tmp_path):
+    path = str(tmp_path / "profile.csv")
+    benchmark.write_profile(path, 100)
+    player = ApneaPlayer()
+    for _ in range(2):
+        player.add_axis(create_motor_controller(), ApneaData(path, cache_dir=""))
+    return player
+
+
+def test_emergency_stop_writes_vmax_zero(motorController):
+    motorController.set_velocity(10000, TMC5240.RAMPMODE_VELOCITY_POSITIVE)
+
+    motorController.emergency_stop()
+
+    assert motorController.emergency_stopped
+    assert motorController.tmc5240.read_register(REG_VMAX) == 0
+
+
+def test_emergency_stop_latches_commands(motorController):
+    motorController.emergency_stop()
+
+    # ラッチ中の指令は無視する
+    motorController.set_velocity(10000, TMC5240.RAMPMODE_VELOCITY_POSITIVE)
+    assert motorController.tmc5240.read_register(REG_VMAX) == 0
+
+    motorController.clear_emergency_stop()
+    motorController.set_velocity(10000, TMC5240.RAMPMODE_VELOCITY_POSITIVE)
+    assert motorController.tmc5240.read_register(REG_VMAX) == 10000
+
+
+def test_emergency_stop_latency(motorController):
+    assert motorController.emergency_stop(0.0) is not None
+    # 2回目はラッチ済みのため書き込まない
+    assert motorController.emergency_stop(0.0) is None
+
+
+def test_player_emergency_stop_latches_all_axes(player):
+    latencies = player.emergency_stop()
+
+    assert len(latencies) == 2
+    assert all(axis.motorController.emergency_stopped for axis in player.axes)
+    # チャタリングによる2回目のエッジでは何もしない
+    assert player.emergency_stop() == []
+
+
+def test_player_emergency_stop_ignored_while_stopping(player):
+    steps = player.demo_steps()
+    # 停止要求で基準点への戻りを始めたところで止める
+    next(steps)
+    steps.throw(StopEvent())
+
+    assert player.emergency_stop() == []
+    assert not any(axis.motorController.emergency_stopped for axis in player.axes)
+    steps.close()
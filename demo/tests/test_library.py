@@ -0,0 +1,130 @@
+import os
+import time
+
+import pytest
+
+import constant
+from apnea.library import ProfileLibrary
+from motor import MotorController
+from simulator import SimulatedTMC5240
+
+import benchmark
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    # ApneaData のキャッシュ（.cache）を作業ディレクトリに作らない
+    monkeypatch.chdir(tmp_path)
+    directory = tmp_path / "profiles"
+    directory.mkdir()
+    for name in ("a.csv", "b.csv", "c.csv"):
+        benchmark.write_profile(str(directory / name), 100)
+    (directory / "readme.txt").write_text("not a profile", encoding="utf-8")
+    return directory
+
+
+def compile_schedule(apneadata):
+    driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV)
+    motorController = MotorController(steps_per_rev=constant.STEPS_PER_REV, driver=driver)
+    return motorController.compile_schedule(
+        apneadata.sampling_interval, apneadata.usteps_multiplier, apneadata.diffs
+    ).segments()
+
+
+def profile_size(directory) -> int:
+    return ProfileLibrary(str(directory)).load("a.csv").nbytes
+
+
+def test_select(directory):
+    library = ProfileLibrary(str(directory))
+
+    assert library.names() == ["a.csv", "b.csv", "c.csv"]
+    assert library.selected == "a.csv"
+    assert library.select_next() == "b.csv"
+    assert library.select("c.csv") == "c.csv"
+    assert library.select_next() == "a.csv"
+    with pytest.raises(KeyError):
+        library.select("readme.txt")
+
+
+def test_load_is_cached(directory):
+    library = ProfileLibrary(str(directory))
+
+    apneadata = library.load()
+
+    assert library.load("a.csv") is apneadata
+    assert library.size == apneadata.nbytes
+
+
+def test_eviction_is_lru(directory):
+    library = ProfileLibrary(str(directory), cache_size=2 * profile_size(directory))
+    a = library.load("a.csv")
+    b = library.load("b.csv")
+
+    c = library.load("c.csv")
+
+    # 最も古い b を破棄し、選択中の a は残す
+    assert library.load("a.csv") is a
+    assert library.load("c.csv") is c
+    assert library.load("b.csv") is not b
+    assert library.size <= library.cache_size
+
+
+def test_selected_is_never_evicted(directory):
+    library = ProfileLibrary(str(directory), cache_size=1)
+    a = library.load()
+
+    b = library.load("b.csv")
+
+    assert library.load() is a
+    assert library.load("b.csv") is not b
+    assert library.size == a.nbytes
+
+
+def test_schedule_cached_per_key(directory):
+    library = ProfileLibrary(str(directory))
+    apneadata = library.load()
+    compiled = []
+
+    def compile():
+        compiled.append(apneadata.name)
+        return compile_schedule(apneadata)
+
+    first = library.schedule(apneadata, ("axis0", 0), compile)
+    assert library.schedule(apneadata, ("axis0", 0), compile) is first
+    library.schedule(apneadata, ("axis1", 0), compile)
+    assert len(compiled) == 2
+    assert apneadata.nbytes < library.size
+
+
+def test_invalidate_reloads(directory):
+    library = ProfileLibrary(str(directory))
+    apneadata = library.load()
+    schedule = library.schedule(apneadata, "key", lambda: compile_schedule(apneadata))
+
+    library.invalidate("a.csv")
+
+    assert library.size == 0
+    # 破棄したプロファイルのスケジュールはキャッシュせずに変換する
+    reloaded = library.schedule(apneadata, "key", lambda: compile_schedule(apneadata))
+    assert reloaded is not schedule
+    assert library.size == 0
+    assert library.load() is not apneadata
+
+
+def test_watch_reloads_rewritten_file(directory):
+    library = ProfileLibrary(str(directory)).start_watch(poll_interval=0.01)
+    try:
+        apneadata = library.load()
+        assert len(apneadata.diffs) == 100
+
+        path = str(directory / "a.csv")
+        benchmark.write_profile(f"{path}.tmp", 200)
+        os.replace(f"{path}.tmp", path)
+
+        deadline = time.monotonic() + 5.0
+        while library.load() is apneadata and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(library.load().diffs) == 200
+    finally:
+        library.stop_watch()
@@ -0,0 +1,97 @@
+from cgstep import TMC5240
+import pytest
+
+import constant
+from apnea.data import ApneaData
+from benchmark import reference_schedule, write_profile
+from motor import MotorController
+from simulator import SimulatedTMC5240
+
+
+@pytest.fixture
+def motorController():
+    driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV)
+    return MotorController(constant.STEPS_PER_REV, driver=driver)
+
+
+@pytest.fixture
+def apneadata(tmp_path):
+    # 呼吸と無呼吸（移動量0）を含む合成プロファイル
+    path = str(tmp_path / "profile.csv")
+    write_profile(path, 4000)
+    return ApneaData(path, cache_dir="")
+
+
+def compile_schedule(motorController, apneadata):
+    return motorController.compile_schedule(
+        apneadata.sampling_interval, apneadata.usteps_multiplier, apneadata.diffs
+    )
+
+
+def test_compile_schedule_matches_reference(motorController, apneadata):
+    schedule = compile_schedule(motorController, apneadata)
+
+    assert len(schedule) == len(apneadata.diffs)
+    assert list(schedule) == reference_schedule(motorController.tmc5240, apneadata)
+
+
+def test_compile_schedule_direction(motorController, apneadata):
+    schedule = compile_schedule(motorController, apneadata)
+
+    for (vmax, rampmode), diff in zip(schedule, apneadata.diffs):
+        if diff < 0:
+            assert rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+        else:
+            assert rampmode == TMC5240.RAMPMODE_VELOCITY_POSITIVE
+        assert (vmax == 0) == (diff == 0)
+
+
+def expand(segments):
+    """
+    セグメントをサンプルごとの (VMAX, RAMPMODE) に展開する。
+    """
+    samples = []
+    position = 0
+    for vmax, rampmode, start, count in segments:
+        assert start == position
+        assert 0 < count
+        samples.extend([(vmax, rampmode)] * count)
+        position += count
+    return samples
+
+
+@pytest.mark.parametrize("max_length", [0, 1, 7, 50])
+def test_segments_match_reference(motorController, apneadata, max_length):
+    segments = compile_schedule(motorController, apneadata).segments(max_length)
+
+    assert segments.samples == len(apneadata.diffs)
+    assert expand(segments) == reference_schedule(motorController.tmc5240, apneadata)
+    if 0 < max_length:
+        assert max(segments.count) <= max_length
+
+
+def test_segments_merge_runs(motorController, apneadata):
+    segments = compile_schedule(motorController, apneadata).segments()
+
+    commands = list(zip(segments.vmax.tolist(), segments.rampmode.tolist()))
+    # 隣り合うセグメントの指令は異なる
+    assert all(a != b for a, b in zip(commands, commands[1:]))
+    # 無呼吸の区間は1つのセグメントになる
+    assert max(segments.count) >= 1000
+
+
+def test_segments_split_long_run(motorController):
+    schedule = motorController.compile_schedule(0.01, 1.0, [0] * 10)
+
+    segments = schedule.segments(4)
+
+    assert list(segments.start) == [0, 4, 8]
+    assert list(segments.count) == [4, 4, 2]
+    assert list(segments.vmax) == [0, 0, 0]
+
+
+def test_segments_empty(motorController):
+    segments = motorController.compile_schedule(0.01, 1.0, []).segments(4)
+
+    assert len(segments) == 0
+    assert segments.samples == 0
@@ -0,0 +1,120 @@
+from cgstep import TMC5240
+import pytest
+
+import constant
+from apnea.data import ApneaData
+from apnea.demo import ApneaPlayer, StopEvent
+from motor import MotorController
+from scheduler import DeadlineScheduler, VirtualClock
+from simulator import SimulatedTMC5240
+
+import benchmark
+
+REG_VMAX = 0x27
+
+
+def create_motor_controller(clock: VirtualClock):
+    driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV, clock=clock.now)
+    motorController = MotorController(
+        steps_per_rev=constant.STEPS_PER_REV, driver=driver, clock=clock.now
+    )
+    motorController.poweron()
+    return motorController
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+@pytest.fixture
+def player(tmp_path, clock):
+    path = str(tmp_path / "profile.csv")
+    benchmark.write_profile(path, 1000)
+    player = ApneaPlayer(clock=clock.now, sleep=clock.sleep)
+    for _ in range(2):
+        axis = player.add_axis(
+            create_motor_controller(clock), ApneaData(path, cache_dir="")
+        )
+        axis.compile()
+    return player
+
+
+def vmax(player: ApneaPlayer) -> list[int]:
+    return [axis.motorController.tmc5240.read_register(REG_VMAX) for axis in player.axes]
+
+
+def play_until(player: ApneaPlayer, clock: VirtualClock, condition):
+    """
+    仮想時計を期限まで進めながら、condition() が成立するまで再生の手順を進める。
+    """
+    steps = player.play_steps(DeadlineScheduler(0.01, clock=clock.now))
+    wait = next(steps)
+    while not condition():
+        clock.sleep(wait - clock.now())
+        wait = next(steps)
+    return steps
+
+
+def test_pause_requires_playing(player):
+    assert not player.pause()
+    assert not player.resume()
+    assert player.state == "idle"
+
+
+def test_pause_and_resume(player, clock):
+    steps = play_until(player, clock, lambda: all(vmax(player)))
+    command = vmax(player)
+    deadlines = [axis.deadline for axis in player.axes]
+    assert player.state == "playing"
+
+    assert player.pause()
+    assert not player.pause()
+    # 一時停止はモーターを停止し、再開の要求まで待機する
+    assert next(steps) is None
+    assert vmax(player) == [0, 0]
+    assert player.state == "paused"
+    assert player.snapshot["state"] == "paused"
+
+    clock.sleep(5.0)
+    assert player.resume()
+    next(steps)
+    # 止めたセグメントの指令を送り直し、期限を一時停止していた時間だけ遅らせる
+    assert vmax(player) == command
+    assert player.state == "playing"
+    for axis, deadline in zip(player.axes, deadlines):
+        assert axis.deadline == pytest.approx(deadline + 5.0)
+    steps.close()
+
+
+def test_stop_while_paused(player, clock):
+    steps = play_until(player, clock, lambda: all(vmax(player)))
+    player.pause()
+    assert next(steps) is None
+
+    with pytest.raises(StopEvent):
+        steps.throw(StopEvent())
+    assert vmax(player) == [0, 0]
+
+
+def test_resume_skips_negative_command_at_reference_point(player, clock):
+    steps = play_until(
+        player,
+        clock,
+        lambda: all(vmax(player))
+        and all(
+            axis.motorController.rampmode == TMC5240.RAMPMODE_VELOCITY_NEGATIVE
+            for axis in player.axes
+        ),
+    )
+    command = vmax(player)
+    player.pause()
+    next(steps)
+
+    player.reached_reference_point(0)
+    player.resume()
+    next(steps)
+
+    # 基準点に到達した軸は逆方向の指令を送り直さない
+    assert vmax(player) == [0, command[1]]
+    steps.close()
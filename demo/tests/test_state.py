@@ -0,0 +1,100 @@
+import json
+import os
+
+import constant
+from apnea.data import ApneaData
+from apnea.demo import ApneaPlayer
+from motor import MotorController
+from simulator import SimulatedTMC5240
+from state import consume_state, load_state, save_state
+
+import benchmark
+
+AXES = {
+    "axis0": {"xactual": 12345, "reference": -678},
+    "axis1": {"xactual": -1, "reference": 0},
+}
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "state.json")
+
+    save_state(AXES, path)
+
+    assert load_state(path) == AXES
+    # 一時ファイルは残らない
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_consume_removes_file(tmp_path):
+    path = str(tmp_path / "state.json")
+    save_state(AXES, path)
+
+    assert consume_state(path) == AXES
+    assert not os.path.exists(path)
+    assert consume_state(path) == {}
+
+
+def test_missing_file(tmp_path):
+    assert load_state(str(tmp_path / "state.json")) == {}
+    assert load_state("") == {}
+
+
+def test_corrupt_file(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text('{"version": 1, "axes": {"axis0": {"xact', encoding="utf-8")
+
+    assert load_state(str(path)) == {}
+    # 壊れたファイルも読み込み時に削除する
+    assert consume_state(str(path)) == {}
+    assert not path.exists()
+
+
+def test_version_mismatch(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text(json.dumps({"version": 0, "axes": AXES}), encoding="utf-8")
+
+    assert load_state(str(path)) == {}
+
+
+def test_invalid_axis_skipped(tmp_path):
+    path = tmp_path / "state.json"
+    axes = dict(
+        AXES,
+        axis2={"xactual": "abc", "reference": 0},
+        axis3={"xactual": 1},
+        axis4={"xactual": 1e400, "reference": 0},
+    )
+    path.write_text(json.dumps({"version": 1, "axes": axes}), encoding="utf-8")
+
+    assert load_state(str(path)) == AXES
+
+
+def test_player_position_state_round_trip(tmp_path):
+    profile = str(tmp_path / "profile.csv")
+    benchmark.write_profile(profile, 100)
+
+    def create_player():
+        player = ApneaPlayer()
+        for _ in range(2):
+            driver = SimulatedTMC5240(steps_per_rev=constant.STEPS_PER_REV)
+            motorController = MotorController(
+                steps_per_rev=constant.STEPS_PER_REV, driver=driver
+            )
+            motorController.poweron()
+            player.add_axis(motorController, ApneaData(profile, cache_dir=""))
+        return player
+
+    player = create_player()
+    # 基準点が不明な軸は保存しない
+    assert player.position_state() == {}
+
+    path = str(tmp_path / "state.json")
+    player.restore_position_state(AXES)
+    save_state(player.position_state(), path)
+
+    restored = create_player()
+    restored.restore_position_state(consume_state(path))
+    assert restored.position_state() == AXES
+    for axis in restored.axes:
+        assert axis.motorController.status(0).xactual == AXES[axis.name]["xactual"]
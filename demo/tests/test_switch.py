@@ -0,0 +1,177 @@
+import heapq
+from itertools import count
+
+import pigpio
+import pytest
+
+from switch import Switch
+
+PIN = 5
+
+
+class FakePi:
+    """
+    エッジを手動で発生させる pigpio.pi の代わり。
+    """
+
+    def __init__(self, level=pigpio.HIGH):
+        self.level = level
+        self.cbf = None
+
+    def set_mode(self, pin, mode):
+        pass
+
+    def set_pull_up_down(self, pin, pud):
+        pass
+
+    def set_glitch_filter(self, pin, steady):
+        pass
+
+    def callback(self, pin, edge, cbf):
+        self.cbf = cbf
+        return None
+
+    def read(self, pin):
+        return self.level
+
+    def edge(self, level, tick):
+        self.level = level
+        self.cbf(PIN, level, tick & 0xFFFFFFFF)
+
+
+class ManualDispatcher:
+    """
+    期限付きの呼び出しを run で実行する SwitchDispatcher の代わり。
+    呼び出しの順序は期限の順で、時刻は進めない。
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._seq = count()
+
+    def call_at(self, due, func, *args):
+        heapq.heappush(self._queue, (due, next(self._seq), func, args))
+
+    def call_soon(self, func, *args):
+        self.call_at(float("-inf"), func, *args)
+
+    def run_soon(self):
+        # 直ちに実行する呼び出し（デバウンス期間の開始時の通知）のみ実行する
+        while self._queue and self._queue[0][0] == float("-inf"):
+            _, _, func, args = heapq.heappop(self._queue)
+            func(*args)
+
+    def run(self):
+        # デバウンス期間の終了を含むすべての呼び出しを実行する
+        while self._queue:
+            _, _, func, args = heapq.heappop(self._queue)
+            func(*args)
+
+
+@pytest.fixture
+def pi():
+    return FakePi()
+
+
+@pytest.fixture
+def dispatcher():
+    return ManualDispatcher()
+
+
+@pytest.fixture
+def reports():
+    return []
+
+
+def create_switch(pi, dispatcher, reports, edge=pigpio.EITHER_EDGE):
+    switch = Switch(PIN, pi, debounce_interval=0.01, edge=edge, dispatcher=dispatcher)
+    switch.callback = lambda gpio, level, tick: reports.append((level, tick))
+    return switch
+
+
+def test_first_edge_reported_immediately(pi, dispatcher, reports):
+    switch = create_switch(pi, dispatcher, reports)
+
+    pi.edge(pigpio.LOW, 1000)
+    dispatcher.run_soon()
+
+    assert reports == [(pigpio.LOW, 1000)]
+    assert switch.level == pigpio.LOW
+
+
+def test_bounce_within_interval_ignored(pi, dispatcher, reports):
+    switch = create_switch(pi, dispatcher, reports)
+
+    pi.edge(pigpio.LOW, 1000)
+    pi.edge(pigpio.HIGH, 1200)
+    pi.edge(pigpio.LOW, 1500)
+    dispatcher.run()
+
+    assert reports == [(pigpio.LOW, 1000)]
+    assert switch.level == pigpio.LOW
+
+
+def test_settled_level_reported_when_window_closes(pi, dispatcher, reports):
+    switch = create_switch(pi, dispatcher, reports)
+
+    # 押した直後に離れ、デバウンス期間内に HIGH で落ち着く
+    pi.edge(pigpio.LOW, 1000)
+    pi.edge(pigpio.HIGH, 3000)
+    dispatcher.run_soon()
+    assert reports == [(pigpio.LOW, 1000)]
+
+    dispatcher.run()
+    assert reports == [(pigpio.LOW, 1000), (pigpio.HIGH, 3000)]
+    assert switch.level == pigpio.HIGH
+
+
+def test_edge_after_interval_reported(pi, dispatcher, reports):
+    create_switch(pi, dispatcher, reports)
+
+    pi.edge(pigpio.LOW, 1000)
+    dispatcher.run()
+    pi.edge(pigpio.HIGH, 1000 + 10000)
+    dispatcher.run()
+
+    assert reports == [(pigpio.LOW, 1000), (pigpio.HIGH, 11000)]
+
+
+def test_tick_wraparound(pi, dispatcher, reports):
+    create_switch(pi, dispatcher, reports)
+
+    # tick は32ビットで周回する。周回後の 200us 先のエッジもデバウンス期間内
+    pi.edge(pigpio.LOW, 0xFFFFFF00)
+    pi.edge(pigpio.HIGH, 0x100000000 + 100)
+    dispatcher.run_soon()
+    pi.edge(pigpio.LOW, 0x100000000 + 200)
+    dispatcher.run()
+
+    assert reports == [(pigpio.LOW, 0xFFFFFF00)]
+
+
+def test_rising_edge_only(pi, dispatcher, reports):
+    switch = create_switch(pi, dispatcher, reports, edge=pigpio.RISING_EDGE)
+
+    pi.edge(pigpio.LOW, 1000)
+    dispatcher.run()
+    pi.edge(pigpio.HIGH, 20000)
+    dispatcher.run()
+
+    # LOW は通知しないがレベルは反映する
+    assert reports == [(pigpio.HIGH, 20000)]
+    assert switch.level == pigpio.HIGH
+
+
+def test_edge_callback_called_for_every_raw_edge(pi, dispatcher, reports):
+    switch = create_switch(pi, dispatcher, reports, edge=pigpio.RISING_EDGE)
+    raw = []
+    switch.edge_callback = lambda gpio, level, tick: raw.append((level, tick))
+
+    pi.edge(pigpio.LOW, 1000)
+    pi.edge(pigpio.HIGH, 1200)
+    pi.edge(pigpio.LOW, 1500)
+    pi.edge(pigpio.HIGH, 1800)
+
+    # デバウンス前に、対象のエッジ（RISING）ごとに直ちに呼び出される
+    assert raw == [(pigpio.HIGH, 1200), (pigpio.HIGH, 1800)]
+    assert reports == []
@@ -0,0 +1,71 @@
+from threading import Event
+
+import numpy as np
+import pytest
+
+from apnea import validate
+from apnea.data import ApneaData
+from scheduler import DeadlineScheduler, VirtualClock
+
+import benchmark
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    # ApneaData のキャッシュ（.cache）を作業ディレクトリに作らない
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "profile.csv")
+    benchmark.write_profile(path, 3000)
+    return path
+
+
+def test_virtual_clock_sleep_advances_time():
+    clock = VirtualClock(10.0)
+    scheduler = DeadlineScheduler(0.01, clock=clock.now, sleep=clock.sleep)
+
+    assert scheduler.sleep_until(12.5)
+    assert clock.now() == 12.5
+    # 過ぎた期限では時計を戻さない
+    assert scheduler.sleep_until(11.0)
+    assert clock.now() == 12.5
+
+
+def test_virtual_clock_sleep_checks_wake_event():
+    clock = VirtualClock()
+    wake_event = Event()
+    wake_event.set()
+    scheduler = DeadlineScheduler(0.01, wake_event, clock.now, clock.sleep)
+
+    assert not scheduler.sleep_until(1.0)
+
+
+def test_simulate_runs_in_virtual_time(path):
+    apneadata = ApneaData(path)
+
+    trace, stats = validate.simulate(apneadata, axes=2, samples=2000)
+
+    # 最後のセグメントを指令したところで終わる
+    assert stats["samples"] == 2000
+    assert 19.9 < stats["virtual_seconds"] <= 2000 * apneadata.sampling_interval
+    assert stats["overruns"] == 0
+    assert set(trace["axis"]) == {0, 1}
+    assert trace["index"].max() < 2000
+
+
+def test_simulate_is_deterministic(path):
+    apneadata = ApneaData(path)
+
+    first, first_stats = validate.simulate(apneadata)
+    second, second_stats = validate.simulate(apneadata)
+
+    assert np.array_equal(first, second)
+    assert first_stats["register_transfers"] == second_stats["register_transfers"]
+
+
+def test_validate_max_error(path):
+    assert validate.validate(path)["ok"]
+
+    result = validate.validate(path, max_error=-1.0)
+    assert not result["ok"]
+    assert "position error" in result["errors"][0]
+    assert validate.main([path, "--max-error", "-1"]) == 1